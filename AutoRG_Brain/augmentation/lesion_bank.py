@@ -0,0 +1,155 @@
+"""
+Pre-rendered bank of Perlin-perturbed sphere lesions (see prelin_sphere.py) for the copy-paste abnormal synthesis.
+Meshing with VTK and rasterizing with ITK for every sample is slow, so the binary masks are rendered once into a
+memory-mapped file and the sampler only applies cheap flips, axis permutations and scaling.
+"""
+import argparse
+import os
+import pickle
+
+import numpy as np
+from scipy.ndimage import zoom
+
+# volume range (voxels) of the lesions drawn in dataset/copypaste.py tumor_array_generate
+LESION_VOLUME_RANGE = (7000, 200000)
+DEFAULT_BANK_RADII = (12, 18, 27)
+
+
+def sample_lesion_radius():
+    k = 4/3 * np.pi
+    volume = np.random.randint(*LESION_VOLUME_RANGE)
+    return (volume / k) ** (1/3)
+
+
+def get_cube_size(max_radius, scale=0.5):
+    # radius / ratio (ratio >= 0.8) plus noise * scale along the normal, + some border
+    extent = max_radius / 0.8 * (1 + scale)
+    return int(np.ceil(2 * extent / 8.) * 8) + 8
+
+
+def render_lesion(input_poly_data, radius, cube_size, octaves=4, offset=0, ratio=1., scale=0.5):
+    """
+    rasterizes one perturbed sphere centered in a cube of cube_size voxels (1 voxel = 1 unit)
+    :return: (cube_size, cube_size, cube_size) bool mask
+    """
+    from augmentation.prelin_sphere import get_resection_poly_data
+    from augmentation.vtk_itk import pd_to_numpy_vol
+
+    a = radius
+    b = radius / ratio
+    c = radius * ratio
+    center = [cube_size / 2.] * 3
+    poly_data = get_resection_poly_data(input_poly_data, offset, center, (c, b, a), None, octaves, scale)
+    ndseg = pd_to_numpy_vol(poly_data, spacing=[1., 1., 1.], shape=[cube_size] * 3, origin=[0., 0., 0.])
+    return ndseg > 0
+
+
+def generate_lesion_bank(output_file, input_poly_data, num_lesions=2000, radii=DEFAULT_BANK_RADII, seed=1234,
+                         scale=0.5):
+    """
+    renders num_lesions masks (cycling through radii) into output_file (.npy, bit packed along the last axis) and
+    writes the per lesion radius and bounding box to output_file[:-4] + '.pkl'
+    """
+    rndst = np.random.RandomState(seed)
+    cube_size = get_cube_size(max(radii), scale)
+
+    tmp_file = output_file + ".tmp"
+    masks = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8,
+                                      shape=(num_lesions, cube_size, cube_size, cube_size // 8))
+    lesion_radii = np.zeros(num_lesions, dtype=np.float32)
+    bboxes = np.zeros((num_lesions, 3, 2), dtype=np.int32)
+
+    for i in range(num_lesions):
+        radius = radii[i % len(radii)]
+        mask = render_lesion(input_poly_data, radius, cube_size, octaves=rndst.randint(4, 8),
+                             offset=rndst.randint(1000), ratio=rndst.uniform(0.8, 1), scale=scale)
+        masks[i] = np.packbits(mask, axis=-1)
+        lesion_radii[i] = radius
+        for d in range(3):
+            nonzero = np.where(np.any(mask, axis=tuple(j for j in range(3) if j != d)))[0]
+            if len(nonzero) > 0:
+                bboxes[i, d] = nonzero[0], nonzero[-1] + 1
+        if (i + 1) % 100 == 0:
+            print("rendered", i + 1, "of", num_lesions, "lesions")
+
+    masks.flush()
+    del masks
+    os.replace(tmp_file, output_file)
+    with open(output_file[:-4] + ".pkl", 'wb') as f:
+        pickle.dump({'radii': lesion_radii, 'bboxes': bboxes, 'cube_size': cube_size}, f)
+
+
+class LesionBank(object):
+    def __init__(self, bank_file, scale_range=(0.85, 1.15)):
+        """
+        draws lesion masks from a bank written by generate_lesion_bank. The bank is opened lazily (memmap), so the
+        object can be handed to the data augmentation workers
+        :param scale_range: extra random scaling on top of matching the requested radius
+        """
+        self.bank_file = bank_file
+        self.scale_range = scale_range
+        with open(bank_file[:-4] + ".pkl", 'rb') as f:
+            meta = pickle.load(f)
+        self.radii = meta['radii']
+        self.bboxes = meta['bboxes']
+        self.cube_size = meta['cube_size']
+        self.bank_radii = np.unique(self.radii)
+        self._masks = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_masks'] = None
+        return state
+
+    @property
+    def masks(self):
+        if self._masks is None:
+            self._masks = np.load(self.bank_file, mmap_mode='r')
+        return self._masks
+
+    def __len__(self):
+        return len(self.radii)
+
+    def sample(self, radius=None):
+        """
+        :param radius: target radius in voxels, drawn like tumor_array_generate if None
+        :return: bool mask cropped to the lesion
+        """
+        if radius is None:
+            radius = sample_lesion_radius()
+        bank_radius = self.bank_radii[np.argmin(np.abs(self.bank_radii - radius))]
+        idx = np.random.choice(np.where(self.radii == bank_radius)[0])
+
+        bbox = self.bboxes[idx]
+        mask = np.unpackbits(self.masks[idx], axis=-1, count=self.cube_size).astype(bool)
+        mask = mask[bbox[0, 0]:bbox[0, 1], bbox[1, 0]:bbox[1, 1], bbox[2, 0]:bbox[2, 1]]
+
+        # rotations by multiples of 90 degrees and flips
+        mask = mask.transpose(np.random.permutation(3))
+        for axis in range(3):
+            if np.random.random() < 0.5:
+                mask = np.flip(mask, axis)
+
+        zoom_factor = radius / bank_radius * np.random.uniform(*self.scale_range)
+        if abs(zoom_factor - 1) > 1e-3:
+            mask = zoom(mask.astype(np.uint8), zoom_factor, order=0) > 0
+        return np.ascontiguousarray(mask)
+
+
+if __name__ == '__main__':
+    import vtk
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output_file', required=True, help="bank file to write (.npy)")
+    parser.add_argument('-n', '--num_lesions', type=int, default=2000)
+    parser.add_argument('--radii', type=float, nargs='+', default=list(DEFAULT_BANK_RADII))
+    parser.add_argument('--polyhedron', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources',
+                                                             'geodesic_polyhedron.vtp'))
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(args.polyhedron)
+    reader.Update()
+
+    generate_lesion_bank(args.output_file, reader.GetOutput(), args.num_lesions, tuple(args.radii), args.seed)
@@ -0,0 +1,121 @@
+"""
+accuracy and latency check of the quantized CPU report generation (LanguageModel.quantize_for_cpu) against the float
+model. The region features of a held-out set are computed once, then decoded greedily by the float and by the int8
+model. The int8 weights are quantized dynamically (the activation ranges are measured on the fly), so no calibration
+data is needed and the held-out set only serves the comparison.
+"""
+from inference.inferenceSdk import AutoRG_Brain
+from utilities.llm_metric import compute_language_model_scores
+from time import time
+import numpy as np
+import argparse
+import copy
+import json
+import os
+import torch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-o',"--out_dir", required=True, default=None, help="folder for saving the comparison")
+parser.add_argument('--llm_folder', required=True, default=None, help="folder of saved llm checkpoint")
+parser.add_argument('--llm_chk', help='llm checkpoint name (if xx.model then --llm_chk xx)', default='AutoRG_Brain_RGv1')
+parser.add_argument('--seg_folder', required=True, default=None, help="folder of saved segmentation checkpoint")
+parser.add_argument('--seg_chk', help='segmentation checkpoint name (if xx.model then --seg_chk xx)', default='AutoRG_Brain_SEG')
+parser.add_argument('-test','--test_file', required=True,default=None, help="json with the held-out images info")
+parser.add_argument('--eval_mode', required=False,default='region_segtool', help="the report inference way")
+parser.add_argument('--num_threads', required=False, type=int, default=None, help="torch threads for CPU decoding")
+parser.add_argument('--max_length', required=False, type=int, default=300)
+parser.add_argument('--batch_size', required=False, type=int, default=16, help="regions decoded together")
+
+args = parser.parse_args()
+
+os.makedirs(args.out_dir, exist_ok=True)
+if args.num_threads is not None:
+    torch.set_num_threads(args.num_threads)
+
+config = {
+    'llm_folder':args.llm_folder,
+    'seg_folder':args.seg_folder,
+    'llm_chk':args.llm_chk,
+    'seg_chk':args.seg_chk,
+    'output_dir':args.out_dir,
+    'eval_mode':args.eval_mode,
+    'save_masks':False,
+}
+
+model = AutoRG_Brain(gpu_id=[0], config=config)
+
+input_case_dict = json.load(open(args.test_file,'r'))
+
+# region features of every case, computed once for both models
+case_info = {}
+features = {case_idx: f.cpu() for case_idx, f in model.region_features_stream(input_case_dict, case_info)}
+
+float_model = model.trainer.llm_model
+float_model.eval()
+float_model.to("cpu")
+float_model.device = torch.device("cpu")
+for gpt2_block in float_model.gpt2_blocks:
+    gpt2_block[1].device = float_model.device
+
+quantized_model = copy.deepcopy(float_model).quantize_for_cpu()
+
+
+def decode(llm_model):
+    sents = {}
+    num_tokens = 0
+    start = time()
+    for case_idx, output in llm_model.generate_stream(features.items(), max_length=args.max_length,
+                                                      max_batch_size=args.batch_size):
+        num_tokens += int((output != llm_model.pad_token_id).sum())
+        sents[case_idx] = model.trainer.tokenizer.batch_decode(output, skip_special_tokens=True,
+                                                               clean_up_tokenization_spaces=True)
+    return sents, time() - start, num_tokens
+
+
+float_sents, float_time, float_tokens = decode(float_model)
+quantized_sents, quantized_time, quantized_tokens = decode(quantized_model)
+
+cases = []
+all_float, all_quantized = [], []
+for case_idx in sorted(features):
+    the_image_path, _, _, region_direction_names = case_info[case_idx]
+    all_float.extend(float_sents[case_idx])
+    all_quantized.extend(quantized_sents[case_idx])
+
+    case = {'image': the_image_path,
+            'float_report': model.postprocess_report(float_sents[case_idx], region_direction_names),
+            'quantized_report': model.postprocess_report(quantized_sents[case_idx], region_direction_names),
+            'identical_regions': int(sum(f == q for f, q in zip(float_sents[case_idx], quantized_sents[case_idx]))),
+            'num_regions': len(float_sents[case_idx])}
+
+    # the ground truth report of the case if the held-out set has one
+    r = input_case_dict[case_idx].get('report')
+    if isinstance(r, dict):
+        r = " ".join(r.keys())
+    if isinstance(r, str) and case['float_report'] is not None:
+        for k in ('float', 'quantized'):
+            rouges, bleus = compute_language_model_scores([case[k + '_report']], [r])
+            case[k + '_bleu'], case[k + '_rouge'] = float(np.mean(bleus)), float(np.mean(rouges))
+    cases.append(case)
+
+# the float sentences are the reference of the quantized ones
+rouges, bleus = compute_language_model_scores(all_quantized, all_float) if len(all_float) else ([0], [0])
+summary = {
+    'num_cases': len(cases),
+    'num_regions': len(all_float),
+    'identical_region_fraction': float(np.mean([f == q for f, q in zip(all_float, all_quantized)])) if len(all_float) else 0,
+    'bleu_vs_float': float(np.mean(bleus)),
+    'rouge_vs_float': float(np.mean(rouges)),
+    'float_ms_per_token': 1000 * float_time / max(float_tokens, 1),
+    'quantized_ms_per_token': 1000 * quantized_time / max(quantized_tokens, 1),
+}
+for k in ('float', 'quantized'):
+    scores = [c[k + '_bleu'] for c in cases if k + '_bleu' in c]
+    if len(scores):
+        summary[k + '_bleu_vs_ground_truth'] = float(np.mean(scores))
+        summary[k + '_rouge_vs_ground_truth'] = float(np.mean([c[k + '_rouge'] for c in cases if k + '_rouge' in c]))
+
+print(json.dumps(summary, indent=4))
+
+with open(os.path.join(args.out_dir,'quantization_check.json'), 'w') as f:
+    json.dump({'summary': summary, 'cases': cases}, f, indent=4)
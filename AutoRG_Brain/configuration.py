@@ -2,4 +2,21 @@ import os
 
 default_num_threads = 8 if 'nnUNet_def_n_proc' not in os.environ else int(os.environ['nnUNet_def_n_proc'])
 RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD = 3  # determines what threshold to use for resampling the low resolution axis
-# separately (with NN)
\ No newline at end of file
+# separately (with NN)
+
+# number of sliding window tiles that are run through the network as one batch during 3d inference. Values < 1 mean
+# that the batch size is derived from the free GPU memory (see SegmentationNetwork._get_tile_batch_size)
+default_tile_batch_size = 0 if 'nnUNet_tile_batch_size' not in os.environ else int(os.environ['nnUNet_tile_batch_size'])
+# rough estimate of the GPU memory (in bytes) one input voxel of a tile occupies during a forward pass (activations of
+# all resolution stages plus the softmax outputs of both heads). Only used to derive the tile batch size
+TILE_VRAM_BYTES_PER_VOXEL = 2048
+
+# GPT-2 checkpoint (a local folder or a huggingface model name) of the report language model and its tokenizer
+default_gpt2_checkpoint = "/home/jason/models/healx-gpt-2-pubmed-medium" if 'nnUNet_gpt2_checkpoint' not in os.environ \
+    else os.environ['nnUNet_gpt2_checkpoint']
+
+# attention of the report language model (GPT2PseudoAttention): "eager" computes it with explicit matmuls and softmax,
+# "sdpa" with torch.nn.functional.scaled_dot_product_attention (torch >= 2.0), which does not materialize the attention
+# weights with the fused kernels
+default_attn_implementation = "eager" if 'nnUNet_attn_implementation' not in os.environ \
+    else os.environ['nnUNet_attn_implementation']
@@ -13,9 +13,13 @@ import SimpleITK as sitk
 # from .batchgenerator import *
 
 from .batchgenerator import *
+from .utils import get_bbox_slices, gaussian_support
 
 from augmentation.vtk_itk import pd_to_itk_image
 from augmentation.prelin_sphere import *
+from augmentation.lesion_bank import sample_lesion_radius
+
+from functools import lru_cache
 
 import vtk
 import torchio as tio
@@ -35,7 +39,8 @@ import json
 #     return data
 
 
-ployhedron_path = 'AutoRG_Brain/augmentation/resources/geodesic_polyhedron.vtp'
+ployhedron_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'augmentation', 'resources',
+                               'geodesic_polyhedron.vtp')
 reader = vtk.vtkXMLPolyDataReader()
 reader.SetFileName(ployhedron_path)
 reader.Update()
@@ -146,7 +151,18 @@ trans =tio.Compose((
 #             reshaped[reshaped_multihot >= 0.5] = c
 #         return reshaped
 
-def tumor_array_generate(img_array, itk_img, input_poly_data, name):
+@lru_cache(maxsize=32)
+def read_reference(ref_path):
+    """
+    the reference images are shared by all cases, so they are read once per worker. Do not modify the results
+    """
+    ref_img = sitk.ReadImage(ref_path)
+    ref_img.SetOrigin((0.0, 0.0, 0.0))
+    ref_array = sitk.GetArrayFromImage(ref_img)
+    ref_array.setflags(write=False)
+    return ref_img, ref_array
+
+def tumor_array_generate(img_array, itk_img, input_poly_data, name, lesion_bank=None):
     brain_start_x,brain_end_x,brain_start_y,brain_end_y,brain_start_z,brain_end_z = crop(img_array)
     ratio_x = np.random.uniform(0.3,0.8)
     ratio_y = np.random.uniform(0.2,0.7)
@@ -164,29 +180,32 @@ def tumor_array_generate(img_array, itk_img, input_poly_data, name):
 
     center = [128,128,128]
 
-    k = 4/3 * np.pi
-    volume = np.random.randint(7000, 200000)
-    radius = (volume / k) ** (1/3)
-    ratio = np.random.uniform(0.8, 1)
-    a = radius
-    b = radius / ratio
-    c = radius * ratio
+    radius = sample_lesion_radius()
 
-    radii = c,b,a
-    angles = np.random.uniform(0, 180, size=3)
+    if lesion_bank is not None:
+        # pre-rendered shape with random flips, rotations and scaling
+        output_poly_array = lesion_bank.sample(radius)
+    else:
+        ratio = np.random.uniform(0.8, 1)
+        a = radius
+        b = radius / ratio
+        c = radius * ratio
 
-    octaves = np.random.randint(4, 8)
-    offset = np.random.randint(1000)
-    scale = 0.5
+        radii = c,b,a
+        angles = np.random.uniform(0, 180, size=3)
 
-    output_poly_data = get_resection_poly_data(input_poly_data,offset,[64,64,64],radii,angles,octaves,scale)
+        octaves = np.random.randint(4, 8)
+        offset = np.random.randint(1000)
+        scale = 0.5
 
-    output_poly_stk, ndseg = pd_to_itk_image(output_poly_data,itk_img)
+        output_poly_data = get_resection_poly_data(input_poly_data,offset,[64,64,64],radii,angles,octaves,scale)
 
-    ### for test ###      
+        output_poly_stk, ndseg = pd_to_itk_image(output_poly_data,itk_img)
 
-    output_poly_array = sitk.GetArrayFromImage(output_poly_stk)
-    output_poly_array[output_poly_array>0]=1
+        ### for test ###      
+
+        output_poly_array = sitk.GetArrayFromImage(output_poly_stk)
+        output_poly_array[output_poly_array>0]=1
     
     mask = np.zeros(img_array.shape)
     x_start, x_end = np.where(np.any(output_poly_array!=0, axis=(1, 2)))[0][[0, -1]]
@@ -316,7 +335,10 @@ def mix_array(normal,tumor,mask):
 
     # temp = mask.astype(np.uint8)
     sigma = np.random.uniform(1,2)
-    mix_mask = gaussian_filter(mask*1.0, sigma)
+
+    # blend in a crop around the lesion that is large enough for the blurred mask, tumor is 0 outside of the mask
+    bbox = get_bbox_slices(mask, gaussian_support(sigma))
+    mix_mask = gaussian_filter(mask[bbox]*1.0, sigma)
 
     values = mix_mask[mix_mask > 0]
     max_v = np.percentile(values,99)
@@ -324,25 +346,26 @@ def mix_array(normal,tumor,mask):
         r = 0.6/max_v
         mix_mask = mix_mask * r
         # print("95 v",max_v,"r",r,"max",np.max(geo_blur),"min",np.min(geo_blur))
-    temp = mix_mask >= 0.25
+    temp = np.zeros(mask.shape, dtype=bool)
+    temp[bbox] = mix_mask >= 0.25
     
-    mix_array = normal * (1 - mix_mask) + tumor * mix_mask
+    mix_crop = normal[bbox] * (1 - mix_mask) + tumor[bbox] * mix_mask
+    mix_array = normal.astype(mix_crop.dtype)
+    mix_array[bbox] = mix_crop
 
     #tumor[mask!=0] = mix_array[mask!=0]
     #return mix_array, tumor
     return mix_array, temp
 
-def GetSingleLesion(brain_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties, refpaths, name):
+def GetSingleLesion(brain_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties, refpaths, name, lesion_bank=None):
 
     # 1）初始化异常区域形状（用椭圆或者解剖区域形状均可），进行适当的放大缩小等变形；GetSingleLesion
     # abnormal_mask.shape is a whatevershape
     ref_path = refpaths[random.choice(list(refpaths.keys()))][modality]
-    ref_img = sitk.ReadImage(ref_path)
-    ref_img.SetOrigin((0.0, 0.0, 0.0))
-    ref_array = sitk.GetArrayFromImage(ref_img)
+    ref_img, ref_array = read_reference(ref_path)
 
     # get the abnormal mask shape = ref_array.shape
-    abnormal_mask = tumor_array_generate(ref_array,ref_img,input_poly_data, name)
+    abnormal_mask = tumor_array_generate(ref_array,ref_img,input_poly_data, name, lesion_bank)
 
     # tumor_gen tumor_mask with a tumor texture shapfind_positione = ref_array.shape
     abnormal_gen = get_texture(brain_scan, ref_array, abnormal_mask)
@@ -396,7 +419,7 @@ def seperate(anatomy_scan):
 
     return edge, center, skull_gap, whole_brain==1
 
-def SynthesisTumor(brain_scan, anatomy_scan, modality, properties, ref_paths, name):
+def SynthesisTumor(brain_scan, anatomy_scan, modality, properties, ref_paths, name, lesion_bank=None):
     
     abnormal_mask = np.zeros(anatomy_scan.shape)
     num_lesions = random.randint(1,4)
@@ -409,7 +432,7 @@ def SynthesisTumor(brain_scan, anatomy_scan, modality, properties, ref_paths, na
     num_lesions = 1
 
     for cnt in range(num_lesions):
-        brain_scan, abnormal_mask_anatomy, center_coords = GetSingleLesion(brain_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties, ref_paths, name)
+        brain_scan, abnormal_mask_anatomy, center_coords = GetSingleLesion(brain_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties, ref_paths, name, lesion_bank)
         abnormal_mask = np.logical_or(abnormal_mask, abnormal_mask_anatomy)
         xyzs.append(center_coords)
 
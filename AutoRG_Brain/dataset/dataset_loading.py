@@ -24,7 +24,8 @@ from paths import preprocessing_output_dir
 from batchgenerators.utilities.file_and_folder_operations import *
 
 from .utils import SynthesisTumor as SynthesisTumor_intense
-# from .copypaste import SynthesisTumor as SynthesisTumor_copypaste
+from .utils import get_partition, get_case_intensity
+from augmentation.lesion_bank import LesionBank
 import SimpleITK as sitk
 
 import random
@@ -76,6 +77,42 @@ def _load_case_array(data_file, memmap_mode="r"):
     return np.load(data_file)['data']
 
 
+def get_synthesis_cache_files(data_file):
+    return data_file[:-4] + "_partition.npy", data_file[:-4] + "_intensity.pkl"
+
+
+def convert_to_synthesis_cache(data_file):
+    """
+    precomputes the case dependent parts of SynthesisTumor (anatomy partition and intensity ranges) and stores them
+    next to the npy file, see load_synthesis_cache
+    """
+    partition_file, intensity_file = get_synthesis_cache_files(data_file)
+    if isfile(partition_file) and isfile(intensity_file):
+        return
+    case_all_data = _load_case_array(data_file, "r")
+    anatomy_scan = np.array(case_all_data[1])
+    anatomy_scan[anatomy_scan < 0] = 0
+
+    tmp_npy = partition_file + ".tmp"
+    with open(tmp_npy, "wb") as f:
+        np.save(f, get_partition(anatomy_scan))
+    os.replace(tmp_npy, partition_file)
+
+    tmp_pkl = intensity_file + ".tmp"
+    save_pickle(get_case_intensity(np.array(case_all_data[0]), anatomy_scan), tmp_pkl)
+    os.replace(tmp_pkl, intensity_file)
+
+
+def load_synthesis_cache(data_file, memmap_mode="r"):
+    """
+    :return: partition (memmap) and case intensity written by convert_to_synthesis_cache, None if not there
+    """
+    partition_file, intensity_file = get_synthesis_cache_files(data_file)
+    if not (isfile(partition_file) and isfile(intensity_file)):
+        return None, None
+    return np.load(partition_file, memmap_mode), load_pickle(intensity_file)
+
+
 def save_as_npz(args):
     if not isinstance(args, tuple):
         key = "data"
@@ -86,24 +123,27 @@ def save_as_npz(args):
     np.savez_compressed(npy_file[:-3] + "npz", **{key: d})
 
 
-def unpack_dataset(folder, threads=default_num_threads, key="data"):
+def unpack_dataset(folder, threads=default_num_threads, key="data", synthesis_cache=False):
     """
     unpacks all npz files in a folder to npy (whatever you want to have unpacked must be saved unter key)
     :param folder:
     :param threads:
     :param key:
+    :param synthesis_cache: also precompute the per case SynthesisTumor cache (convert_to_synthesis_cache)
     :return:
     """
     p = Pool(threads)
     npz_files = subfiles(folder, True, None, ".npz", True)
     p.map(convert_to_npy, zip(npz_files, [key] * len(npz_files)))
+    if synthesis_cache:
+        p.map(convert_to_synthesis_cache, npz_files)
     p.close()
     p.join()
 
 
 def pack_dataset(folder, threads=default_num_threads, key="data"):
     p = Pool(threads)
-    npy_files = subfiles(folder, True, None, ".npy", True)
+    npy_files = [i for i in subfiles(folder, True, None, ".npy", True) if not i.endswith("_partition.npy")]
     p.map(save_as_npz, zip(npy_files, [key] * len(npy_files)))
     p.close()
     p.join()
@@ -186,7 +226,7 @@ def crop_2D_image_force_fg(img, crop_size, valid_voxels):
 class DataLoader3D(SlimDataLoaderBase):
     def __init__(self, data, patch_size, final_patch_size, batch_size, abnormal_type="intense", has_prev_stage=False,
                  oversample_foreground_percent=0.0, memmap_mode="r", pad_mode="edge", pad_kwargs_data=None,
-                 pad_sides=None):
+                 pad_sides=None, lesion_bank_file=None, reference_file=None):
         """
         This is the basic data loader for 3D networks. It uses preprocessed data as produced by my (Fabian) preprocessing.
         You can load the data with load_dataset(folder) where folder is the folder where the npz files are located. If there
@@ -209,6 +249,10 @@ class DataLoader3D(SlimDataLoaderBase):
         :param stage: ignore this (Fabian only)
         :param random: Sample keys randomly; CAREFUL! non-random sampling requires batch_size=1, otherwise you will iterate batch_size times over the dataset
         :param oversample_foreground: half the batch will be forced to contain at least some foreground (equal prob for each of the foreground classes)
+        :param lesion_bank_file: bank written by augmentation/lesion_bank.py, used by the copy-paste synthesis instead
+        of meshing a new lesion for every sample
+        :param reference_file: json {name: {modality: image}} of the scans the copy-paste synthesis takes the lesion
+        texture from, required unless abnormal_type is "intense" or "no_abnormal"
         """
         super(DataLoader3D, self).__init__(data, batch_size, None)
         if pad_kwargs_data is None:
@@ -282,6 +326,16 @@ class DataLoader3D(SlimDataLoaderBase):
 
         self.abnormal_type = abnormal_type
         self._warned_no_fg_cases = set()
+        self.lesion_bank = LesionBank(lesion_bank_file) if lesion_bank_file is not None else None
+        self.ref_paths = load_json(reference_file) if reference_file is not None else None
+        self.synthesis_copypaste = None
+        if abnormal_type not in ("intense", "no_abnormal"):
+            if self.ref_paths is None:
+                raise ValueError("abnormal_type %s uses the copy-paste synthesis, which needs a reference_file (use "
+                                 "abnormal_type intense to train without reference scans)" % abnormal_type)
+            # vtk, torchio and noise are only needed for the copy-paste synthesis
+            from .copypaste import SynthesisTumor as SynthesisTumor_copypaste
+            self.synthesis_copypaste = SynthesisTumor_copypaste
 
     def get_do_oversample(self, batch_idx):
         return not batch_idx < round(self.batch_size * (1 - self.oversample_foreground_percent))
@@ -352,6 +406,9 @@ class DataLoader3D(SlimDataLoaderBase):
             flag = 0
 
             if self.abnormal_type != "no_abnormal":
+
+                # case dependent parts of the lesion synthesis, precomputed during unpacking (None if not there)
+                partition, case_intensity = load_synthesis_cache(self._data[i]['data_file'], self.memmap_mode)
                 
                 ### gen abnormal ###
                 cnt = 0
@@ -362,9 +419,9 @@ class DataLoader3D(SlimDataLoaderBase):
                             warnings.filterwarnings("ignore", message="Mean of empty slice.*", category=RuntimeWarning)
                             warnings.filterwarnings("ignore", message="invalid value encountered in divide.*", category=RuntimeWarning)
                             if self.abnormal_type == "intense" or (self.abnormal_type == "mix" and np.random.rand()<0.5):
-                                abnormal_image, seg_from_previous_stage, xyzs = SynthesisTumor_intense(case_all_data[0], anatomy_scan, modal, properties)
+                                abnormal_image, seg_from_previous_stage, xyzs = SynthesisTumor_intense(case_all_data[0], anatomy_scan, modal, properties, partition, case_intensity)
                             else:
-                                abnormal_image, seg_from_previous_stage, xyzs = SynthesisTumor_copypaste(case_all_data[0], anatomy_scan, modal, properties, self.ref_paths, name)
+                                abnormal_image, seg_from_previous_stage, xyzs = self.synthesis_copypaste(case_all_data[0], anatomy_scan, modal, properties, self.ref_paths, name, self.lesion_bank)
                         selected_voxel = random.choice(xyzs)
                         case_all_data[0] = abnormal_image
                         flag = 1
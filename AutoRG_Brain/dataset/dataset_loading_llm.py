@@ -23,6 +23,7 @@ from paths import preprocessing_output_dir
 from batchgenerators.utilities.file_and_folder_operations import *
 
 from .utils import SynthesisTumor as SynthesisTumor_intense
+from .dataset_loading import convert_to_synthesis_cache
 # from .copypaste import SynthesisTumor as SynthesisTumor_copypaste
 import SimpleITK as sitk
 
@@ -67,12 +68,13 @@ def save_as_npz(args):
     np.savez_compressed(npy_file[:-3] + "npz", **{key: d})
 
 
-def unpack_dataset(folder, threads=default_num_threads, key="data",train_file = None):
+def unpack_dataset(folder, threads=default_num_threads, key="data",train_file = None, synthesis_cache=False):
     """
     unpacks all npz files in a folder to npy (whatever you want to have unpacked must be saved unter key)
     :param folder:
     :param threads:
     :param key:
+    :param synthesis_cache: also precompute the per case SynthesisTumor cache (dataset_loading.convert_to_synthesis_cache)
     :return:
     """
     p = Pool(threads)
@@ -100,13 +102,15 @@ def unpack_dataset(folder, threads=default_num_threads, key="data",train_file =
             print(f"[unpack_dataset] skip {missing} missing preprocessed npz files")
     
     p.map(convert_to_npy, zip(npz_files, [key] * len(npz_files)))
+    if synthesis_cache:
+        p.map(convert_to_synthesis_cache, npz_files)
     p.close()
     p.join()
 
 
 def pack_dataset(folder, threads=default_num_threads, key="data"):
     p = Pool(threads)
-    npy_files = subfiles(folder, True, None, ".npy", True)
+    npy_files = [i for i in subfiles(folder, True, None, ".npy", True) if not i.endswith("_partition.npy")]
     p.map(save_as_npz, zip(npy_files, [key] * len(npy_files)))
     p.close()
     p.join()
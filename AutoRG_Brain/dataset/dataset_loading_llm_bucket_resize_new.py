@@ -33,6 +33,7 @@ from io import BytesIO
 import os
 
 from .utils import nnUNet_resize
+from .row_cache import create_row_cache, finalize_row_cache, load_row_cache_index, read_rows
 
 def get_case_identifiers(folder):
     case_identifiers = [i[:-4] for i in os.listdir(folder) if i.endswith("npz") and (i.find("segFromPrevStage") == -1)]
@@ -64,6 +65,98 @@ def load_from_bucket(aws_path, client=None):
     img_array = np.load(iostr)
     return img_array
 
+def load_case_bucket(data_file, client=None):
+    # a missing object is returned as None, so there is no need for a contains() request before every GET
+    data = client.get(data_file[:-4] + ".npy")
+    if data is not None:
+        return np.load(BytesIO(memoryview(data)))
+    return load_from_bucket(data_file, client=client)['data']
+
+
+def resize_case(case_all_data, final_patch_size):
+    """
+    resizes a whole case (image, anatomy, abnormal) to final_patch_size
+    :return: data (1, *final_patch_size) and seg (2, *final_patch_size)
+    """
+    data = np.expand_dims(nnUNet_resize(case_all_data[0,:],final_patch_size,axis=0),axis=0)
+    seg = np.stack((nnUNet_resize(case_all_data[1,:],final_patch_size,is_seg=True,axis=0),
+                    nnUNet_resize(case_all_data[2,:],final_patch_size,is_seg=True,axis=0)))
+    return data, seg
+
+
+def get_resized_cache_files(folder, modal=None):
+    """
+    :return: the index file of the cache in folder, or the data and seg files of modal
+    """
+    if modal is None:
+        return join(folder, "index.pkl")
+    return join(folder, "%s_data.npy" % modal), join(folder, "%s_seg.npy" % modal)
+
+
+def load_resized_cache_index(folder, final_patch_size=None):
+    index = load_row_cache_index(get_resized_cache_files(folder))
+    if index is None:
+        return None
+    if final_patch_size is not None and tuple(index['patch_size']) != tuple(final_patch_size):
+        return None
+    return index
+
+
+def _convert_case_to_resized_cache(args):
+    data_file, data_npy, seg_npy, row, final_patch_size, client = args
+    data, seg = resize_case(load_case_bucket(data_file, client=client), final_patch_size)
+    cache_data = np.load(data_npy, "r+")
+    cache_data[row] = data
+    cache_data.flush()
+    cache_seg = np.load(seg_npy, "r+")
+    cache_seg[row] = seg
+    cache_seg.flush()
+
+
+def convert_to_resized_cache(folder, dataset, keys_modal, final_patch_size, threads=default_num_threads, client=None):
+    """
+    resizes every case to final_patch_size once and stores them in one array per modal (data float32, seg int8) plus
+    an index (modal -> key -> row). DataLoader3D_bucket then builds its batches from these without resampling. An
+    existing cache for the same patch size and keys is kept
+    :param keys_modal: dict modal -> list of keys
+    """
+    index = load_resized_cache_index(folder, final_patch_size)
+    if index is not None and all(k in index['rows'].get(m, {}) for m, keys in keys_modal.items() for k in keys):
+        return
+
+    index_file = get_resized_cache_files(folder)
+    arrays = OrderedDict()
+    for modal, keys in keys_modal.items():
+        if len(keys) == 0:
+            continue
+        data_npy, seg_npy = get_resized_cache_files(folder, modal)
+        arrays[data_npy] = (np.float32, (len(keys), 1, *final_patch_size))
+        arrays[seg_npy] = (np.int8, (len(keys), 2, *final_patch_size))
+    memmaps = create_row_cache(index_file, arrays)
+    for memmap in memmaps.values():
+        # the workers write the rows through their own memmaps
+        memmap.flush()
+
+    rows = {}
+    jobs = []
+    for modal, keys in keys_modal.items():
+        if len(keys) == 0:
+            continue
+        data_npy, seg_npy = get_resized_cache_files(folder, modal)
+        rows[modal] = OrderedDict()
+        for row, k in enumerate(keys):
+            rows[modal][k] = row
+            jobs.append((dataset[k]['data_file'], data_npy + ".tmp", seg_npy + ".tmp", row, tuple(final_patch_size),
+                         client))
+
+    p = Pool(threads)
+    p.map(_convert_case_to_resized_cache, jobs)
+    p.close()
+    p.join()
+
+    finalize_row_cache(index_file, memmaps, {'patch_size': tuple(final_patch_size), 'rows': rows})
+
+
 def convert_to_npy_bucket(args):
 
     npz_file, npz_file_bucket, key, client = args
@@ -195,7 +288,7 @@ def crop_2D_image_force_fg(img, crop_size, valid_voxels):
 class DataLoader3D_bucket(SlimDataLoaderBase):
     def __init__(self, data, patch_size, final_patch_size, batch_size, report=None, has_prev_stage=False,
                  oversample_foreground_percent=0.0, memmap_mode="r", pad_mode="edge", pad_kwargs_data=None,
-                 pad_sides=None,client=None,dataset="six"):
+                 pad_sides=None,client=None,dataset="six",resized_cache_folder=None):
         """
         This is the basic data loader for 3D networks. It uses preprocessed data as produced by my (Fabian) preprocessing.
         You can load the data with load_dataset(folder) where folder is the folder where the npz files are located. If there
@@ -218,6 +311,8 @@ class DataLoader3D_bucket(SlimDataLoaderBase):
         :param stage: ignore this (Fabian only)
         :param random: Sample keys randomly; CAREFUL! non-random sampling requires batch_size=1, otherwise you will iterate batch_size times over the dataset
         :param oversample_foreground: half the batch will be forced to contain at least some foreground (equal prob for each of the foreground classes)
+        :param resized_cache_folder: cases resized to final_patch_size by convert_to_resized_cache. Used once its index
+        exists, before that (and for keys that are not in it) the cases are loaded from the bucket and resized
         """
         super(DataLoader3D_bucket, self).__init__(data, batch_size, None)
         if pad_kwargs_data is None:
@@ -261,10 +356,47 @@ class DataLoader3D_bucket(SlimDataLoaderBase):
 
         print("222 slef.batch_size",self.batch_size)
 
+        self.resized_cache_folder = resized_cache_folder
+        self._resized_cache_index = None
+        self._resized_cache = {}
+
         self.data_shape, self.seg_shape = self.determine_shapes()
 
         self.report = report
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_resized_cache'] = {}
+        return state
+
+    def get_resized_cache(self, modal):
+        """
+        :return: rows (key -> row), data and seg memmaps of modal, None if there is no cache (yet)
+        """
+        if self.resized_cache_folder is None:
+            return None
+        if self._resized_cache_index is None:
+            self._resized_cache_index = load_resized_cache_index(self.resized_cache_folder, self.final_patch_size)
+            if self._resized_cache_index is None:
+                return None
+        rows = self._resized_cache_index['rows'].get(modal)
+        if rows is None:
+            return None
+        if modal not in self._resized_cache:
+            data_npy, seg_npy = get_resized_cache_files(self.resized_cache_folder, modal)
+            self._resized_cache[modal] = (np.load(data_npy, self.memmap_mode), np.load(seg_npy, self.memmap_mode))
+        return (rows,) + self._resized_cache[modal]
+
+    def get_resized_case(self, key, modal):
+        """
+        :return: data (1, *final_patch_size) and seg (2, *final_patch_size) of one case
+        """
+        cache = self.get_resized_cache(modal)
+        if cache is not None and key in cache[0]:
+            rows, cache_data, cache_seg = cache
+            return np.array(cache_data[rows[key]]), cache_seg[rows[key]].astype(np.float32)
+        return resize_case(load_case_bucket(self._data[key]['data_file'], client=self.client), self.final_patch_size)
+
     def get_do_oversample(self, batch_idx):
         return not batch_idx < round(self.batch_size * (1 - self.oversample_foreground_percent))
 
@@ -277,10 +409,7 @@ class DataLoader3D_bucket(SlimDataLoaderBase):
 
         k = list(self._data.keys())[0]
 
-        if self.client.contains(self._data[k]['data_file'][:-4] + ".npy"):
-            case_all_data = load_from_bucket(self._data[k]['data_file'][:-4] + ".npy", client=self.client)
-        else:
-            case_all_data = load_from_bucket(self._data[k]['data_file'],client=self.client)['data']
+        case_all_data = load_case_bucket(self._data[k]['data_file'], client=self.client)
         
         num_color_channels = case_all_data.shape[0] - 1
         data_shape = (self.batch_size, 1, *self.patch_size)
@@ -315,6 +444,15 @@ class DataLoader3D_bucket(SlimDataLoaderBase):
 
         modal = choose_modal
 
+        cache = self.get_resized_cache(modal)
+        if cache is not None and all(i in cache[0] for i in selected_keys):
+            # the cases are already resized, no resampling needed
+            rows, cache_data, cache_seg = cache
+            selected_keys, data, seg = read_rows(selected_keys, rows, (cache_data, cache_seg)) # b, c / b, 2, patch_size
+            seg = seg.astype(np.float32)
+            reports = [self.report[i] for i in selected_keys]
+            return {'data': data, 'seg': seg, 'modal':modal, "report":reports}
+
         data = np.zeros(self.data_shape, dtype=np.float32) # b, c, patch_size
         seg = np.zeros(self.seg_shape, dtype=np.float32) # b, 1, patch_size
         case_properties = []
@@ -335,19 +473,12 @@ class DataLoader3D_bucket(SlimDataLoaderBase):
             # cases are stored as npz, but we require unpack_dataset to be run. This will decompress them into npy
             # which is much faster to access
             
-            if self.client.contains(self._data[i]['data_file'][:-4] + ".npy"):
-                case_all_data_origin = load_from_bucket(self._data[i]['data_file'][:-4] + ".npy", client=self.client)
-            else:
-                case_all_data_origin = load_from_bucket(self._data[i]['data_file'], client=self.client)['data']
-            
             # data: case_all_data[0].shape = (original_x, original_y, original_z)
             # seg: case_all_data[1].shape = (original_x, original_y, original_z)
 
-            case_all_data = case_all_data_origin.copy()
+            case_all_data = load_case_bucket(self._data[i]['data_file'], client=self.client)
 
-            data[j] = np.expand_dims(nnUNet_resize(case_all_data[0,:],self.final_patch_size,axis=0),axis=0)
-            seg[j,0] = np.expand_dims(nnUNet_resize(case_all_data[1,:],self.final_patch_size,is_seg=True,axis=0),axis=0)
-            seg[j,1] = np.expand_dims(nnUNet_resize(case_all_data[2,:],self.final_patch_size,is_seg=True,axis=0),axis=0)
+            data[j], seg[j] = resize_case(case_all_data, self.final_patch_size)
 
         return {'data': data, 'seg': seg, 'modal':modal, "report":reports}
 
@@ -0,0 +1,86 @@
+"""
+Cache of frozen backbone features for report training. Without train_with_seg the segmentation network is frozen up
+to pool_conv, and with no_aug every case is simply resized to the patch size, so the output of Generic_UNet.encode
+only depends on the case. It is computed once (see nnUNetTrainerV2_llm_resize_new.extract_frozen_features) and stored
+as one float16 array of features and one uint8 array of downsampled targets, one row per case.
+"""
+from collections import OrderedDict
+
+import numpy as np
+from batchgenerators.dataloading.data_loader import SlimDataLoaderBase
+from batchgenerators.utilities.file_and_folder_operations import *
+
+from .row_cache import create_row_cache, finalize_row_cache, load_row_cache_index, read_rows
+
+
+def get_feature_cache_files(folder):
+    return join(folder, "features.npy"), join(folder, "targets.npy"), join(folder, "index.pkl")
+
+
+def create_feature_cache(folder, num_cases, feature_shape, target_shape):
+    """
+    :return: writable memmaps for the features and targets, finish with finalize_feature_cache
+    """
+    features_file, targets_file, index_file = get_feature_cache_files(folder)
+    memmaps = create_row_cache(index_file, {features_file: (np.float16, (num_cases, *feature_shape)),
+                                            targets_file: (np.uint8, (num_cases, *target_shape))})
+    return memmaps[features_file], memmaps[targets_file]
+
+
+def finalize_feature_cache(folder, features, targets, index):
+    """
+    :param index: dict with 'rows' (key -> row), 'modal' (key -> modal) and whatever identifies the backbone
+    """
+    features_file, targets_file, index_file = get_feature_cache_files(folder)
+    finalize_row_cache(index_file, {features_file: features, targets_file: targets}, index)
+
+
+def load_feature_cache_index(folder):
+    return load_row_cache_index(get_feature_cache_files(folder)[2])
+
+
+class DataLoaderFeatures(SlimDataLoaderBase):
+    def __init__(self, data, folder, batch_size, report=None, memmap_mode="r"):
+        """
+        batches of cached features in the layout of DataLoader3D_bucket: a modal is chosen uniformly, then batch_size
+        cases of that modal. 'data' are the features (b, d, z, x, y) and 'seg' the downsampled targets (b, 2, z, x, y)
+        :param data: dataset of this split, only its keys are used
+        :param folder: feature cache written by create_feature_cache/finalize_feature_cache
+        """
+        super(DataLoaderFeatures, self).__init__(data, batch_size, None)
+        self.folder = folder
+        self.report = report
+        self.memmap_mode = memmap_mode
+        index = load_feature_cache_index(folder)
+        self.rows = index['rows']
+
+        self.list_of_keys_modal = OrderedDict()
+        for k in self._data.keys():
+            if k in self.rows:
+                self.list_of_keys_modal.setdefault(index['modal'][k], []).append(k)
+        self._features = None
+        self._targets = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_features'] = None
+        state['_targets'] = None
+        return state
+
+    def _open(self):
+        if self._features is None:
+            features_file, targets_file, _ = get_feature_cache_files(self.folder)
+            self._features = np.load(features_file, self.memmap_mode)
+            self._targets = np.load(targets_file, self.memmap_mode)
+
+    def generate_train_batch(self):
+        self._open()
+        modals = list(self.list_of_keys_modal.keys())
+        modal = modals[np.random.choice(len(modals))]
+        selected_keys = np.random.choice(self.list_of_keys_modal[modal], self.batch_size, False, None)
+
+        selected_keys, data, seg = read_rows(selected_keys, self.rows, (self._features, self._targets))
+        seg = seg.astype(np.float32)
+        reports = [self.report[k] for k in selected_keys]
+
+        return {'data': data, 'seg': seg, 'modal': modal, "report": reports, "keys": selected_keys}
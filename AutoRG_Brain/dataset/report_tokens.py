@@ -0,0 +1,127 @@
+"""
+Region report phrases tokenized once for report training. The token ids of all phrases are stored as one ragged int32
+array (tokens + offsets) and batches are padded by collate, which gives the same input_ids and attention_mask as
+running the GPT-2 tokenizer with padding="longest" on every batch.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import *
+
+# bump when the layout or the tokenization below changes
+REPORT_TOKENS_VERSION = 1
+
+BOS_TOKEN = "<|endoftext|>"  # note: in the GPT2 tokenizer, bos_token = eos_token = "<|endoftext|>"
+EOS_TOKEN = "<|endoftext|>"
+
+
+def get_report_phrases(region_report):
+    """
+    :param region_report: train_file['region_report'], {split: {case: {phrase: region}}}
+    :return: the unique phrases in a fixed order
+    """
+    phrases = set()
+    for split in region_report.values():
+        for case_report in split.values():
+            phrases.update(case_report.keys())
+    return sorted(phrases)
+
+
+def tokenizer_fingerprint(tokenizer):
+    md5 = hashlib.md5()
+    md5.update(type(tokenizer).__name__.encode('utf-8'))
+    for file_name in sorted(tokenizer.vocab_files_names.values()):
+        path = join(str(tokenizer.name_or_path), file_name)
+        if isfile(path):
+            with open(path, 'rb') as f:
+                md5.update(f.read())
+        else:
+            md5.update(file_name.encode('utf-8'))
+    return md5.hexdigest()
+
+
+class ReportTokens(object):
+    def __init__(self, phrases, tokens, offsets, pad_token_id, tokenizer=None, max_length=1024):
+        """
+        :param phrases: list of phrases, phrase i has the tokens tokens[offsets[i]:offsets[i + 1]]
+        :param tokenizer: used for phrases that are not in the cache
+        """
+        self.index = {p: i for i, p in enumerate(phrases)}
+        self.tokens = tokens
+        self.offsets = offsets
+        self.pad_token_id = pad_token_id
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    @staticmethod
+    def tokenize(tokenizer, phrases, max_length=1024):
+        """
+        :return: tokens (int32) and offsets (int64) of phrases
+        """
+        if len(phrases) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64)
+        phrases_with_special_tokens = [BOS_TOKEN + phrase + EOS_TOKEN for phrase in phrases]
+        input_ids = tokenizer(phrases_with_special_tokens, truncation=True, max_length=max_length)["input_ids"]
+        offsets = np.zeros(len(input_ids) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(i) for i in input_ids])
+        tokens = np.fromiter((t for i in input_ids for t in i), dtype=np.int32, count=int(offsets[-1]))
+        return tokens, offsets
+
+    @classmethod
+    def build(cls, tokenizer, region_report, cache_folder=None, max_length=1024):
+        """
+        tokenizes all phrases of region_report. With cache_folder the result is stored in a file named after the
+        tokenizer files, the reports and REPORT_TOKENS_VERSION, so it is rebuilt whenever one of them changes
+        """
+        phrases = get_report_phrases(region_report)
+
+        cache_file = None
+        if cache_folder is not None:
+            md5 = hashlib.md5()
+            md5.update(str(REPORT_TOKENS_VERSION).encode('utf-8'))
+            md5.update(str(max_length).encode('utf-8'))
+            md5.update(tokenizer_fingerprint(tokenizer).encode('utf-8'))
+            md5.update(json.dumps(phrases).encode('utf-8'))
+            cache_file = join(cache_folder, "report_tokens_%s.pkl" % md5.hexdigest())
+            if isfile(cache_file):
+                cached = load_pickle(cache_file)
+                return cls(cached['phrases'], cached['tokens'], cached['offsets'], tokenizer.pad_token_id, tokenizer,
+                           max_length)
+
+        tokens, offsets = cls.tokenize(tokenizer, phrases, max_length)
+
+        if cache_file is not None:
+            maybe_mkdir_p(cache_folder)
+            save_pickle({'phrases': phrases, 'tokens': tokens, 'offsets': offsets}, cache_file + ".tmp")
+            os.replace(cache_file + ".tmp", cache_file)
+        return cls(phrases, tokens, offsets, tokenizer.pad_token_id, tokenizer, max_length)
+
+    def _add(self, phrases):
+        tokens, offsets = self.tokenize(self.tokenizer, phrases, self.max_length)
+        n = len(self.offsets) - 1
+        for i, p in enumerate(phrases):
+            self.index[p] = n + i
+        self.offsets = np.concatenate((self.offsets[:-1], offsets + self.offsets[-1]))
+        self.tokens = np.concatenate((self.tokens, tokens))
+
+    def collate(self, phrases):
+        """
+        :return: input_ids and attention_mask (int64 tensors, [len(phrases) x longest phrase]), right padded
+        """
+        missing = list(dict.fromkeys(p for p in phrases if p not in self.index))
+        if len(missing) > 0:
+            self._add(missing)
+
+        idx = np.array([self.index[p] for p in phrases], dtype=np.int64)
+        starts = self.offsets[idx]
+        lengths = self.offsets[idx + 1] - starts
+        positions = np.arange(lengths.max() if len(lengths) else 0)
+
+        attention_mask = positions[None] < lengths[:, None]
+        gather = np.minimum(starts[:, None] + positions[None], len(self.tokens) - 1)
+        input_ids = np.where(attention_mask, self.tokens[gather], self.pad_token_id)
+
+        return torch.from_numpy(input_ids.astype(np.int64)), torch.from_numpy(attention_mask.astype(np.int64))
@@ -0,0 +1,55 @@
+"""
+Arrays with one row per case, stored as .npy files next to an index pickle (key -> row and whatever else identifies
+the content). Used by the feature cache (feature_cache.py) and the resized case cache of DataLoader3D_bucket. The
+arrays are written as memmaps to .tmp files and renamed when complete, the index is written last, so a cache without
+index is incomplete and a crash while writing never leaves a cache that looks valid.
+"""
+import os
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+
+
+def create_row_cache(index_file, arrays):
+    """
+    removes the index of an existing cache and creates the memmaps file + '.tmp' of every array
+    :param arrays: dict file -> (dtype, shape)
+    :return: dict file -> writable memmap, finish with finalize_row_cache
+    """
+    maybe_mkdir_p(os.path.dirname(index_file))
+    if isfile(index_file):
+        os.remove(index_file)
+    return {f: np.lib.format.open_memmap(f + ".tmp", mode='w+', dtype=dtype, shape=shape)
+            for f, (dtype, shape) in arrays.items()}
+
+
+def finalize_row_cache(index_file, memmaps, index):
+    """
+    :param memmaps: dict file -> memmap returned by create_row_cache
+    :param index: saved to index_file once all arrays are in place
+    """
+    for f, memmap in memmaps.items():
+        memmap.flush()
+        os.replace(f + ".tmp", f)
+    # the index is written last, a cache without index is incomplete
+    save_pickle(index, index_file + ".tmp")
+    os.replace(index_file + ".tmp", index_file)
+
+
+def load_row_cache_index(index_file):
+    if not isfile(index_file):
+        return None
+    return load_pickle(index_file)
+
+
+def read_rows(keys, rows, arrays):
+    """
+    reads the rows of keys from every array with one fancy index per array
+    :param rows: dict key -> row
+    :return: keys sorted by row, then the rows of every array in that order
+    """
+    # sorted rows make the memmap reads sequential
+    keys = np.asarray(keys)
+    keys = keys[np.argsort([rows[k] for k in keys])]
+    batch_rows = np.array([rows[k] for k in keys])
+    return (keys,) + tuple(a[batch_rows] for a in arrays)
@@ -312,10 +312,24 @@ def find_position(edge_anatomy, center_anatomy, whole_brain, abnormal_mask, prop
 
     return mask, cx, cy, cz
 
-def get_texture(brain_scan, abnormal_mask, whole_brain, intensity_dic, gap, modality):
+def gaussian_support(sigma, truncate=4.0):
+    # radius of the gaussian_filter kernel + 1. Further away from a mask than this its blurred version is exactly 0
+    return int(truncate * float(sigma) + 0.5) + 1
 
-    abnormally_mask = np.zeros(abnormal_mask.shape)
-    abnormally_full = brain_scan
+def get_bbox_slices(mask, pad=0):
+    """
+    slices of the bounding box of mask != 0, enlarged by pad voxels and clipped to the volume. The whole volume if the
+    mask is empty
+    """
+    slices = []
+    for d in range(mask.ndim):
+        nonzero = np.where(np.any(mask != 0, axis=tuple(j for j in range(mask.ndim) if j != d)))[0]
+        if len(nonzero) == 0:
+            return tuple(slice(None) for _ in range(mask.ndim))
+        slices.append(slice(max(0, nonzero[0] - pad), min(mask.shape[d], nonzero[-1] + 1 + pad)))
+    return tuple(slices)
+
+def get_texture(brain_scan, abnormal_mask, whole_brain, intensity_dic, gap, modality):
 
     layer = np.sort(np.unique(abnormal_mask))
     # ignore background
@@ -330,12 +344,22 @@ def get_texture(brain_scan, abnormal_mask, whole_brain, intensity_dic, gap, moda
     if np.random.rand()<0.5:
         flag = 0 # gradually low
         textures = textures[::-1]
+
+    # everything below happens in a crop around the lesion, padded so that the blurred layers fit (and the
+    # gaussian_filter reflections at the crop border only see zeros). Outside of it nothing changes
+    max_sigma = 2
+    bbox = get_bbox_slices(abnormal_mask, gaussian_support(max_sigma))
+    brain_crop = brain_scan[bbox]
+    abnormal_crop = abnormal_mask[bbox]
+
+    abnormally_mask = np.zeros(abnormal_crop.shape)
+    abnormally_full = brain_crop
     
     for idx,i in enumerate(layer):
 
-        temp = (abnormal_mask==i).astype(np.uint8)
+        temp = (abnormal_crop==i).astype(np.uint8)
 
-        sigma = np.random.uniform(1, 2)
+        sigma = np.random.uniform(1, max_sigma)
         geo_blur = gaussian_filter(temp*1.0, sigma)
 
         values = geo_blur[geo_blur > 0]
@@ -345,7 +369,7 @@ def get_texture(brain_scan, abnormal_mask, whole_brain, intensity_dic, gap, moda
             geo_blur = geo_blur * r
         temp = geo_blur>=0.25
 
-        mean_value = np.mean(brain_scan[abnormal_mask==i])
+        mean_value = np.mean(brain_crop[abnormal_crop==i])
         legal_low = intensity_dic[textures[idx]][0]
         legal_high = intensity_dic[textures[idx]][1] 
         forbidden_low = mean_value - gap
@@ -375,25 +399,44 @@ def get_texture(brain_scan, abnormal_mask, whole_brain, intensity_dic, gap, moda
     #     abnormally_mask[edge_anatomy==0] = 0
     # else:
     #     abnormally_mask[whole_brain==0] = 0
-    abnormally_mask[whole_brain==0] = 0
-    abnormally_full[abnormally_mask == 0] = brain_scan[abnormally_mask==0]
+    abnormally_mask[whole_brain[bbox]==0] = 0
+    abnormally_full[abnormally_mask == 0] = brain_crop[abnormally_mask==0]
 
-    return abnormally_full, abnormally_mask
+    full_mask = np.zeros(abnormal_mask.shape, dtype=abnormally_mask.dtype)
+    full_mask[bbox] = abnormally_mask
+    if len(layer) == 0:
+        return brain_scan, full_mask
+    full_scan = brain_scan.astype(abnormally_full.dtype)
+    full_scan[bbox] = abnormally_full
 
-def GetSingleLesion(brain_scan, anatomy_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties):
+    return full_scan, full_mask
+
+def GetSingleLesion(brain_scan, anatomy_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties, intensity=None):
 
     abnormal_mask = get_shape(anatomy_scan)
 
     abnormal_mask, cx,cy,cz = find_position(edge_anatomy, center_anatomy, whole_brain, abnormal_mask, properties)
 
-    intensity_dic, gap = get_intensity(brain_scan, anatomy_scan, modality)
+    if intensity is None:
+        intensity_dic, gap = get_intensity(brain_scan, anatomy_scan, modality)
+    else:
+        intensity_dic, gap = intensity
 
     brain_scan, abnormal_mask = get_texture(brain_scan, abnormal_mask, whole_brain, intensity_dic, gap, modality)
     
     return brain_scan, abnormal_mask, [cx,cy,cz]
 
-def seperate(anatomy_scan):
+# bit flags of the partition map computed by get_partition
+PARTITION_BRAIN = 1
+PARTITION_SKULL_GAP = 2
+PARTITION_EDGE = 4
+PARTITION_CENTER = 8
 
+def get_partition(anatomy_scan):
+    """
+    the case dependent (expensive) part of seperate: hole filled brain, skull gap, brain edge and eroded brain center
+    packed as bit flags into one uint8 map. Depends only on the anatomy labels, so it can be computed once per case
+    """
     z = anatomy_scan.shape[-1]
 
     whole_brain = anatomy_scan.copy()
@@ -416,16 +459,50 @@ def seperate(anatomy_scan):
     erode_anatomy = cv2.erode(anatomy_scan_temp, kernel, iterations=1)
     anatomy_edge = np.logical_xor(anatomy_scan_temp, erode_anatomy)
 
+    partition = np.zeros(anatomy_scan.shape, dtype=np.uint8)
+    partition[whole_brain == 1] |= PARTITION_BRAIN
+    partition[skull_gap] |= PARTITION_SKULL_GAP
+    partition[anatomy_edge] |= PARTITION_EDGE
+    partition[erode_anatomy > 0] |= PARTITION_CENTER
+    return partition
+
+def partition_to_anatomy(anatomy_scan, partition):
+    """
+    expands a partition map (see get_partition) into the edge, center, skull_gap, whole_brain outputs of seperate
+    """
+    partition = np.asarray(partition)
+    whole_brain = (partition & PARTITION_BRAIN) > 0
+    skull_gap = (partition & PARTITION_SKULL_GAP) > 0
+
     full_anatomy_scan =anatomy_scan.copy()
-    full_anatomy_scan[np.logical_and(anatomy_scan==0, whole_brain==1)] = 100
+    full_anatomy_scan[np.logical_and(anatomy_scan==0, whole_brain)] = 100
     
     edge = full_anatomy_scan.copy()
-    edge[np.logical_not(anatomy_edge)] = 0
+    edge[(partition & PARTITION_EDGE) == 0] = 0
 
-    center = full_anatomy_scan.copy()
-    center[np.logical_not(erode_anatomy)] = 0
+    center = full_anatomy_scan
+    center[(partition & PARTITION_CENTER) == 0] = 0
 
-    return edge, center, skull_gap, whole_brain==1
+    return edge, center, skull_gap, whole_brain
+
+def seperate(anatomy_scan):
+    return partition_to_anatomy(anatomy_scan, get_partition(anatomy_scan))
+
+def intensity_key(modality):
+    # get_intensity only distinguishes these two groups of modalities
+    return "T2WI" if modality in ("T2WI", "ADC") else "T1WI"
+
+def get_case_intensity(brain_scan, anatomy_scan):
+    """
+    get_intensity of the unmodified case for both modality groups (see intensity_key), None where it fails
+    """
+    case_intensity = {}
+    for modality in ("T2WI", "T1WI"):
+        try:
+            case_intensity[modality] = get_intensity(brain_scan, anatomy_scan, modality)
+        except Exception:
+            case_intensity[modality] = None
+    return case_intensity
 
 def _minimal_fallback_lesion(brain_scan, anatomy_scan, modality):
     foreground = anatomy_scan > 0
@@ -492,18 +569,27 @@ def _minimal_fallback_lesion(brain_scan, anatomy_scan, modality):
     out_mask = lesion.astype(np.uint8)
     return out_scan, out_mask, center
 
-def SynthesisTumor(brain_scan, anatomy_scan, modality, properties=None):
+def SynthesisTumor(brain_scan, anatomy_scan, modality, properties=None, partition=None, case_intensity=None):
+    """
+    partition (get_partition) and case_intensity (get_case_intensity) can be precomputed per case, otherwise they are
+    computed here. With case_intensity every lesion uses the intensity ranges of the unmodified case
+    """
     
     abnormal_mask = np.zeros(anatomy_scan.shape)
     num_lesions = random.randint(1,4)
     
-    edge_anatomy, center_anatomy, skull_gap, whole_brain = seperate(anatomy_scan)
+    if partition is None:
+        edge_anatomy, center_anatomy, skull_gap, whole_brain = seperate(anatomy_scan)
+    else:
+        edge_anatomy, center_anatomy, skull_gap, whole_brain = partition_to_anatomy(anatomy_scan, partition)
+
+    intensity = case_intensity.get(intensity_key(modality)) if case_intensity is not None else None
 
     xyzs = []
 
     for cnt in range(num_lesions):
         try:
-            brain_scan, abnormal_mask_anatomy, center_coords = GetSingleLesion(brain_scan, anatomy_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties)
+            brain_scan, abnormal_mask_anatomy, center_coords = GetSingleLesion(brain_scan, anatomy_scan, edge_anatomy, center_anatomy, whole_brain, modality, properties, intensity)
             abnormal_mask = np.logical_or(abnormal_mask, abnormal_mask_anatomy)
             xyzs.append(center_coords)
         except:
@@ -26,6 +26,14 @@ CONFIG_DEFAULT = {
     'mc_key_cb': 'identity',
     'get_retry_max': '10',
     's3_cpp_log_level': 'off',
+    'enable_disk_cache': 'False',
+    'disk_cache_dir': '~/.cache/petrel_client',
+    'disk_cache_max_bytes': str(64 * 1024 * 1024 * 1024),  # 64GB
+    # revalidate every disk cache hit against the length and ETag of a HEAD
+    # request (boto s3 clients only) and check single part ETags against the
+    # md5 of the cached content. Without it, an object overwritten on the
+    # backend is served stale from disk until it is evicted
+    'disk_cache_verify_etag': 'False',
     # 'host_bucket': '%(host_base)s/%(bucket)s',
     # 'user_https': 'False',
     # 'ca_certs_file': '',
@@ -5,6 +5,7 @@ from os.path import expanduser, abspath
 
 from petrel_client.ceph.ceph import Ceph
 from petrel_client.cache.cache import Cache
+from petrel_client.cache.disk import DiskCache
 from petrel_client.dfs.dfs import DFS
 from petrel_client.common.config import Config
 from petrel_client.common.log import init_log
@@ -42,9 +43,15 @@ class MixedClient(object):
         else:
             self._cache = None
 
+        disk_cache_conf = config.get('disk_cache', None) or self._default_config
+        if disk_cache_conf.get_boolean('enable_disk_cache'):
+            self._disk_cache = DiskCache(disk_cache_conf)
+        else:
+            self._disk_cache = None
+
         self._ceph_dict = {
             cluster: Ceph.create(cluster, conf)
-            for cluster, conf in config.items() if cluster.lower() not in ('dfs', 'cache', 'mc')
+            for cluster, conf in config.items() if cluster.lower() not in ('dfs', 'cache', 'mc', 'disk_cache')
         }
 
         dfs_conf = config.get('dfs', self._default_config)
@@ -110,16 +117,38 @@ class MixedClient(object):
     def _get_with_info(self, uri, **kwargs):  # returns (data, info)
         no_cache = kwargs.get('no_cache', False)
         update_cache = kwargs.get('update_cache', False)
+        # expected ETag of the object, only used to validate the disk tier
+        etag = kwargs.pop('etag', None)
 
         if no_cache and update_cache:
             raise ValueError(
                 'arguments "update_cache" and "no_cache" conflict with each other')
 
         enable_cache, get_fn = self.prepare_io_fn(uri)
+        # only remote objects go to the disk tier, dfs files are local already
+        enable_disk_cache = self._disk_cache and (not no_cache) and self._is_ceph_uri(uri)
         enable_cache = self._cache and enable_cache and (not no_cache)
         cache_retry_times = 3
         cache_value = None
 
+        # length and ETag of the backend object to revalidate the disk tier
+        # with (disk_cache_verify_etag), None if the client can not HEAD
+        head = None
+        if enable_disk_cache and etag is None and self._disk_cache.revalidate:
+            head = self._head(uri)
+            if head is not None:
+                etag = head['etag']
+                kwargs['enable_etag'] = True
+
+        if enable_disk_cache and (not update_cache):
+            try:
+                cache_value = self._disk_cache.get(
+                    uri, etag=etag, size=head['size'] if head else None)
+            except Exception as err:
+                LOG.error(err)
+            if cache_value is not None:
+                return cache_value, None
+
         if enable_cache and (not update_cache):
             for _ in range(cache_retry_times):
                 cache_should_retry = False
@@ -138,6 +167,8 @@ class MixedClient(object):
                         break
 
         if cache_value is not None:
+            if enable_disk_cache:
+                self._disk_cache_put(uri, cache_value)
             return cache_value, None
 
         content, info = get_fn(**kwargs)
@@ -157,8 +188,40 @@ class MixedClient(object):
                     if not cache_should_retry:
                         break
 
+        if enable_disk_cache:
+            self._disk_cache_put(uri, content, info)
+
         return content, info
 
+    def _head(self, uri):
+        cluster, bucket, key, _ = Ceph.parse_uri(
+            uri, self._ceph_dict, self._default_cluster)
+        head_fn = getattr(self._ceph_dict[cluster], 'head', None)
+        if head_fn is None:
+            return None
+        try:
+            return head_fn(cluster, bucket, key)
+        except exception.ObjectNotFoundError:
+            # gone on the backend, the get below raises for it
+            self._disk_cache.delete(uri)
+            return None
+
+    def _is_ceph_uri(self, uri):
+        try:
+            Ceph.parse_uri(uri, self._ceph_dict, self._default_cluster)
+            return True
+        except exception.InvalidUriError:
+            return False
+
+    def _disk_cache_put(self, uri, content, info=None):
+        # streams (enable_stream) are handed to the caller untouched
+        if not isinstance(content, (bytes, bytearray)):
+            return
+        try:
+            self._disk_cache.put(uri, content, info)
+        except Exception as err:
+            LOG.error(err)
+
     # 所有的异常在此处处理
     def get_with_info(self, uri, **kwargs):
         @retry('get', exceptions=(Exception,), raises=(exception.ResourceNotFoundError, NotImplementedError), tries=self._get_retry_max)
@@ -237,6 +300,8 @@ class MixedClient(object):
 
         if update_cache:
             self._cache.put(uri, content)
+        if self._disk_cache and self._is_ceph_uri(uri):
+            self._disk_cache.delete(uri)
 
         return result, info
 
@@ -250,6 +315,8 @@ class MixedClient(object):
         cluster, bucket, key, _ = Ceph.parse_uri(
             uri, self._ceph_dict, self._default_cluster)
         client = self._ceph_dict[cluster]
+        if self._disk_cache:
+            self._disk_cache.delete(uri)
         return client.delete(cluster, bucket, key)
 
     def generate_presigned_url(self, uri, client_method='get_object', expires_in=3600):
@@ -23,6 +23,7 @@ from scipy.ndimage.interpolation import map_coordinates
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
 from multiprocessing.pool import Pool
+from preprocess.preprocessing import sample_class_locations
 
 from petrel_client.client import Client
 import os
@@ -352,18 +353,7 @@ class GenericPreprocessor(object):
         num_samples = 10000
         min_percent_coverage = 0.01 # at least 1% of the class voxels need to be selected, otherwise it may be too sparse
         rndst = np.random.RandomState(1234)
-        class_locs = {}
-        for c in all_classes:
-            all_locs = np.argwhere(all_data[-1] == c)
-            if len(all_locs) == 0:
-                class_locs[c] = []
-                continue
-            target_num_samples = min(num_samples, len(all_locs))
-            target_num_samples = max(target_num_samples, int(np.ceil(len(all_locs) * min_percent_coverage)))
-
-            selected = all_locs[rndst.choice(len(all_locs), target_num_samples, replace=False)]
-            class_locs[c] = selected
-            print(c, target_num_samples)
+        class_locs = sample_class_locations(all_data[-1], all_classes, rndst, num_samples, min_percent_coverage)
         properties['class_locations'] = class_locs
 
         print("saving: ", os.path.join(output_folder_stage, "%s.npz" % case_identifier))
@@ -36,7 +36,7 @@ from run.load_pretrained_weights import *
 from dataset.utils import nnUNet_resize
 from utilities.nd_softmax import *
 import uuid
-from inference.segmentation_export import save_segmentation_nifti_from_softmax, save_segmentation_nifti
+from inference.segmentation_export import save_segmentation_nifti_from_softmax, save_segmentation_nifti, reverse_anatomy_lut
 
 import SimpleITK as sitk
 
@@ -69,45 +69,78 @@ class AutoRG_Brain():
 
         self.hammer_anas = json.load(open('utils_file/hammer_anas.json','r'))
         self.eval_mode = config['eval_mode']
+        # predicted masks are passed to the report model in memory, nifti export is optional
+        self.fuse_seg_report = config.get('fuse_seg_report', True)
+        self.save_masks = config.get('save_masks', True)
+        # number of regions (of possibly several cases) that are decoded together
+        self.report_batch_size = config.get('report_batch_size', 16)
+        # report generation on the CPU with int8 weights, see LanguageModel.quantize_for_cpu
+        if config.get('quantize_llm', False):
+            self.trainer.llm_model.quantize_for_cpu()
     
     def report(self, input_case_dict):
+        """
+        :return: the predicted reports of the cases in input_case_dict, in input order
+        """
+        case_reports = {}
+        for case_idx, pred_report in self.report_stream(input_case_dict):
+            if pred_report is not None:
+                case_reports[case_idx] = pred_report
 
+        print("inference done.")
+
+        return [case_reports[case_idx] for case_idx in sorted(case_reports)]
+
+    def report_stream(self, input_case_dict):
+        """
+        yields (index of the case in input_case_dict, predicted report) as soon as the report of a case is done. The
+        report is None if eval_mode produces none, cases that fail in preprocessing are skipped
+        """
+        # paths and region names of the cases whose reports are still being generated
+        case_info = {}
+
+        # the regions of several cases are decoded in one batch, reports come back per case once all its regions are done
+        for case_idx, output in self.trainer.llm_model.generate_stream(self.region_features_stream(input_case_dict, case_info),
+                                                                       max_length=300, max_batch_size=self.report_batch_size):
+            generated_sents_for_selected_regions = self.trainer.tokenizer.batch_decode(
+                    output, skip_special_tokens=True, clean_up_tokenization_spaces=True
+            )
+            the_image_path, the_ab_seg_path, the_ana_seg_path, region_direction_names = case_info.pop(case_idx)
+
+            pred_region_concat_report = self.postprocess_report(generated_sents_for_selected_regions, region_direction_names)
+            if pred_region_concat_report is not None:
+                yield case_idx, {'image':the_image_path,'pred_report':pred_region_concat_report,'ab_mask':the_ab_seg_path,'ana_mask':the_ana_seg_path}
+            else:
+                yield case_idx, None
+
+    def region_features_stream(self, input_case_dict, case_info):
+        """
+        yields (index of the case in input_case_dict, region features) in the order the cases are preprocessed.
+        case_info[index] is set to (image path, ab mask path, ana mask path, region direction names) of the case
+        """
         test_file = input_case_dict
         
         list_of_lists = [[j['image']] for j in test_file]
         list_of_ab_segs = [j['label'] if 'label' in j else None for j in test_file]
         list_of_ana_segs = [j['label2'] if 'label2' in j else None for j in test_file]
-        list_of_reports = None if 'report' not in test_file[0] else [j['report'] for j in test_file]
+        list_of_reports = [j.get('report') for j in test_file] if any('report' in j for j in test_file) else None
         modals = [j['modal'] for j in test_file]
 
-        list_of_ab_segs, list_of_ana_segs = self.segmodel.seg(list_of_lists, list_of_ab_segs, list_of_ana_segs, modals)
-
-        case_identifiers = []
-        for idx,j in enumerate(test_file):
-            case_identifiers.append(j['image'].split('/')[-1].split('.')[0])
-        
-        pool = Pool(self.num_threads_nifti_save)
-        
-        print("emptying cuda cache")
-        torch.cuda.empty_cache()
+        # the preprocessing workers return the cases in any order, they are identified by their index
+        case_identifiers = list(range(len(test_file)))
 
-        preprocessing = preprocess_multithreaded(self.trainer, list_of_lists, list_of_ab_segs, list_of_ana_segs, list_of_reports, case_identifiers, modals, self.num_threads_preprocessing)
+        if self.fuse_seg_report and self.segmodel.shares_preprocessing(self.trainer):
+            cases = self.fused_cases(list_of_lists, list_of_ab_segs, list_of_ana_segs, list_of_reports, case_identifiers, modals)
+        else:
+            cases = self.staged_cases(list_of_lists, list_of_ab_segs, list_of_ana_segs, list_of_reports, case_identifiers, modals)
 
-        pred_report = []
-        
         setup_seed(42)
 
         self.trainer.network.eval()
         self.trainer.llm_model.eval()
 
-        # the_idx = 0
-        result_se_mask = [None for _ in modals]
-
-        result_modal = []
-        for preprocessed in preprocessing:
-
-            # identifier, modal, (r, d, s_ab, s_ana, dct) = preprocessed
-            identifier, modal, the_image_path, the_ab_seg_path, the_ana_seg_path, (r, d, s_ab, s_ana, dct) = preprocessed
+        for case in cases:
+            case_idx, modal, the_image_path, the_ab_seg_path, the_ana_seg_path, (r, d, s_ab, s_ana) = case
 
             d = np.expand_dims(nnUNet_resize(d[0],self.trainer.patch_size,axis=0),axis=0)
             s_ab = nnUNet_resize(s_ab[0], self.trainer.patch_size,is_seg=True,axis=0) if s_ab is not None else np.zeros(self.trainer.patch_size)
@@ -127,84 +160,121 @@ class AutoRG_Brain():
                 mixed_precision=self.mixed_precision, modal=modal, eval_mode=self.eval_mode)
 
             region_features = torch.tensor(np.array([item.cpu().detach().numpy() for item in region_features]), dtype=torch.float32).to(self.trainer.llm_model.device)
-            
-            output = self.trainer.llm_model.generate(
-                    region_features,
-                    max_length=300,
-                    num_beams=1,
-                    num_beam_groups=1,
-                    do_sample=False,
-                    num_return_sequences = 1,
-                    early_stopping=True
-            )
-            del region_features
 
-            generated_sents_for_selected_regions = self.trainer.tokenizer.batch_decode(
-                    output, skip_special_tokens=True, clean_up_tokenization_spaces=True
-            )
-
-            ## the index of the sentence mask ##
-            if self.eval_mode == "region_segtool":
-                pred_global_report = generated_sents_for_selected_regions[-1]
-
-                pred_region_concat_report = []
-                for cur_idx, se in enumerate(generated_sents_for_selected_regions[:-1]):
-                    # no anatomy is mentioned in the sentence
-                    print("sentence",generated_sents_for_selected_regions[cur_idx],"anatomy",region_direction_names[cur_idx])
-                    ana_flag = False
-                    for cur_a in self.hammer_anas:
-                        if cur_a in se.lower():
-                            ana_flag=True
-                            break
-                    # anatomy is mentioned in the sentence
-                    if not ana_flag:
-                        sort_ana = sorted(region_direction_names[cur_idx][1],key =lambda x:-x[0])
-                        most_pixel = sort_ana[0][0]
-                        sort_ana = list(filter(lambda x:x[0]>=most_pixel, sort_ana))
-                        ana_str = ' and '.join([item[1] for item in sort_ana])
-                        se = se.strip()
-                        se = se[:-1] + ' in '+ana_str+'.' if se[-1] == '.' or se[-1] == ',' else se + ' in '+ana_str+'.'
-                    else:
-                        if region_direction_names[cur_idx][0] == "left":
-                            se = se.replace('right','left')
-                        elif region_direction_names[cur_idx][0] == "right":
-                            se = se.replace('left','right')
-                    pred_region_concat_report.append(se)
-                    
-                pred_region_concat_report = " ".join(pred_region_concat_report)
-
-                left_sentence = ""
-
-                pred_split = pred_global_report.split('.')
-                pred_split_2 = []
-                for se in pred_split:
-                    pred_split_2.extend(se.split(','))
-                pred_split = list(map(lambda x:x+'.',pred_split_2))
-                
-                if 'ventricle' not in pred_region_concat_report.lower() and 'ventricle' not in left_sentence.lower():
-                    left_sentence = left_sentence+" ".join([g for g in pred_split if 'ventricle' in g.lower()])            
-                if 'midline' not in pred_region_concat_report.lower() and 'midline' not in left_sentence.lower():
-                    left_sentence = left_sentence+" "+" ".join([g for g in pred_split if 'midline' in g.lower()])
-                if 'sulci' not in pred_region_concat_report.lower() and 'midline' not in left_sentence.lower():
-                    left_sentence = left_sentence+" "+" ".join([g for g in pred_split if 'sulci' in g.lower()])
+            case_info[case_idx] = (the_image_path, the_ab_seg_path, the_ana_seg_path, region_direction_names)
+            yield case_idx, region_features
+
+    def postprocess_report(self, generated_sents_for_selected_regions, region_direction_names):
+        """
+        joins the generated sentences of the regions of one case to its report
+        """
+        ## the index of the sentence mask ##
+        if self.eval_mode == "region_segtool":
+            pred_global_report = generated_sents_for_selected_regions[-1]
+
+            pred_region_concat_report = []
+            for cur_idx, se in enumerate(generated_sents_for_selected_regions[:-1]):
+                # no anatomy is mentioned in the sentence
+                print("sentence",generated_sents_for_selected_regions[cur_idx],"anatomy",region_direction_names[cur_idx])
+                ana_flag = False
+                for cur_a in self.hammer_anas:
+                    if cur_a in se.lower():
+                        ana_flag=True
+                        break
+                # anatomy is mentioned in the sentence
+                if not ana_flag:
+                    sort_ana = sorted(region_direction_names[cur_idx][1],key =lambda x:-x[0])
+                    most_pixel = sort_ana[0][0]
+                    sort_ana = list(filter(lambda x:x[0]>=most_pixel, sort_ana))
+                    ana_str = ' and '.join([item[1] for item in sort_ana])
+                    se = se.strip()
+                    se = se[:-1] + ' in '+ana_str+'.' if se[-1] == '.' or se[-1] == ',' else se + ' in '+ana_str+'.'
+                else:
+                    if region_direction_names[cur_idx][0] == "left":
+                        se = se.replace('right','left')
+                    elif region_direction_names[cur_idx][0] == "right":
+                        se = se.replace('left','right')
+                pred_region_concat_report.append(se)
                 
-                if 'midline' not in pred_region_concat_report.lower() and 'midline' not in left_sentence.lower():
-                    left_sentence += " No midline shift."
-                    
-                pred_region_concat_report +=" "+left_sentence
+            pred_region_concat_report = " ".join(pred_region_concat_report)
+
+            left_sentence = ""
+
+            pred_split = pred_global_report.split('.')
+            pred_split_2 = []
+            for se in pred_split:
+                pred_split_2.extend(se.split(','))
+            pred_split = list(map(lambda x:x+'.',pred_split_2))
+            
+            if 'ventricle' not in pred_region_concat_report.lower() and 'ventricle' not in left_sentence.lower():
+                left_sentence = left_sentence+" ".join([g for g in pred_split if 'ventricle' in g.lower()])            
+            if 'midline' not in pred_region_concat_report.lower() and 'midline' not in left_sentence.lower():
+                left_sentence = left_sentence+" "+" ".join([g for g in pred_split if 'midline' in g.lower()])
+            if 'sulci' not in pred_region_concat_report.lower() and 'midline' not in left_sentence.lower():
+                left_sentence = left_sentence+" "+" ".join([g for g in pred_split if 'sulci' in g.lower()])
+            
+            if 'midline' not in pred_region_concat_report.lower() and 'midline' not in left_sentence.lower():
+                left_sentence += " No midline shift."
                 
-                pred_report.append({'image':the_image_path,'pred_report':pred_region_concat_report,'ab_mask':the_ab_seg_path,'ana_mask':the_ana_seg_path})
+            pred_region_concat_report +=" "+left_sentence
+            return pred_region_concat_report
 
-            elif self.eval_mode == "given_mask":
-                pred_region_concat_report = " ".join(generated_sents_for_selected_regions)
-                pred_report.append({'image':the_image_path,'pred_report':pred_region_concat_report,'ab_mask':the_ab_seg_path,'ana_mask':the_ana_seg_path})
+        elif self.eval_mode == "given_mask":
+            return " ".join(generated_sents_for_selected_regions)
 
-        print("inference done.")
+        return None
 
-        pool.close()
-        pool.join()
-        
-        return pred_report
+    def staged_cases(self, list_of_lists, list_of_ab_segs, list_of_ana_segs, list_of_reports, case_identifiers, modals):
+        """
+        segmentation masks are exported to nifti first and then preprocessed again together with the image. Used when
+        the segmentation and the report trainer do not share their preprocessing
+        """
+        list_of_ab_segs, list_of_ana_segs = self.segmodel.seg(list_of_lists, list_of_ab_segs, list_of_ana_segs, modals)
+
+        print("emptying cuda cache")
+        torch.cuda.empty_cache()
+
+        preprocessing = preprocess_multithreaded(self.trainer, list_of_lists, list_of_ab_segs, list_of_ana_segs, list_of_reports, case_identifiers, modals, self.num_threads_preprocessing)
+
+        for preprocessed in preprocessing:
+            identifier, modal, the_image_path, the_ab_seg_path, the_ana_seg_path, (r, d, s_ab, s_ana, dct) = preprocessed
+            yield identifier, modal, the_image_path, the_ab_seg_path, the_ana_seg_path, (r, d, s_ab, s_ana)
+
+    def fused_cases(self, list_of_lists, list_of_ab_segs, list_of_ana_segs, list_of_reports, case_identifiers, modals):
+        """
+        every image is preprocessed once. Missing masks are predicted on the preprocessed image and handed over at
+        network resolution, nifti export of the predicted masks is only a side output (save_masks)
+        """
+        pool = Pool(self.num_threads_nifti_save) if self.save_masks else None
+        results = []
+
+        preprocessing = preprocess_multithreaded(self.segmodel.trainer, list_of_lists, list_of_ab_segs, list_of_ana_segs, list_of_reports, case_identifiers, modals, self.num_threads_preprocessing)
+
+        try:
+            for preprocessed in preprocessing:
+                identifier, modal, the_image_path, the_ab_seg_path, the_ana_seg_path, (r, d, s_ab, s_ana, dct) = preprocessed
+
+                if s_ab is None or s_ana is None:
+                    print("predicting", the_image_path[0], "modal", modal)
+                    softmaxs = self.segmodel.predict_preprocessed(d, modal, return_probabilities=pool is not None)
+                    pred_ab, pred_ana = self.segmodel.network_resolution_masks(softmaxs)
+
+                    if pool is not None:
+                        output_ab_filename, output_ana_filename = self.segmodel.output_filenames(the_image_path[0])
+                        results.extend(self.segmodel.export_softmax(pool, softmaxs, dct, output_ab_filename, output_ana_filename,
+                                                                    export_ab=s_ab is None, export_ana=s_ana is None))
+                        the_ab_seg_path = output_ab_filename if s_ab is None else the_ab_seg_path
+                        the_ana_seg_path = output_ana_filename if s_ana is None else the_ana_seg_path
+                    del softmaxs
+
+                    s_ab = pred_ab if s_ab is None else s_ab
+                    s_ana = pred_ana if s_ana is None else s_ana
+
+                yield identifier, modal, the_image_path, the_ab_seg_path, the_ana_seg_path, (r, d, s_ab, s_ana)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
 class SegModel():
     def __init__(self, config):
@@ -215,6 +285,79 @@ class SegModel():
         self.num_threads_preprocessing = 6
         self.output_mask_dir = config['output_dir']
 
+    def shares_preprocessing(self, trainer):
+        """
+        True if trainer preprocesses images exactly like the segmentation trainer, so that the preprocessed image and
+        the segmentation at network resolution can be used by trainer directly
+        """
+        seg_trainer = self.trainer
+        seg_spacing = seg_trainer.plans['plans_per_stage'][seg_trainer.stage]['current_spacing']
+        spacing = trainer.plans['plans_per_stage'][trainer.stage]['current_spacing']
+        return np.allclose(seg_spacing, spacing) and \
+            list(seg_trainer.transpose_forward) == list(trainer.transpose_forward) and \
+            seg_trainer.normalization_schemes == trainer.normalization_schemes and \
+            seg_trainer.use_mask_for_norm == trainer.use_mask_for_norm and \
+            seg_trainer.intensity_properties == trainer.intensity_properties
+
+    def output_filenames(self, image_path):
+        img_path = image_path.split('/')[-1].split('.')[0]
+        return join(self.output_mask_dir,img_path+'_ab.nii.gz'), join(self.output_mask_dir,img_path+'_ana.nii.gz')
+
+    def predict_preprocessed(self, d, modal, return_probabilities=True):
+        return self.trainer.predict_preprocessed_data_return_seg_and_softmax(
+            d, do_mirroring=False, mirror_axes=self.trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
+            step_size=0.5, use_gaussian=True, all_in_gpu=False,
+            mixed_precision=True, modal=modal, return_probabilities=return_probabilities)
+
+    def network_resolution_masks(self, softmaxs):
+        """
+        abnormal and anatomy masks (1, x, y, z) in the preprocessed (transposed) space, with the anatomy labels
+        reversed like in the nifti export
+        """
+        seg_abnormal, seg_anatomy = softmaxs[0], softmaxs[2]
+        seg_anatomy = reverse_anatomy_lut[seg_anatomy.astype(np.uint8)]
+        return seg_abnormal[None].astype(np.float32), seg_anatomy[None].astype(np.float32)
+
+    def export_softmax(self, pool, softmaxs, dct, output_ab_filename, output_ana_filename, export_ab=True, export_ana=True):
+        softmax_abnormal, softmax_anatomy = softmaxs[1], softmaxs[3]
+
+        transpose_forward = self.trainer.plans.get('transpose_forward')
+        if transpose_forward is not None:
+            transpose_backward = self.trainer.plans.get('transpose_backward')
+            softmax_abnormal = softmax_abnormal.transpose([0] + [i + 1 for i in transpose_backward]) # 2, x ,y z
+            softmax_anatomy = softmax_anatomy.transpose([0] + [i + 1 for i in transpose_backward]) # 96, x, y, z
+
+        if 'segmentation_export_params' in self.trainer.plans.keys():
+            force_separate_z = self.trainer.plans['segmentation_export_params']['force_separate_z']
+            interpolation_order = self.trainer.plans['segmentation_export_params']['interpolation_order']
+            interpolation_order_z = self.trainer.plans['segmentation_export_params']['interpolation_order_z']
+        else:
+            force_separate_z = None
+            interpolation_order = 1
+            interpolation_order_z = 0
+
+        npz_file = None
+
+        if hasattr(self.trainer, 'regions_class_order'):
+            region_class_order = self.trainer.regions_class_order
+        else:
+            region_class_order = None
+
+        results = []
+        if export_ab:
+            results.append(pool.starmap_async(save_segmentation_nifti_from_softmax,
+                                            ((softmax_abnormal, output_ab_filename, dct, interpolation_order, region_class_order,
+                                                None, None,
+                                                npz_file, None, force_separate_z, interpolation_order_z),)
+                                                ))
+        if export_ana:
+            results.append(pool.starmap_async(save_segmentation_nifti_from_softmax,
+                                            ((softmax_anatomy, output_ana_filename, dct, interpolation_order, region_class_order,
+                                                None, None,
+                                                npz_file, None, force_separate_z, interpolation_order_z, True),)
+                                            ))
+        return results
+
     def seg(self, list_of_lists, list_of_ab_segs, list_of_ana_segs, modals):
         pool = Pool(self.num_threads_nifti_save)
         results = []
@@ -225,39 +368,28 @@ class SegModel():
         ana_flag = []
         for idx,item in enumerate(list_of_lists):
             # uid = uuid.uuid1().hex
-            img_path = item[0].split('/')[-1].split('.')[0]
+            output_ab_filename, output_ana_filename = self.output_filenames(item[0])
             if list_of_ab_segs[idx] is not None:
                 ab_flag.append(True)
                 output_ab_filenames.append(list_of_ab_segs[idx])
             else:
                 ab_flag.append(False)
-                output_ab_filenames.append(join(self.output_mask_dir,img_path+'_ab.nii.gz'))
+                output_ab_filenames.append(output_ab_filename)
             if list_of_ana_segs[idx] is not None:
                 ana_flag.append(True)
                 output_ana_filenames.append(list_of_ana_segs[idx])
             else:
                 ana_flag.append(False)
-                output_ana_filenames.append(join(self.output_mask_dir,img_path+'_ana.nii.gz'))
+                output_ana_filenames.append(output_ana_filename)
         
         print("emptying cuda cache")
         torch.cuda.empty_cache()
-
-        if 'segmentation_export_params' in self.trainer.plans.keys():
-            force_separate_z = self.trainer.plans['segmentation_export_params']['force_separate_z']
-            interpolation_order = self.trainer.plans['segmentation_export_params']['interpolation_order']
-            interpolation_order_z = self.trainer.plans['segmentation_export_params']['interpolation_order_z']
-        else:
-            force_separate_z = None
-            interpolation_order = 1
-            interpolation_order_z = 0
         
         print("starting preprocessing generator")
         # under 3dfullres setting, seg_from_prev_stage is None
         preprocessing = preprocess_multithreaded_seg(self.trainer, list_of_lists, modals, output_ab_filenames, output_ana_filenames, ab_flag, ana_flag, self.num_threads_preprocessing)
         print("starting prediction...")
 
-        result_modal = []
-
         for preprocessed in preprocessing:
 
             output_ab_filename, output_ana_filename, is_exist_ab, is_exist_ana, image_path, modal, (d, s, dct) = preprocessed
@@ -272,48 +404,10 @@ class SegModel():
                 os.remove(d)
                 d = data
 
-            # load the params of the network
-
-            softmaxs = self.trainer.predict_preprocessed_data_return_seg_and_softmax(
-                d, do_mirroring=False, mirror_axes=self.trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
-                step_size=0.5, use_gaussian=True, all_in_gpu=False,
-                mixed_precision=True, modal=modal)
-            
-            softmax_abnormal, softmax_anatomy = softmaxs[1], softmaxs[3]
-
-            transpose_forward = self.trainer.plans.get('transpose_forward')
-            if transpose_forward is not None:
-                transpose_backward = self.trainer.plans.get('transpose_backward')
-                softmax_abnormal = softmax_abnormal.transpose([0] + [i + 1 for i in transpose_backward]) # 2, x ,y z
-                softmax_anatomy = softmax_anatomy.transpose([0] + [i + 1 for i in transpose_backward]) # 96, x, y, z
-            
-            # if list_of_segs is not None:
-            #     gt = s[0]
-            #     gt[gt<0] = 0
-
-            #     pred = softmax_abnormal.argmax(0)
-            #     gt[gt>0] = 1
-            #     gt[gt<0] = 0
-            
-            npz_file = None
+            softmaxs = self.predict_preprocessed(d, modal)
 
-            if hasattr(self.trainer, 'regions_class_order'):
-                region_class_order = self.trainer.regions_class_order
-            else:
-                region_class_order = None
-
-            if not is_exist_ab:
-                results.append(pool.starmap_async(save_segmentation_nifti_from_softmax,
-                                                ((softmax_abnormal, output_ab_filename, dct, interpolation_order, region_class_order,
-                                                    None, None,
-                                                    npz_file, None, force_separate_z, interpolation_order_z),)
-                                                    ))
-            if not is_exist_ana:
-                results.append(pool.starmap_async(save_segmentation_nifti_from_softmax,
-                                                ((softmax_anatomy, output_ana_filename, dct, interpolation_order, region_class_order,
-                                                    None, None,
-                                                    npz_file, None, force_separate_z, interpolation_order_z, True),)
-                                                ))
+            results.extend(self.export_softmax(pool, softmaxs, dct, output_ab_filename, output_ana_filename,
+                                               export_ab=not is_exist_ab, export_ana=not is_exist_ana))
 
         pool.close()
         pool.join()
@@ -433,6 +527,9 @@ def preprocess_save_to_queue(preprocess_fn, q, list_of_lists, list_of_ab_segs, l
             else:
                 s_ana = None
 
+            if the_ab_seg is None and the_ana_seg is None:
+                d, _, dct = preprocess_fn(l, None, target_shape=target_shape)
+
             if np.prod(d.shape) > (2e9 / 4 * 0.85):  # *0.85 just to be save, 4 because float32 is 4 bytes
                 print(
                     "This output is too large for python process-process communication. "
@@ -32,8 +32,9 @@ import torch
 import shutil
 from multiprocessing import Pool
 
-from inference.segmentation_export import save_segmentation_nifti_from_softmax, save_segmentation_nifti
-from network_training.model_restore import load_model_and_checkpoint_files
+from inference.segmentation_export import save_segmentation_nifti_from_softmax, save_segmentation_nifti, \
+    reverse_anatomy_lut
+from network_training.model_restore import CheckpointPool, load_checkpoint_pool
 from utilities.nd_softmax import *
 
 #from nnunet.postprocessing.connected_components import load_remove_save, load_postprocessing
@@ -127,10 +128,12 @@ def predict_cases(model, output_folder, list_of_lists, list_of_segs, output_file
                   num_threads_nifti_save, dice_type="anatomy", do_tta=True, save_output_nii=False,
                   mixed_precision=True,
                   all_in_gpu=False, step_size=0.5, checkpoint_name="model_final_checkpoint",
-                  segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False, modal=None):
+                  segmentation_export_kwargs: dict = None, disable_postprocessing: bool = False, modal=None,
+                  pin_memory=False):
     """
     :param segmentation_export_kwargs:
-    :param model: folder where the model is saved, must contain fold_x subfolders
+    :param model: folder where the model is saved, must contain fold_x subfolders. Can also be a CheckpointPool
+    (see network_training/model_restore.py) to reuse the loaded weights across calls
     :param list_of_lists: [[case0_0000.nii.gz, case0_0001.nii.gz], [case1_0000.nii.gz, case1_0001.nii.gz], ...]
     :param output_filenames: [output_file_case0.nii.gz, output_file_case1.nii.gz, ...]
     :param folds: default: (0, 1, 2, 3, 4) (but can also be 'all' or a subset of the five folds, for example use (0, )
@@ -142,6 +145,7 @@ def predict_cases(model, output_folder, list_of_lists, list_of_segs, output_file
     :param do_tta: default: True, can be set to False for a 8x speedup at the cost of a reduced segmentation quality
     :param overwrite_existing: default: True
     :param mixed_precision: if None then we take no action. If True/False we overwrite what the model has in its init
+    :param pin_memory: keep the checkpoint weights in pinned host memory
     :return:
     """
 
@@ -180,9 +184,13 @@ def predict_cases(model, output_folder, list_of_lists, list_of_segs, output_file
     print("emptying cuda cache")
     torch.cuda.empty_cache()
 
-    # if folds is a int, e.g. 0, then len(params) == 1
-    trainer, params = load_model_and_checkpoint_files(model, mixed_precision=mixed_precision,
-                                                      checkpoint_name=checkpoint_name)
+    # weights are loaded once per run, the pool only swaps them if there are several checkpoints
+    if isinstance(model, CheckpointPool):
+        checkpoint_pool = model
+    else:
+        checkpoint_pool = load_checkpoint_pool(model, mixed_precision=mixed_precision,
+                                               checkpoint_name=checkpoint_name, pin_memory=pin_memory)
+    trainer = checkpoint_pool.trainer
     
     if 'Radio_VQA' in list_of_lists[0][0] or 'radio' in list_of_lists[0][0]:
         trainer.plans['transpose_forward'] = [2,0,1]
@@ -220,8 +228,6 @@ def predict_cases(model, output_folder, list_of_lists, list_of_segs, output_file
         test_dices = json.load(open(os.path.join(output_folder,'test_dices.json'),'r'))
     else:
         test_dices = {}
-    
-    reverse_anatomy_map = json.load(open('utils_file/hammer_label_reverse_map.json','r'))
 
     for preprocessed in preprocessing:
 
@@ -239,31 +245,23 @@ def predict_cases(model, output_folder, list_of_lists, list_of_segs, output_file
             d = data
 
         print("predicting", output_filename)
-        # load the params of the network
-        trainer.load_checkpoint_ram(params[0], False)
-        
-        # Use the do_tta parameter passed to predict_cases, don't force False
 
-        softmaxs = trainer.predict_preprocessed_data_return_seg_and_softmax(
-            d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
-            step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
-            mixed_precision=mixed_precision, modal=modal)
-        
-        softmax_abnormal, softmax_anatomy = softmaxs[1], softmaxs[3]
-        
-        # if fold is a int then len(params) == 1, the below code won't run
-        for p in params[1:]:
-            trainer.load_checkpoint_ram(p, False)
-            softmaxs_fold = trainer.predict_preprocessed_data_return_seg_and_softmax(
+        # Use the do_tta parameter passed to predict_cases, don't force False
+        softmax_abnormal, softmax_anatomy = None, None
+        for trainer in checkpoint_pool.iterate():
+            softmaxs = trainer.predict_preprocessed_data_return_seg_and_softmax(
                 d, do_mirroring=do_tta, mirror_axes=trainer.data_aug_params['mirror_axes'], use_sliding_window=True,
                 step_size=step_size, use_gaussian=True, all_in_gpu=all_in_gpu,
                 mixed_precision=mixed_precision, modal=modal)
-            softmax_abnormal += softmaxs_fold[1]
-            softmax_anatomy += softmaxs_fold[3]
-        # if fold is a int then len(params) == 1, the below code won't run
-        if len(params) > 1:
-            softmax_abnormal /= len(params)
-            softmax_anatomy /= len(params)
+            if softmax_abnormal is None:
+                softmax_abnormal, softmax_anatomy = softmaxs[1], softmaxs[3]
+            else:
+                softmax_abnormal += softmaxs[1]
+                softmax_anatomy += softmaxs[3]
+        # if there is only one checkpoint, the below code won't run
+        if len(checkpoint_pool) > 1:
+            softmax_abnormal /= len(checkpoint_pool)
+            softmax_anatomy /= len(checkpoint_pool)
 
         # softmax_transpose.shape = num_classes, 144, 174, 138
         transpose_forward = trainer.plans.get('transpose_forward')
@@ -278,27 +276,13 @@ def predict_cases(model, output_folder, list_of_lists, list_of_segs, output_file
 
             if "anatomy" in dice_type:
                 ###### begin annotation ####
-                class_dice = []
                 pred = softmax_anatomy.argmax(0)
                 if dice_type == "anatomy_reverse":
-                    pred_reverse = np.zeros(pred.shape)
-                    for from_label, to_label in reverse_anatomy_map.items():
-                        pred_reverse[pred == int(from_label)] = int(to_label)
-                    
-                    pred = pred_reverse
-
-                for ana in list(np.unique(gt)):
-                    if ana == 0:
-                        continue
-
-                    hd = cal_hd(pred==ana,gt==ana)
-                    # nsd = cal_nsd(pred==ana,gt==ana)
-                    cur_dice, nsd, precision, sensitivity, specificity = cal_dice(pred==ana,gt==ana)
+                    pred = reverse_anatomy_lut[pred]
 
-                    class_dice.append([cur_dice, nsd, hd, precision, sensitivity, specificity])
+                labels = [ana for ana in np.unique(gt) if ana != 0]
+                class_dice = cal_multilabel_metrics(pred, gt, labels)
 
-                    # class_dice.append(cal_dice(pred==ana, gt==ana))
-                    
                 dices.append(np.mean(class_dice,axis=0))
 
                 ### end annotation ####
@@ -306,8 +290,7 @@ def predict_cases(model, output_folder, list_of_lists, list_of_segs, output_file
                 pred = softmax_abnormal.argmax(0)
                 gt[gt>0] = 1
                 gt[gt<0] = 0
-                hd = cal_hd(pred,gt)
-                cur_dice, nsd, precision, sensitivity, specificity = cal_dice(pred,gt)
+                cur_dice, nsd, hd, precision, sensitivity, specificity = cal_multilabel_metrics(pred, gt, [1])[0]
                 cur_dice = 0 if np.isnan(cur_dice) else cur_dice
                 nsd = 0 if np.isnan(nsd) else nsd
                 precision = 0 if np.isnan(precision) else precision
@@ -442,7 +425,8 @@ def predict_from_folder(model: str, output_folder: str, test_file: str,
                         part_id: int, num_parts: int, tta: bool, save_output_nii: bool, mixed_precision: bool = True,
                         overwrite_all_in_gpu: bool = None,
                         step_size: float = 0.5, checkpoint_name: str = "model_final_checkpoint",
-                        segmentation_export_kwargs: dict = None, disable_postprocessing: bool = True, modal=None):
+                        segmentation_export_kwargs: dict = None, disable_postprocessing: bool = True, modal=None,
+                        pin_memory=False):
     """
         here we use the standard naming scheme to generate list_of_lists and output_files needed by predict_cases
 
@@ -547,7 +531,7 @@ def predict_from_folder(model: str, output_folder: str, test_file: str,
                             all_in_gpu=all_in_gpu,
                             step_size=step_size, checkpoint_name=checkpoint_name,
                             segmentation_export_kwargs=segmentation_export_kwargs,
-                            disable_postprocessing=disable_postprocessing, modal=modal)
+                            disable_postprocessing=disable_postprocessing, modal=modal, pin_memory=pin_memory)
 
 
 if __name__ == "__main__":
@@ -32,7 +32,7 @@ else:
 import torch
 from multiprocessing import Pool
 
-from network_training.model_restore import load_model_and_checkpoint_files_llm
+from network_training.model_restore import CheckpointPool, load_checkpoint_pool
 from utilities.llm_metric import *
 
 from batchgenerators.utilities.file_and_folder_operations import *
@@ -138,9 +138,10 @@ def predict_cases(model, seg_pretrained, output_folder, list_of_lists, list_of_a
                   num_threads_nifti_save, do_tta=True, 
                   mixed_precision=True,
                   all_in_gpu=False, step_size=0.5, checkpoint_name="model_final_checkpoint",
-                  eval_mode="region_oracle"):
+                  eval_mode="region_oracle", pin_memory=False):
     """
-    :param model: folder where the model is saved, must contain fold_x subfolders
+    :param model: folder where the model is saved, must contain fold_x subfolders. Can also be a CheckpointPool
+    (see network_training/model_restore.py) to reuse the loaded weights across calls
     :param list_of_lists: [[case0_0000.nii.gz, case0_0001.nii.gz], [case1_0000.nii.gz, case1_0001.nii.gz], ...]
     :param num_threads_preprocessing:
     :param num_threads_nifti_save:
@@ -156,10 +157,12 @@ def predict_cases(model, seg_pretrained, output_folder, list_of_lists, list_of_a
     print("emptying cuda cache")
     torch.cuda.empty_cache()
 
-    trainer, params = load_model_and_checkpoint_files_llm(model, mixed_precision=mixed_precision,
-                                                      checkpoint_name=checkpoint_name)
-
-    trainer.load_checkpoint_ram(params[0], False)
+    if isinstance(model, CheckpointPool):
+        checkpoint_pool = model
+    else:
+        checkpoint_pool = load_checkpoint_pool(model, mixed_precision=mixed_precision,
+                                               checkpoint_name=checkpoint_name, pin_memory=pin_memory, llm=True)
+    trainer = checkpoint_pool.activate(0)
     
     if seg_pretrained is not None:
         print("init AutoRG_Brain_SEG model")
@@ -374,7 +377,7 @@ def predict_from_folder(model: str, seg_pretrained: str, output_folder: str, tes
                         part_id: int, num_parts: int, tta: bool, mixed_precision: bool = True,
                         overwrite_all_in_gpu: bool = None,
                         step_size: float = 0.5, checkpoint_name: str = "model_final_checkpoint",
-                        eval_mode="region_oracle"):
+                        eval_mode="region_oracle", pin_memory=False):
     """
         here we use the standard naming scheme to generate list_of_lists and output_files needed by predict_cases
 
@@ -473,7 +476,7 @@ def predict_from_folder(model: str, seg_pretrained: str, output_folder: str, tes
                             mixed_precision=mixed_precision,
                             all_in_gpu=all_in_gpu,
                             step_size=step_size, checkpoint_name=checkpoint_name,
-                            eval_mode=eval_mode)
+                            eval_mode=eval_mode, pin_memory=pin_memory)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+"""
+Resident report generation: AutoRG_Brain is loaded once and serves cases submitted over a loopback HTTP endpoint or a
+local unix socket. Requests wait in a bounded queue, the worker takes the cases of several queued requests at once
+(their regions are decoded in one batch, see AutoRG_Brain.report_stream) and the reports are streamed back to every
+request as soon as a case is done.
+
+POST /report with a json list of cases (same format as the test_file of test.py: 'image', 'modal' and optionally
+'label'/'label2'), or {"cases": [...], "timeout": seconds}. The response is one json object per line:
+{"index": i, "report": {...}} for every finished case, {"index": i, "error": "..."} for every case that failed or was
+skipped by the preprocessing, then {"done": true} or {"error": "..."}.
+GET /health returns the number of queued requests.
+"""
+import json
+import math
+import os
+import queue
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from time import time
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class ReportRequest(object):
+    def __init__(self, cases, timeout=None):
+        self.cases = cases
+        self.deadline = time() + timeout if timeout else None
+        # ('case', index, report) for every finished case, ('case_error', index, message) for every failed case,
+        # then ('done', None, None) or ('error', message, None)
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        # indices of the cases that have no result yet
+        self.unfinished = set(range(len(cases)))
+
+    def expired(self):
+        return self.cancelled.is_set() or (self.deadline is not None and time() > self.deadline)
+
+    def remaining(self):
+        return None if self.deadline is None else max(0., self.deadline - time())
+
+
+class ReportService(object):
+    def __init__(self, model, max_queue_size=8, max_batch_cases=16, submit_timeout=5., request_timeout=600.):
+        """
+        :param model: AutoRG_Brain
+        :param max_queue_size: number of requests that can wait, submit raises ServiceBusy if the queue stays full
+        for submit_timeout seconds
+        :param max_batch_cases: the worker takes queued requests until it has at least this many cases
+        :param request_timeout: default timeout (seconds) of a request, 0 or None for no timeout
+        """
+        self.model = model
+        self.requests = queue.Queue(max_queue_size)
+        self.max_batch_cases = max_batch_cases
+        self.submit_timeout = submit_timeout
+        self.request_timeout = request_timeout
+
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._worker.start()
+
+    def stop(self):
+        self._stop.set()
+        self._worker.join()
+
+    def submit(self, cases, timeout=None):
+        request = ReportRequest(cases, timeout if timeout is not None else self.request_timeout)
+        try:
+            self.requests.put(request, timeout=self.submit_timeout)
+        except queue.Full:
+            raise ServiceBusy("%d requests are queued" % self.requests.qsize())
+        return request
+
+    def _next_batch(self):
+        batch = []
+        num_cases = 0
+        while not self._stop.is_set() and len(batch) == 0:
+            try:
+                batch.append(self.requests.get(timeout=0.5))
+            except queue.Empty:
+                continue
+            num_cases += len(batch[-1].cases)
+        while num_cases < self.max_batch_cases:
+            try:
+                batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+            num_cases += len(batch[-1].cases)
+        return batch
+
+    def _decode(self, batch):
+        """
+        decodes the unfinished cases of the requests in batch together. If that fails, every request is decoded again
+        on its own, so a bad case only fails the request it belongs to. Nothing is sent to expired requests and the
+        decoding stops once all requests of the batch are expired
+        """
+        batch = [request for request in batch if not request.expired()]
+        cases, owners = [], []
+        for request in batch:
+            for index in sorted(request.unfinished):
+                cases.append(request.cases[index])
+                owners.append((request, index))
+        if len(cases) == 0:
+            return
+
+        try:
+            for case_idx, pred_report in self.model.report_stream(cases):
+                request, index = owners[case_idx]
+                request.unfinished.discard(index)
+                if not request.expired():
+                    request.results.put(('case', index, pred_report))
+                if all(request.expired() for request in batch):
+                    return
+        except Exception as e:
+            if len(batch) > 1:
+                for request in batch:
+                    self._decode([request])
+                return
+            message = "%s: %s" % (type(e).__name__, e)
+        else:
+            message = "the case could not be preprocessed"
+
+        # cases that failed, or that report_stream skipped because their preprocessing failed
+        for request in batch:
+            if not request.expired():
+                for index in sorted(request.unfinished):
+                    request.results.put(('case_error', index, message))
+            request.unfinished.clear()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = []
+            for request in self._next_batch():
+                if request.expired():
+                    request.results.put(('error', 'timeout before the request was started', None))
+                else:
+                    batch.append(request)
+            if len(batch) == 0:
+                continue
+
+            self._decode(batch)
+            for request in batch:
+                if not request.expired():
+                    request.results.put(('done', None, None))
+
+
+def check_timeout(timeout):
+    if timeout is None:
+        return
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not math.isfinite(timeout) or timeout < 0:
+        raise ValueError("timeout has to be a non-negative number of seconds")
+
+
+def check_cases(cases):
+    if not isinstance(cases, list) or len(cases) == 0:
+        raise ValueError("expected a non-empty list of cases")
+    for c in cases:
+        if not isinstance(c, dict) or 'image' not in c or 'modal' not in c:
+            raise ValueError("every case needs 'image' and 'modal'")
+        for k in ('image', 'label', 'label2'):
+            if k in c and not os.path.isfile(c[k]):
+                raise ValueError("%s does not exist" % c[k])
+
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    service = None  # set by make_server
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_line(self, obj):
+        self.wfile.write(json.dumps(obj).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': 'unknown path %s' % self.path})
+            return
+        self._send_json(200, {'queued': self.service.requests.qsize()})
+
+    def do_POST(self):
+        if self.path != '/report':
+            self._send_json(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if isinstance(body, dict):
+                cases, timeout = body.get('cases'), body.get('timeout')
+            else:
+                cases, timeout = body, None
+            check_cases(cases)
+            check_timeout(timeout)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        try:
+            request = self.service.submit(cases, timeout)
+        except ServiceBusy as e:
+            self._send_json(503, {'error': str(e)})
+            return
+
+        # the reports are streamed, one json object per line, the connection is closed at the end
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    kind, value, payload = request.results.get(timeout=request.remaining())
+                except queue.Empty:
+                    request.cancelled.set()
+                    self._write_line({'error': 'timeout'})
+                    break
+                if kind == 'case':
+                    self._write_line({'index': value, 'report': payload})
+                elif kind == 'case_error':
+                    self._write_line({'index': value, 'error': payload})
+                elif kind == 'done':
+                    self._write_line({'done': True})
+                    break
+                else:
+                    self._write_line({'error': value})
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            request.cancelled.set()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        # attributes HTTPServer.server_bind would set
+        self.server_name = socket.gethostname()
+        self.server_port = 0
+
+
+def make_server(service, host="127.0.0.1", port=8765, unix_socket=None):
+    handler = type('BoundReportRequestHandler', (ReportRequestHandler,), {'service': service})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
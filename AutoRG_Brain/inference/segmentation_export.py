@@ -27,13 +27,48 @@ import json
 
 reverse_anatomy_map = json.load(open('utils_file/hammer_label_reverse_map.json','r'))
 
+# lookup table version of reverse_anatomy_map, labels that are not in the map become 0
+reverse_anatomy_lut = np.zeros(256, dtype=np.uint8)
+for from_label, to_label in reverse_anatomy_map.items():
+    reverse_anatomy_lut[int(from_label)] = int(to_label)
+
+
+def resample_softmax_argmax(segmentation_softmax: np.ndarray, new_shape, axis=None, order: int = 1,
+                            do_separate_z: bool = False, order_z: int = 0, channel_chunk_size: int = 8,
+                            dtype=np.float32):
+    """
+    argmax of resample_data_or_seg(segmentation_softmax, new_shape, is_seg=False, ...) without holding all resampled
+    channels in memory. Channels are resampled channel_chunk_size at a time (cast to dtype) while a running max and
+    argmax are kept. Ties go to the lower class index, same as np.argmax
+    :return: (x, y, z) class map
+    """
+    num_classes = segmentation_softmax.shape[0]
+    best_prob = None
+    best_class = np.zeros(new_shape, dtype=np.uint8 if num_classes <= 256 else np.int32)
+    for c in range(0, num_classes, channel_chunk_size):
+        resampled = resample_data_or_seg(segmentation_softmax[c:c + channel_chunk_size].astype(dtype, copy=False),
+                                         new_shape, is_seg=False, axis=axis, order=order,
+                                         do_separate_z=do_separate_z, order_z=order_z)
+        chunk_prob = resampled.max(0)
+        if best_prob is None:
+            best_prob = chunk_prob
+            best_class[:] = resampled.argmax(0)
+        else:
+            better = chunk_prob > best_prob
+            best_class[better] = resampled.argmax(0)[better] + c
+            best_prob[better] = chunk_prob[better]
+        del resampled
+    return best_class
+
+
 def save_segmentation_nifti_from_softmax(segmentation_softmax: Union[str, np.ndarray], out_fname: str,
                                          properties_dict: dict, order: int = 1,
                                          region_class_order: Tuple[Tuple[int]] = None,
                                          seg_postprogess_fn: callable = None, seg_postprocess_args: tuple = None,
                                          resampled_npz_fname: str = None,
                                          non_postprocessed_fname: str = None, force_separate_z: bool = None,
-                                         interpolation_order_z: int = 0, verbose: bool = True, anatomy_reverse=False):
+                                         interpolation_order_z: int = 0, verbose: bool = True, anatomy_reverse=False,
+                                         channel_chunk_size: int = 8, resample_dtype=np.float32):
     """
     This is a utility for writing segmentations to nifty and npz. It requires the data to have been preprocessed by
     GenericPreprocessor because it depends on the property dictionary output (dct) to know the geometry of the original
@@ -62,6 +97,11 @@ def save_segmentation_nifti_from_softmax(segmentation_softmax: Union[str, np.nda
     /never resample along z separately. Do not touch unless you know what you are doing
     :param interpolation_order_z: if separate z resampling is done then this is the order for resampling in z
     :param verbose:
+    :param anatomy_reverse: map the predicted labels with utils_file/hammer_label_reverse_map.json
+    :param channel_chunk_size: if the softmax is only needed for its argmax (no npz export, no region_class_order), it
+    is resampled channel_chunk_size channels at a time in resample_dtype instead of all at once in float64. None or 0
+    resamples everything at once like before
+    :param resample_dtype: np.float32 or np.float16
     :return:
     """
     if verbose: print("force_separate_z:", force_separate_z, "interpolation order:", order)
@@ -83,6 +123,9 @@ def save_segmentation_nifti_from_softmax(segmentation_softmax: Union[str, np.nda
     # current_spacing = dct.get('spacing_after_resampling')
     # original_spacing = dct.get('original_spacing')
 
+    # only the argmax is needed, so the resampled softmax never has to exist as a whole
+    chunked = bool(channel_chunk_size) and resampled_npz_fname is None and region_class_order is None
+
     if np.any([i != j for i, j in zip(np.array(current_shape[1:]), np.array(shape_original_after_cropping))]):
         if force_separate_z is None:
             if get_do_separate_z(properties_dict.get('original_spacing')):
@@ -108,10 +151,17 @@ def save_segmentation_nifti_from_softmax(segmentation_softmax: Union[str, np.nda
 
         if verbose: print("separate z:", do_separate_z, "lowres axis", lowres_axis)
 
-        # seg_old_spacing.shape = 2,x,y,z
-        seg_old_spacing = resample_data_or_seg(segmentation_softmax, shape_original_after_cropping, is_seg=False,
-                                               axis=lowres_axis, order=order, do_separate_z=do_separate_z,
-                                               order_z=interpolation_order_z)
+        if chunked:
+            # seg_old_spacing.shape = x,y,z
+            seg_old_spacing = resample_softmax_argmax(segmentation_softmax, shape_original_after_cropping,
+                                                      axis=lowres_axis, order=order, do_separate_z=do_separate_z,
+                                                      order_z=interpolation_order_z,
+                                                      channel_chunk_size=channel_chunk_size, dtype=resample_dtype)
+        else:
+            # seg_old_spacing.shape = 2,x,y,z
+            seg_old_spacing = resample_data_or_seg(segmentation_softmax, shape_original_after_cropping, is_seg=False,
+                                                   axis=lowres_axis, order=order, do_separate_z=do_separate_z,
+                                                   order_z=interpolation_order_z)
         # seg_old_spacing = resize_softmax_output(segmentation_softmax, shape_original_after_cropping, order=order)
         # test["resize seg_old_spacing"] = seg_old_spacing.shape
     else:
@@ -143,7 +193,8 @@ def save_segmentation_nifti_from_softmax(segmentation_softmax: Union[str, np.nda
 
     if region_class_order is None: # choose this
         # seg_old_spacing.shape x,y,z
-        seg_old_spacing = seg_old_spacing.argmax(0)
+        if seg_old_spacing.ndim == len(shape_original_after_cropping) + 1:
+            seg_old_spacing = seg_old_spacing.argmax(0)
         # test["seg_old_spacing"] = seg_old_spacing.shape
     else:
         seg_old_spacing_final = np.zeros(seg_old_spacing.shape[1:])
@@ -169,11 +220,7 @@ def save_segmentation_nifti_from_softmax(segmentation_softmax: Union[str, np.nda
     
 
     if anatomy_reverse:
-        seg_old_size_postprocessed = seg_old_size_postprocessed.astype(np.uint8)
-        pred_reverse = np.zeros(seg_old_size_postprocessed.shape)
-        for from_label, to_label in reverse_anatomy_map.items():
-            pred_reverse[seg_old_size_postprocessed == int(from_label)] = int(to_label)
-        seg_old_size_postprocessed = pred_reverse
+        seg_old_size_postprocessed = reverse_anatomy_lut[seg_old_size_postprocessed.astype(np.uint8)]
 
     seg_resized_itk = sitk.GetImageFromArray(seg_old_size_postprocessed.astype(np.uint8))
     seg_resized_itk.SetSpacing(properties_dict['itk_spacing'])
@@ -606,6 +606,15 @@ class Generic_UNet(SegmentationNetwork):
         # region shape [b,num_regions_in_each_image] [[[21],[23,24],[9]],[[5],[9]]]
         # target b, 2, patch_size, with target[:,0,:] is anatomy target target[:,1,:] is abnormal target
 
+        x, target = self.encode(x, target, modal)
+        return self.pool_region_features(x, target, region)
+
+    def encode(self, x, target, modal):
+        """
+        runs the network up to feature_layer and downsamples target to the resolution of the features. With a frozen
+        backbone the result only depends on the case, so report training can cache it (see dataset/feature_cache.py)
+        and only run pool_region_features in every iteration
+        """
         # a = {}
         # a['x1']=list(x.shape)
         # a['target1'] = list(target.shape)
@@ -617,8 +626,6 @@ class Generic_UNet(SegmentationNetwork):
         # a['x2']=list(x.shape)
         # a['target2'] = list(target.shape)
         
-        only_one_target = True if target.shape[1] == 1 else False
-        
         # target_anatomy = target[:,:-1,:] if not only_one_target else target[:,-1:,:]
         # target_abnormal = target[:,-1:,:]
         
@@ -661,6 +668,15 @@ class Generic_UNet(SegmentationNetwork):
             target = self.td[u](target)
             # a['ana_'+str(u)]=list(target_anatomy.shape)
 
+        return x, target
+
+    def pool_region_features(self, x, target, region):
+        """
+        :param x: features at feature_layer, b, d, z, x, y
+        :param target: anatomy and abnormal targets at the resolution of x, b, 2, z, x, y
+        """
+        only_one_target = True if target.shape[1] == 1 else False
+
         region_features = []
 
         # x_in b, 1, 224, 224, 32 
@@ -784,8 +800,6 @@ class Generic_UNet(SegmentationNetwork):
                    use_gaussian: bool = False, pad_border_mode: str = "constant",
                    pad_kwargs: dict = None, all_in_gpu: bool = False,
                    verbose: bool = True, mixed_precision: bool = True, modal=None, eval_mode="region_oracle"):
-        
-        torch.cuda.empty_cache()
 
         assert step_size <= 1, 'step_size must be smaller than 1. Otherwise there will be a gap between consecutive ' \
                                'predictions'
@@ -584,12 +584,41 @@ class Generic_UNet(SegmentationNetwork):
                 new_r.append(r[ri])
         return new_r
 
-        
+
+    @staticmethod
+    def _bbox_slices(box):
+        # the regions used for the reports always extend the skimage bounding box by one voxel at the upper end
+        z1,x1,y1,z2,x2,y2 = box.bbox
+        return slice(z1, z2 + 1), slice(x1, x2 + 1), slice(y1, y2 + 1)
+
+    def _pool_region_features(self, img_feature, region_masks):
+        """
+        runs pool_conv on the whole feature map and on the feature map masked by every region as one batch.
+        img_feature is (d, z, x, y) and region_masks a boolean (r, z, x, y) array. Returns one tensor per region with the
+        global tokens followed by the region tokens, (img_patch_num, d') each
+        """
+        masks = torch.from_numpy(region_masks).to(device=img_feature.device, dtype=img_feature.dtype)
+
+        pooled = torch.cat((img_feature[None], masks[:, None] * img_feature[None]), 0) # 1 + r, d, z, x, y
+
+        for pool_layer in self.pool_conv:
+            pooled = pool_layer(pooled)
+
+        pooled = torch.flatten(pooled, start_dim=2).permute(0, 2, 1) # 1 + r, 48, 1024
+
+        return [torch.cat((pooled[0], pooled[i]), 0) for i in range(1, len(pooled))]
+
     def forward(self, x, target, modal, region, eval_mode):
         # target b, 2, patch_size, with target[:,0,:] is anatomy target target[:,1,:] is abnormal target
-        
-        only_one_target = True if target.shape[1] == 1 else False
-        
+        x, target = self.encode(x, target, modal)
+        return self.pool_region_features(x, target, region, eval_mode)
+
+    def encode(self, x, target, modal):
+        """
+        runs the network up to feature_layer and downsamples target to the resolution of the features. With a frozen
+        backbone the result only depends on the case, so report training can cache it (see dataset/feature_cache.py)
+        and only run pool_region_features in every iteration
+        """
         skips = []
 
         if modal == 'DWI':
@@ -625,6 +654,15 @@ class Generic_UNet(SegmentationNetwork):
         for u in range(len(self.td)-1-self.feature_layer):
             target = self.td[u](target)
 
+        return x, target
+
+    def pool_region_features(self, x, target, region, eval_mode):
+        """
+        :param x: features at feature_layer, b, d, z, x, y
+        :param target: anatomy and abnormal targets at the resolution of x, b, 2, z, x, y
+        """
+        only_one_target = True if target.shape[1] == 1 else False
+
         region_features = []
 
         region_direction_names = []
@@ -644,60 +682,41 @@ class Generic_UNet(SegmentationNetwork):
             a_target[a_target>0] = 1
             b_target[b_target<0] = 0
 
-            whole_feature = img_feature.clone()
+            # integer anatomy labels and boolean abnormal mask of this case. All overlaps below are computed on
+            # these in numpy and the masks of all regions are pooled in one batch (see _pool_region_features)
+            ana_np = np.rint(b_target[0].cpu().numpy()).astype(np.int64) # z, x, y
+            ab_np = a_target[0].cpu().numpy() > 0 # z, x, y
+            num_labels = max(96, int(ana_np.max()) + 1)
 
             t0 = time.time()
-            for pool_layer in self.pool_conv:
-                whole_feature = pool_layer(whole_feature)
 
-            whole_feature = torch.flatten(whole_feature,start_dim=1,end_dim=3)
-            whole_feature = whole_feature.permute(1,0) # 48 1024
+            bboxes_ab = sk_regions(sk_label(ab_np))
+            ab_box_slices = [self._bbox_slices(box) for box in bboxes_ab]
+
+            # voxels inside the bounding box of any anomaly, and abnormal voxels without an anatomy label
+            ab_box_mask = np.zeros(ab_np.shape, dtype=bool)
+            for box_slice in ab_box_slices:
+                ab_box_mask[box_slice] = True
+            unlabelled_ab = np.logical_and(ana_np == 0, ab_np)
 
-            a = {}
+            region_masks = []
 
-            bboxes_ab = sk_regions(sk_label(a_target[0]))
             ### pick all the mentioned areas ###
 
             if eval_mode == "given_mask":
 
-                abnormal = np.zeros(a_target.shape)
-
-                for box in bboxes_ab:
-                    z1,x1,y1,z2,x2,y2 = box.bbox
-                    abnormal[:,z1:z2+1,x1:x2+1,y1:y2+1] = 1
-
-                abnormal = torch.tensor(abnormal, dtype=torch.float16)
-
-                abnormal = abnormal.repeat(img_feature.shape[0],1,1,1).to(img_feature.device) # d, z, x, y
-
-                abnormal_feature = abnormal * img_feature # d, z, x, y
-
-                for pool_layer in self.pool_conv:
-                    abnormal_feature = pool_layer(abnormal_feature)
-
-                abnormal_feature = torch.flatten(abnormal_feature,start_dim=1,end_dim=3)
-
-                abnormal_feature = abnormal_feature.permute(1,0)
-
-                final_feature = torch.cat((whole_feature, abnormal_feature), 0)
-
-                region_features.append(final_feature)
+                region_masks.append(ab_box_mask)
 
             elif eval_mode == 'region_segtool':
-                
-                r = []
 
-                for box in bboxes_ab:
+                r = []
 
-                    z1,x1,y1,z2,x2,y2 = box.bbox
-                    temp = np.zeros(a_target.shape)
-                    temp[:,z1:z2+1,x1:x2+1,y1:y2+1] = a_target[:,z1:z2+1,x1:x2+1,y1:y2+1]
-                    the_anas = []
-                    for the_a in range(1,96):
-                        if len(torch.where(np.logical_and(b_target==the_a, temp))[0]):
-                            the_anas.append(the_a)
+                # the anatomies that overlap with the anomaly inside the bounding box of every anomaly
+                for box_slice in ab_box_slices:
+                    hit_counts = np.bincount(ana_np[box_slice][ab_np[box_slice]], minlength=num_labels)
+                    the_anas = [int(the_a) for the_a in np.nonzero(hit_counts[1:96])[0] + 1]
                     if len(the_anas):
-                        r.append([the_a for the_a in the_anas])
+                        r.append(the_anas)
 
                 ### force to add lateral ventricle
                 r.append([45,46,47,48,49])
@@ -707,55 +726,49 @@ class Generic_UNet(SegmentationNetwork):
                 r.append('global')
 
                 for ana_group in r:
-                    
+
                     if ana_group == "global":
-                        abnormal = np.ones(b_target.shape)
+                        abnormal = np.ones(ab_np.shape, dtype=bool)
 
                         region_direction_names.append(['middle',[[0,'whole brain']]])
 
                     else:
-                        temp =np.zeros(b_target.shape)
-                        for ana in ana_group:
-                            temp = np.logical_or(temp,b_target==ana)
-                        
-                        abnormal = np.zeros(b_target.shape)
+                        temp = np.isin(ana_np, ana_group)
 
                         if len(ana_group)==5 and 45 in ana_group and 46 in ana_group and 47 in ana_group and 48 in ana_group and 49 in ana_group:
-    
-                            abnormal[temp.bool()] = 1
+
+                            abnormal = temp
 
                             region_direction_names.append(["middle",[[0,"the brain pools and ventricles"]]])
 
                         else:
 
-                            bboxes_ana = sk_regions(sk_label(temp[0]))
-                            temp2 = np.zeros(temp.shape)
+                            temp2 = np.zeros(temp.shape, dtype=bool)
+                            any_hit = False
 
-                            for box in bboxes_ana:
-                                
-                                z1,x1,y1,z2,x2,y2 = box.bbox
+                            for box in sk_regions(sk_label(temp)):
+                                box_slice = self._bbox_slices(box)
 
                                 ## if the ana_group doesn't have any anomalies (probably due to the bad anatomy segmentation)
-                                if len(np.where(np.logical_and(temp[:,z1:z2+1,x1:x2+1,y1:y2+1],a_target[:,z1:z2+1,x1:x2+1,y1:y2+1]))[0]) == 0:
+                                if not np.any(np.logical_and(temp[box_slice], ab_np[box_slice])):
                                     continue
-                                temp2[:,z1:z2+1,x1:x2+1,y1:y2+1] = temp[:,z1:z2+1,x1:x2+1,y1:y2+1]
+                                temp2[box_slice] = temp[box_slice]
+                                any_hit = True
 
-                                ## temp2 pixel wise anatomy ##
-
-                                for idx,box_ab in enumerate(bboxes_ab):
-                                    z1,x1,y1,z2,x2,y2 = box_ab.bbox
-                                    
-                                    # if len(np.where(temp[:,z1:z2+1,x1:x2+1,y1:y2+1])[0]):
-                                    #     abnormal[:,z1:z2+1,x1:x2+1,y1:y2+1] = 1
-                                    hits = np.logical_or(temp[:,z1:z2+1,x1:x2+1,y1:y2+1],np.logical_and(b_target[:,z1:z2+1,x1:x2+1,y1:y2+1]==0,a_target[:,z1:z2+1,x1:x2+1,y1:y2+1])).bool()
-                                    abnormal[:,z1:z2+1,x1:x2+1,y1:y2+1][hits] = 1
+                            ## pixel wise anatomy plus unlabelled anomaly inside the bounding boxes of the anomalies
+                            if any_hit:
+                                abnormal = np.logical_and(ab_box_mask, np.logical_or(temp, unlabelled_ab))
+                            else:
+                                abnormal = np.zeros(temp.shape, dtype=bool)
 
                             abnormal = np.logical_or(abnormal, temp2)
 
+                            pixel_counts = np.bincount(ana_np[np.logical_and(ab_np, abnormal)], minlength=num_labels)
+
                             selected_anas = {}
                             left_flag, right_flag = False, False
                             for the_a in ana_group:
-                                pixels = len(torch.where(np.logical_and(a_target, np.logical_and(b_target==the_a, abnormal)))[0])
+                                pixels = int(pixel_counts[the_a])
                                 if pixels:
                                     cur_a = self.hammer_label_side[str(the_a)]
                                     if cur_a.startswith('left'):
@@ -773,96 +786,38 @@ class Generic_UNet(SegmentationNetwork):
                                 region_direction_names.append(['right',[[selected_anas[ta],ta] for ta in selected_anas]])
                             else:
                                 region_direction_names.append(['middle',[[selected_anas[ta],ta] for ta in selected_anas]])
-                    
-                    abnormal = torch.tensor(abnormal, dtype=torch.float16)
-
-                    abnormal = abnormal.repeat(img_feature.shape[0],1,1,1).to(img_feature.device) # d, z, x, y
-
-                    abnormal_feature = abnormal * img_feature # d, z, x, y
-
-                    for pool_layer in self.pool_conv:
-                        abnormal_feature = pool_layer(abnormal_feature)
-
-                    abnormal_feature = torch.flatten(abnormal_feature,start_dim=1,end_dim=3)
 
-                    abnormal_feature = abnormal_feature.permute(1,0)
+                    region_masks.append(abnormal)
 
-                    final_feature = torch.cat((whole_feature, abnormal_feature), 0)
+            else: # oracle or propmt
 
-                    region_features.append(final_feature)
+                ### get the individual bbox abnormal areas ###
 
-                # del hit_ana_mask
-                # del bboxes_ana
-            else: # oracle or propmt
-            
-                ana_masks = []
                 for ana_group in r:
-                    if ana_group!="global" and ana_group !="mask":
-                        ana_masks.append(np.zeros(b_target.shape))
-                        for ana in ana_group:
-                            ana_masks[-1] = np.logical_or(ana_masks[-1],b_target==ana)
-                    else:
-                        ana_masks.append(a_target)
 
-                ### get the individual bbox abnormal areas ###
-                
-                for idx,ana_group in enumerate(r):
-                    
                     if ana_group == "global":
 
-                        abnormal = np.ones(b_target.shape)
-                    
+                        abnormal = np.ones(ab_np.shape, dtype=bool)
+
                     elif ana_group == "mask":
-                        abnormal = np.zeros(a_target.shape)
 
-                        for box in bboxes_ab:
-                            z1,x1,y1,z2,x2,y2 = box.bbox
-                            abnormal[:,z1:z2+1,x1:x2+1,y1:y2+1] = 1
-                        
-                        # abnormal = np.logical_or(abnormal,a_target)
+                        abnormal = ab_box_mask
 
                     else:
 
-                        abnormal = np.zeros(b_target.shape)
-                        
-                        ### old method begins ###
-                        # for box in bboxes_ab:
-                            
-                        #     z1,x1,y1,z2,x2,y2 = box.bbox
-                            
-                        #     if len(np.where(ana_masks[idx][:,z1:z2+1,x1:x2+1,y1:y2+1])[0]):
-                        #         abnormal[:,z1:z2+1,x1:x2+1,y1:y2+1] = 1
-                        ### old method ends ###
-
-                        for box in bboxes_ab:
-                            z1,x1,y1,z2,x2,y2 = box.bbox
-                            
-                            if len(np.where(ana_masks[idx][:,z1:z2+1,x1:x2+1,y1:y2+1])[0]):
-                                hits = np.logical_or(ana_masks[idx][:,z1:z2+1,x1:x2+1,y1:y2+1],np.logical_and(b_target[:,z1:z2+1,x1:x2+1,y1:y2+1]==0,a_target[:,z1:z2+1,x1:x2+1,y1:y2+1])).bool()
-                                abnormal[:,z1:z2+1,x1:x2+1,y1:y2+1][hits] = 1
-                                
-                                # abnormal[:,max(z1,az1):min(z2+1,az2+1),max(x1,ax1):min(x2+1,ax2+1),max(y1,ay1):min(y2+1,ay2+1)] = 1
-                        
-                        abnormal = np.logical_or(abnormal,ana_masks[idx])
-
-                    abnormal = torch.tensor(abnormal, dtype=torch.float16)
-
-                    abnormal = abnormal.repeat(img_feature.shape[0],1,1,1).to(img_feature.device) # d, z, x, y
+                        ana_mask = np.isin(ana_np, ana_group)
+                        abnormal = np.zeros(ab_np.shape, dtype=bool)
 
-                    abnormal_feature = abnormal * img_feature # d, z, x, y
+                        for box_slice in ab_box_slices:
+                            if np.any(ana_mask[box_slice]):
+                                abnormal[box_slice] |= np.logical_or(ana_mask[box_slice], unlabelled_ab[box_slice])
 
-                    for pool_layer in self.pool_conv:
-                        abnormal_feature = pool_layer(abnormal_feature)
+                        abnormal = np.logical_or(abnormal, ana_mask)
 
-                    abnormal_feature = torch.flatten(abnormal_feature,start_dim=1,end_dim=3)
+                    region_masks.append(abnormal)
 
-                    abnormal_feature = abnormal_feature.permute(1,0)
+            region_features.extend(self._pool_region_features(img_feature, np.stack(region_masks)))
 
-                    final_feature = torch.cat((whole_feature, abnormal_feature), 0)
-
-                    region_features.append(final_feature)
-                
-                del ana_masks
         # print(ao)
 
         return region_features,region_direction_names
@@ -916,8 +871,6 @@ class Generic_UNet(SegmentationNetwork):
                    use_gaussian: bool = False, pad_border_mode: str = "constant",
                    pad_kwargs: dict = None, all_in_gpu: bool = False,
                    verbose: bool = True, mixed_precision: bool = True, modal=None, eval_mode="region_oracle"):
-        
-        torch.cuda.empty_cache()
 
         assert step_size <= 1, 'step_size must be smaller than 1. Otherwise there will be a gap between consecutive ' \
                                'predictions'
@@ -11,6 +11,15 @@ import json
 
 from batchgenerators.utilities.file_and_folder_operations import *
 
+from configuration import default_gpt2_checkpoint, default_attn_implementation
+
+try:
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from torch.ao.quantization import default_dynamic_qconfig
+except ImportError:
+    from torch.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from torch.quantization import default_dynamic_qconfig
+
 
 class Conv1DWithTrainedWeights(nn.Module):
     """
@@ -33,15 +42,178 @@ class Conv1DWithTrainedWeights(nn.Module):
         return x  # x has shape [batch x sequence_len x 3*hidden_dim] for c_attn, shape [batch x sequence_len x hidden_dim] for c_proj
 
 
+def conv1d_to_linear(conv1d):
+    """
+    nn.Linear with the weights of a Conv1D (of transformers or Conv1DWithTrainedWeights), which stores its weight as
+    [in_features x out_features]
+    """
+    in_features, out_features = conv1d.weight.shape
+    linear = nn.Linear(in_features, out_features)
+    linear.weight = nn.Parameter(conv1d.weight.detach().t().contiguous(), requires_grad=False)
+    linear.bias = nn.Parameter(conv1d.bias.detach().clone(), requires_grad=False)
+    return linear
+
+
+def quantize_linear_dynamic(linear):
+    """
+    dynamically quantized copy of linear: int8 weights, the activations are quantized on the fly (CPU only)
+    """
+    linear.qconfig = default_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(linear)
+
+
+class LayerKVCache:
+    """
+    Preallocated key and value buffers of one GPT2PseudoAttention layer for text generation.
+
+    The buffers have shape [batch_size x num_heads x max_tokens x head_dim] and are allocated at the first update.
+    The keys and values of new tokens are written in place at the current length,
+    instead of concatenating them to (and thereby copying) the whole history every decoding step.
+
+    In beam search, the keys and values of the image tokens can be kept as a shared prefix (see set_prefix_) with one row
+    per image instead of one row per beam. The buffers then only hold the word tokens, and reorder_ does not have to move
+    the image keys and values, as all beams of an image share them.
+
+    For continuous batching (see LanguageModel.generate_stream) the buffers have a fixed number of rows (slots): a new
+    sequence is written into a free slot by write_rows_ and update only writes the leading rows that are in use.
+    """
+
+    def __init__(self, max_tokens, max_batch_size=None):
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size  # number of slots allocated by write_rows_
+        self.key = None
+        self.value = None
+        self.length = 0  # number of cached tokens, including a shared prefix
+        self.prefix_key = None
+        self.prefix_value = None
+        self.prefix_length = 0
+
+    def set_prefix_(self, key, value):
+        """
+        Sets the keys and values of the image tokens, shape [num_images x num_heads x img_patch_num x head_dim], that are
+        shared by the num_beams consecutive rows of every image. Has to be called before the first update.
+        """
+        if self.length != 0:
+            raise ValueError("the shared prefix has to be set before any tokens are cached.")
+        self.prefix_key = key
+        self.prefix_value = value
+        self.prefix_length = key.size(-2)
+        self.length = self.prefix_length
+
+    def update(self, key, value):  # key and value have shape [batch_size x num_heads x new_len x head_dim]
+        if self.key is None:
+            buffer_shape = key.shape[:2] + (self.max_tokens - self.prefix_length, key.size(-1))
+            self.key = key.new_empty(buffer_shape)
+            self.value = value.new_empty(buffer_shape)
+
+        new_length = self.length + key.size(-2)
+        if new_length > self.max_tokens:
+            raise ValueError(f"KV cache holds at most {self.max_tokens} tokens, but {new_length} are needed.")
+
+        # the first batch_size rows, all of them unless some trailing slots are free
+        rows = key.size(0)
+        start, end = self.length - self.prefix_length, new_length - self.prefix_length
+        self.key[:rows, :, start:end] = key
+        self.value[:rows, :, start:end] = value
+        self.length = new_length
+
+        # views of the filled part of the buffers (without a shared prefix), shape [batch_size x num_heads x length x head_dim]
+        return self.key[:rows, :, :end], self.value[:rows, :, :end]
+
+    def reorder_(self, index):
+        """
+        Reorders the batch rows in place (e.g. by beam index). index must have batch_size entries.
+        A shared prefix is not reordered, index may only move rows between the beams of the same image.
+        """
+        if self.key is not None:
+            end = self.length - self.prefix_length
+            self.key[:, :, :end] = self.key[:, :, :end].index_select(0, index)
+            self.value[:, :, :end] = self.value[:, :, :end].index_select(0, index)
+
+    def select_(self, index):
+        """
+        Keeps only the batch rows in index (e.g. to remove finished sequences from the batch).
+        """
+        if self.key is not None:
+            self.key = self.key.index_select(0, index)
+            self.value = self.value.index_select(0, index)
+
+    def write_rows_(self, index, key, value):
+        """
+        Writes the first key.size(-2) positions of the slots in index (e.g. the image tokens of sequences that join the
+        batch during generation), in place of the sequences that had these slots before. The later positions of the
+        slots up to length are stale and have to be masked out by the attention mask. An empty cache takes the length of
+        the new rows. The buffers are allocated with max_batch_size zero rows at the first call.
+        """
+        if self.key is None:
+            buffer_shape = (self.max_batch_size,) + key.shape[1:2] + (self.max_tokens, key.size(-1))
+            self.key = key.new_zeros(buffer_shape)
+            self.value = value.new_zeros(buffer_shape)
+
+        self.key[:, :, :key.size(-2)].index_copy_(0, index, key)
+        self.value[:, :, :value.size(-2)].index_copy_(0, index, value)
+        if self.length == 0:
+            self.length = key.size(-2)
+
+    def reset_(self):
+        """
+        Empties the cache and keeps the buffers, their content is overwritten by write_rows_ and update.
+        """
+        self.length = 0
+
+
+class StaticKVCache:
+    """
+    The LayerKVCaches of all GPT2 blocks. Can be passed as past_key_values to LanguageModel.forward.
+    """
+
+    def __init__(self, num_layers, max_tokens, max_batch_size=None):
+        self.layers = [LayerKVCache(max_tokens, max_batch_size) for _ in range(num_layers)]
+
+    @property
+    def length(self):
+        # number of cached tokens (image tokens + word tokens)
+        return self.layers[0].length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def reorder_(self, index):
+        for layer in self.layers:
+            layer.reorder_(index)
+
+    def select_(self, index):
+        for layer in self.layers:
+            layer.select_(index)
+
+    def write_rows_(self, index, keys, values):
+        # keys and values: one tensor per layer, shape [len(index) x num_heads x known_len x head_dim]
+        for layer, key, value in zip(self.layers, keys, values):
+            layer.write_rows_(index, key, value)
+
+    def reset_(self):
+        for layer in self.layers:
+            layer.reset_()
+
+
 class GPT2PseudoAttention(nn.Module):
     def __init__(
         self,
         c_attn_weights_and_bias,  # pre-trained weights and bias for retrieving query, key, value matrices
         c_proj_weights_and_bias,  # pre-trained weights and bias for projecting concatenated heads to original hidden dim
         max_tokens,
+        attn_implementation="eager",  # "eager" or "sdpa", see configuration.default_attn_implementation
     ):
 
         super().__init__()
+        if attn_implementation not in ("eager", "sdpa"):
+            raise ValueError(f"attn_implementation has to be 'eager' or 'sdpa', but is {attn_implementation}.")
+        if attn_implementation == "sdpa" and not hasattr(nn.functional, "scaled_dot_product_attention"):
+            raise RuntimeError("attn_implementation 'sdpa' needs torch >= 2.0")
+        self.attn_implementation = attn_implementation
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         self.c_attn = Conv1DWithTrainedWeights(
@@ -88,6 +260,9 @@ class GPT2PseudoAttention(nn.Module):
         return tensor.permute(0, 2, 1, 3)  # (batch_size, num_heads, seq_len, head_dim)
 
     def _attn(self, query_word, key_image_word, value_image_word, attention_mask):
+        if self.attn_implementation == "sdpa":
+            return self._sdpa_attn(query_word, key_image_word, value_image_word, attention_mask)
+
         attn_weights = torch.matmul(query_word, key_image_word.transpose(-1, -2))  # shape [batch_size x num_heads x seq_len x 1+seq_len]
 
         # scale attention weights
@@ -96,13 +271,16 @@ class GPT2PseudoAttention(nn.Module):
         # create and apply the final causal mask to weights
         query_length, key_length = query_word.size(-2), key_image_word.size(-2)
 
-        # note that this causal mask has a shape of seq_len x 1+seq_len (in the last 2 dims),
-        # with the first column of the mask only consisting of True boolean values
-        # meaning attention weights corresponding to images (which are stored in the first column) are not masked out!
-        causal_mask = self.causal_mask[:, :, key_length - query_length: key_length, :key_length].to(torch.bool)
+        # a single query token (decoding step with a kv cache) is the last row of the causal mask, which attends to everything,
+        # so the mask only has to be applied if there are several query tokens
+        if query_length > 1:
+            # note that this causal mask has a shape of seq_len x 1+seq_len (in the last 2 dims),
+            # with the first column of the mask only consisting of True boolean values
+            # meaning attention weights corresponding to images (which are stored in the first column) are not masked out!
+            causal_mask = self.causal_mask[:, :, key_length - query_length: key_length, :key_length].to(torch.bool)
 
-        # select the attention weights where the causal mask has True values, select -1e4 where the causal mask has False values
-        attn_weights = torch.where(causal_mask, attn_weights, self.mask_out_value.to(attn_weights.dtype))
+            # select the attention weights where the causal mask has True values, select -1e4 where the causal mask has False values
+            attn_weights = torch.where(causal_mask, attn_weights, self.mask_out_value.to(attn_weights.dtype))
 
         # apply the attention mask of shape [batch_size, 1, 1, 1+seq_len] for masking out padding tokens
         # there is an additional column of zeros for the attention weights corresponding to the image,
@@ -119,6 +297,75 @@ class GPT2PseudoAttention(nn.Module):
 
         return attn_output
 
+    def _sdpa_attn(self, query_word, key_image_word, value_image_word, attention_mask):
+        """
+        Same as the eager path of _attn with torch.nn.functional.scaled_dot_product_attention. Instead of slicing the
+        max_tokens x max_tokens causal buffer and adding the mask to the attention weights, a boolean mask of shape
+        [batch_size x 1 x seq_len x img_patch_num+seq_len] is passed: the image tokens (first columns) are always visible,
+        the words are causal and padding tokens are masked out. The masked weights are exactly 0 in both paths, so the
+        outputs agree up to the rounding of the different order of operations.
+        """
+        query_length, key_length = query_word.size(-2), key_image_word.size(-2)
+
+        # attention_mask is 0 for tokens that are attended and -1e4 for padding tokens
+        attn_mask = attention_mask == 0  # shape [batch_size, 1, 1, img_patch_num+seq_len]
+
+        # a single query token (decoding step with a kv cache) attends to everything, see _attn
+        if query_length > 1:
+            # query i is the token at key position key_length - query_length + i, it sees all keys up to that position
+            causal_mask = torch.ones((query_length, key_length), dtype=torch.bool, device=query_word.device)
+            causal_mask = causal_mask.tril(diagonal=key_length - query_length)
+            attn_mask = attn_mask & causal_mask
+
+        return nn.functional.scaled_dot_product_attention(
+            query_word, key_image_word, value_image_word, attn_mask=attn_mask,
+            dropout_p=self.attn_dropout.p if self.training else 0.0)  # shape [batch_size x num_heads x seq_len x head_dim]
+
+    def _attn_shared_prefix(self, query_word, key_image, value_image, key_word, value_word, attention_mask):
+        """
+        Same as _attn on the concatenated image and word keys and values, but the keys and values of the image tokens
+        (shape [num_images x num_heads x img_patch_num x head_dim]) are shared by the num_beams consecutive rows of the
+        word batch. The attention weights are computed separately for the image prefix and the per-beam words and
+        normalized with one softmax over both. Used with both attn_implementations, scaled_dot_product_attention would
+        need the prefix expanded to every beam.
+        """
+        num_images, num_heads, prefix_length, head_dim = key_image.shape
+        batch_size, _, query_length, _ = query_word.shape
+        key_length = key_word.size(-2)
+        num_beams = batch_size // num_images
+
+        # shape [num_images x num_beams x num_heads x seq_len x head_dim], the image keys are broadcasted over the beams
+        query_grouped = query_word.view(num_images, num_beams, num_heads, query_length, head_dim)
+        image_weights = torch.matmul(query_grouped, key_image[:, None].transpose(-1, -2))
+        image_weights = image_weights.view(batch_size, num_heads, query_length, prefix_length)
+        word_weights = torch.matmul(query_word, key_word.transpose(-1, -2))  # shape [batch_size x num_heads x seq_len x seq_len]
+
+        # scale attention weights
+        image_weights = image_weights / (value_word.size(-1) ** 0.5)
+        word_weights = word_weights / (value_word.size(-1) ** 0.5)
+
+        # the image tokens are never masked, the causal mask only applies to the words
+        if query_length > 1:
+            causal_mask = self.causal_mask[:, :, key_length - query_length: key_length, :key_length].to(torch.bool)
+            word_weights = torch.where(causal_mask, word_weights, self.mask_out_value.to(word_weights.dtype))
+
+        # attention_mask has shape [batch_size, 1, 1, img_patch_num+seq_len]
+        attn_weights = torch.cat((image_weights, word_weights), dim=-1) + attention_mask
+
+        attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+
+        # downcast (if necessary) back to V's dtype (if in mixed-precision) -- no-op otherwise
+        attn_weights = attn_weights.type(value_word.dtype)
+        attn_weights = self.attn_dropout(attn_weights)
+
+        image_attn_weights, word_attn_weights = attn_weights.split([prefix_length, key_length], dim=-1)
+        image_attn_weights = image_attn_weights.reshape(num_images, num_beams, num_heads, query_length, prefix_length)
+
+        attn_output = torch.matmul(image_attn_weights, value_image[:, None]).view(batch_size, num_heads, query_length, head_dim)
+        attn_output = attn_output + torch.matmul(word_attn_weights, value_word)  # shape [batch_size x num_heads x seq_len x head_dim]
+
+        return attn_output
+
     def _merge_heads(self, tensor, num_heads, head_dim):
         """
         Merges num_heads (i.e. 16) and head_dim (i.e. 64) into hidden_dim (i.e. 1024)
@@ -127,6 +374,21 @@ class GPT2PseudoAttention(nn.Module):
         new_shape = tensor.size()[:-2] + (num_heads * head_dim,)
         return tensor.view(new_shape)
 
+    def _image_key_value(self, image_hidden_states, batch_size):
+        """
+        Key and value matrices of the image hidden states, each of shape [batch_size x img_patch_num x hidden_dim]
+        """
+        k_image = self.uk(image_hidden_states)  # shape [batch_size x img_patch_num x hidden_dim]
+        v_image = self.uv(image_hidden_states)  # shape [batch_size x img_patch_num x hidden_dim]
+
+        # if the batch_size is different, then we are in beam search generation mode (adjust k and v image matrices accordingly)
+        if k_image.size(0) != batch_size:
+            num_beams = batch_size // k_image.size(0)
+            k_image = k_image.repeat_interleave(num_beams, dim=0)
+            v_image = v_image.repeat_interleave(num_beams, dim=0)
+
+        return k_image, v_image
+
     def forward(self,
                 word_hidden_states,  # shape [batch_size x seq_len x hidden_dim]
                 image_hidden_states,  # shape [batch_size x hidden_dim]
@@ -137,8 +399,35 @@ class GPT2PseudoAttention(nn.Module):
         # query, key, value matrices each have shape [batch_size x seq_len x hidden_dim]
         q_word, k_word, v_word = self.c_attn(word_hidden_states).split(self.split_size, dim=2)
 
+        # text generation with a preallocated kv cache: the keys and values of the new tokens are written into the cache
+        # (together with the keys and values of the image hidden states at the first generation step)
+        if isinstance(layer_past, LayerKVCache):
+            if layer_past.length == 0:
+                if image_hidden_states.size(0) != k_word.size(0):
+                    # beam search: the image keys and values are kept once per image and shared by its beams
+                    layer_past.set_prefix_(
+                        self._split_heads(self.uk(image_hidden_states), self.num_heads, self.head_dim),
+                        self._split_heads(self.uv(image_hidden_states), self.num_heads, self.head_dim))
+                else:
+                    k_image, v_image = self._image_key_value(image_hidden_states, k_word.size(0))
+                    k_word = torch.cat((k_image, k_word), dim=1)  # shape [batch_size x img_patch_num+seq_len x hidden_dim]
+                    v_word = torch.cat((v_image, v_word), dim=1)  # shape [batch_size x img_patch_num+seq_len x hidden_dim]
+
+            q_word = self._split_heads(q_word, self.num_heads, self.head_dim)
+            k_word = self._split_heads(k_word, self.num_heads, self.head_dim)
+            v_word = self._split_heads(v_word, self.num_heads, self.head_dim)
+
+            k, v = layer_past.update(k_word, v_word)  # shape [batch_size x num_heads x cached_len x head_dim]
+
+            present = layer_past
+
+            if layer_past.prefix_key is not None:
+                attn_output = self._attn_shared_prefix(q_word, layer_past.prefix_key, layer_past.prefix_value, k, v, attention_mask)
+            else:
+                attn_output = self._attn(q_word, k, v, attention_mask)  # shape [batch_size x num_heads x seq_len x head_dim]
+
         # if layer_past is None, we are either training the model or generating the first token in text generation mode
-        if layer_past is None:
+        elif layer_past is None:
             # add an addition dimension to the image_hidden_states
 
             # image_hidden_states = image_hidden_states[:, None, :]  # shape [batch_size x 1 x hidden_dim
@@ -149,14 +438,7 @@ class GPT2PseudoAttention(nn.Module):
             if str(image_hidden_states.dtype) != str(self.uk.weight.dtype):
                 pass
 
-            k_image = self.uk(image_hidden_states)  # shape [batch_size x 1 x hidden_dim]
-            v_image = self.uv(image_hidden_states)  # shape [batch_size x 1 x hidden_dim]
-
-            # if the batch_size is different, then we are in beam search generation mode (adjust k and v image matrices accordingly)
-            if k_image.size(0) != k_word.size(0):
-                num_beams = k_word.size(0) // k_image.size(0)
-                k_image = k_image.repeat_interleave(num_beams, dim=0)
-                v_image = v_image.repeat_interleave(num_beams, dim=0)
+            k_image, v_image = self._image_key_value(image_hidden_states, k_word.size(0))
 
             k_image_word = torch.cat((k_image, k_word), dim=1)  # shape [batch_size x 1+seq_len x hidden_dim]
             v_image_word = torch.cat((v_image, v_word), dim=1)  # shape [batch_size x 1+seq_len x hidden_dim]
@@ -205,9 +487,9 @@ class LanguageModel(nn.Module):
     Recommended reading to understand the GPT2 source code: https://amaarora.github.io/2020/02/18/annotatedGPT2.html
     """
 
-    def __init__(self, img_patch_num, max_tokens=1024):
+    def __init__(self, img_patch_num, max_tokens=1024, attn_implementation=default_attn_implementation):
         super().__init__()
-        self.checkpoint = "/home/jason/models/healx-gpt-2-pubmed-medium"
+        self.checkpoint = default_gpt2_checkpoint
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.bos_token_id = 50256
         self.eos_token_id = 50256
@@ -220,6 +502,7 @@ class LanguageModel(nn.Module):
             param.requires_grad = False
         
         self.max_tokens = max_tokens
+        self.attn_implementation = attn_implementation
 
         # replace normal attention layers by pseudo attention layers
         self._replace_attention_by_pseudo_attention()
@@ -241,6 +524,38 @@ class LanguageModel(nn.Module):
         
         self.img_patch_num = img_patch_num
 
+        # see quantize_for_cpu
+        self.quantized = False
+
+    def quantize_for_cpu(self):
+        """
+        CPU inference mode. The projections of GPT2 (c_attn and c_proj of the attention, c_fc and c_proj of the mlp in every
+        block) and the lm_head are replaced by dynamically quantized int8 linear layers, which reduces the memory traffic
+        per decoded token. The pseudo attention projections of the image features (uk, uv), the embeddings and the layer
+        norms stay in float. Inference only, the model is moved to the CPU and changed in place (load the weights first).
+        """
+        self.eval()
+        self.to("cpu")
+        self.device = torch.device("cpu")
+
+        for gpt2_block in self.gpt2_blocks:
+            pseudo_self_attention = gpt2_block[1]
+            pseudo_self_attention.device = self.device
+            pseudo_self_attention.c_attn = quantize_linear_dynamic(conv1d_to_linear(pseudo_self_attention.c_attn))
+            pseudo_self_attention.c_proj = quantize_linear_dynamic(conv1d_to_linear(pseudo_self_attention.c_proj))
+
+            mlp = gpt2_block[3]
+            mlp.c_fc = quantize_linear_dynamic(conv1d_to_linear(mlp.c_fc))
+            mlp.c_proj = quantize_linear_dynamic(conv1d_to_linear(mlp.c_proj))
+
+        # the lm_head is shared with gpt_with_lm_head, it is quantized once. Its weight is tied to the word embeddings,
+        # which stay in float
+        self.lm_head = quantize_linear_dynamic(self.lm_head)
+        self.gpt_with_lm_head.lm_head = self.lm_head
+
+        self.quantized = True
+        return self
+
     def _replace_attention_by_pseudo_attention(self):
         GPT2PSA_list = []
 
@@ -256,7 +571,8 @@ class LanguageModel(nn.Module):
             GPT2PSA = GPT2PseudoAttention(
                 c_attn_weights_and_bias=(c_attn_weights, c_attn_bias),
                 c_proj_weights_and_bias=(c_proj_weights, c_proj_bias),
-                max_tokens = self.max_tokens
+                max_tokens = self.max_tokens,
+                attn_implementation=self.attn_implementation
             )
 
             GPT2PSA_list.append(GPT2PSA)
@@ -311,6 +627,8 @@ class LanguageModel(nn.Module):
         if past_key_values is None:
             past_length = 0
             past_key_values = tuple([None] * len(self.gpt2_blocks))
+        elif isinstance(past_key_values, StaticKVCache):
+            past_length = past_key_values.length
         else:
             past_length = past_key_values[0][0].size(-2)
             
@@ -377,6 +695,10 @@ class LanguageModel(nn.Module):
             if use_cache:
                 presents += (present,)
 
+        # a preallocated kv cache has been updated in place by all layers
+        if use_cache and isinstance(past_key_values, StaticKVCache):
+            presents = past_key_values
+
         word_hidden_states = self.final_layernorm(word_hidden_states)
 
         word_hidden_states = word_hidden_states.view(output_shape)
@@ -424,11 +746,15 @@ class LanguageModel(nn.Module):
                  num_beam_groups: int = 1,
                  do_sample: bool = False,
                  num_return_sequences: int = 1,
-                 early_stopping: bool = False
+                 early_stopping: bool = False,
+                 use_static_cache: bool = True
                  ) -> torch.LongTensor:  # shape [batch_size x longest_generated_sequence_length]
         """
         Generates output ids for a batch of image features.
         These output ids can then be decoded by the tokenizer to get the generated sentences.
+
+        If use_static_cache is True, the keys and values of past tokens are kept in a StaticKVCache that is preallocated
+        for the image tokens plus max_length word tokens, instead of being concatenated every decoding step.
         """
         batch_size = image_hidden_states.size(0)
 
@@ -437,6 +763,10 @@ class LanguageModel(nn.Module):
         model_kwargs = {"attention_mask": torch.ones(size=(batch_size, 1), dtype=torch.int64, device=self.device),
                         "use_cache": True}
 
+        if use_static_cache:
+            max_cached_tokens = self.img_patch_num + max_length if max_length else self.max_tokens
+            model_kwargs["past"] = StaticKVCache(len(self.gpt2_blocks), max_cached_tokens)
+
         is_greedy_gen_mode = (num_beams == 1) and (num_beam_groups == 1) and do_sample is False
         is_sample_gen_mode = (num_beams == 1) and (num_beam_groups == 1) and do_sample is True
         is_beam_gen_mode = (num_beams > 1) and (num_beam_groups == 1) and do_sample is False
@@ -508,11 +838,28 @@ class LanguageModel(nn.Module):
         return input_ids, model_kwargs
 
     def _reorder_cache(self, past, beam_idx):
+        if isinstance(past, StaticKVCache):
+            past.reorder_(beam_idx.to(past.layers[0].key.device))
+            return past
+
         return tuple(
             tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
             for layer_past in past
         )
 
+    def _select_cache_rows(self, past, index):
+        """
+        Keeps only the batch rows in index of the cache (used to remove finished sequences from the batch)
+        """
+        if isinstance(past, StaticKVCache):
+            past.select_(index)
+            return past
+
+        return tuple(
+            tuple(past_state.index_select(0, index.to(past_state.device)) for past_state in layer_past)
+            for layer_past in past
+        )
+
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
         # only use last token for inputs_ids if past is defined in kwargs
         if past:
@@ -632,42 +979,189 @@ class LanguageModel(nn.Module):
                       ) -> torch.LongTensor:  # shape [batch_size x longest_generated_sequence_length]
         batch_size = input_ids.size(0)
         seq_len = input_ids.size(1)
-
-        # keep track of which sequences are already finished
-        # a 1 denotes that a sentence in a batch is unfinished, a 0 denotes that a sentence has finished
-        # finished sentences are padded until all sentences in the batch are finished
-        unfinished_sequences = torch.ones(size=(batch_size,), dtype=torch.int64, device=self.device)
         cur_len = seq_len
 
+        # sequences are removed from the batch as soon as they are finished (i.e. generated the eos token), such that the
+        # transformer and the lm_head only run on unfinished sequences. active_rows holds the original batch index of
+        # every sequence that is still in the batch
+        active_rows = torch.arange(batch_size, device=self.device)
+
+        # generated tokens of every step for the whole batch. Finished sequences are padded with pad tokens,
+        # which are ignored when decoding if skip_special_tokens=True is set
+        generated_tokens = [input_ids]
+
+        # the attention mask is preallocated for all steps and sliced, instead of being extended every step
+        max_total_length = max_length if max_length else self.max_tokens - self.img_patch_num
+        attention_mask = model_kwargs["attention_mask"]
+        attention_mask_buffer = attention_mask.new_ones((batch_size, max(max_total_length, seq_len)))
+        attention_mask_buffer[:, :seq_len] = attention_mask
+
         while True:
+            model_kwargs["attention_mask"] = attention_mask_buffer[:, :cur_len]
             model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
 
             lm_logits, presents = self.forward(**model_inputs, image_hidden_states=image_hidden_states, return_loss=False)
 
-            next_token_logits = lm_logits[:, -1, :]  # of shape [batch_size x vocab_size]
+            next_token_logits = lm_logits[:, -1, :]  # of shape [num_active x vocab_size]
 
             # no need to convert logits into probabilities first (via softmax), argmax can be directly applied to logits
-            next_tokens = torch.argmax(next_token_logits, dim=-1)  # of shape [batch_size]
+            next_tokens = torch.argmax(next_token_logits, dim=-1)  # of shape [num_active]
 
-            # convert next token to padding token if given sentence has already finished (denoted by a 0 in unfinished_sequences)
-            # padding tokens are ignored when decoding, if skip_special_tokens=True is set
-            next_tokens = next_tokens * unfinished_sequences + self.pad_token_id * (1 - unfinished_sequences)
+            # scatter the tokens of the active sequences back to their original slots
+            step_tokens = torch.full((batch_size,), self.pad_token_id, dtype=next_tokens.dtype, device=next_tokens.device)
+            step_tokens[active_rows] = next_tokens
+            generated_tokens.append(step_tokens[:, None])
 
-            # update variables for next step
-            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
-            model_kwargs = self._update_model_kwargs_for_generation(presents, model_kwargs)
+            # update variables for next step (with a kv cache, only the last token is fed to the model)
+            input_ids = next_tokens[:, None]
+            model_kwargs["past"] = presents
             cur_len += 1
 
-            # if eos_token was found in one sentence, set sentence to finished (by converting 1 to 0 for that sentence)
-            binary_mask = (next_tokens != self.eos_token_id).long()
-            unfinished_sequences = unfinished_sequences.mul(binary_mask)
-
-            # stop when all sentences are finished (i.e. all sentences have value 0 in unfinished_sequences),
-            # or if we exceed the maximum length
-            if unfinished_sequences.max() == 0 or (max_length and cur_len >= max_length):
+            # stop if we exceed the maximum length
+            if max_length and cur_len >= max_length:
                 break
 
-        return input_ids
+            # if eos_token was found in one sentence, the sentence is finished and removed from the batch
+            unfinished = next_tokens != self.eos_token_id
+            if not unfinished.all():
+                keep = unfinished.nonzero().squeeze(-1)
+
+                # stop when all sentences are finished
+                if keep.numel() == 0:
+                    break
+
+                active_rows = active_rows[keep]
+                input_ids = input_ids[keep]
+                image_hidden_states = image_hidden_states[keep]
+                attention_mask_buffer = attention_mask_buffer[keep]
+                model_kwargs["past"] = self._select_cache_rows(model_kwargs["past"], keep)
+
+        return torch.cat(generated_tokens, dim=-1)
+
+    def _image_cache_rows(self, image_hidden_states):
+        """
+        Keys and values of the image hidden states in every layer, shape [batch_size x num_heads x img_patch_num x head_dim]
+        """
+        keys, values = [], []
+        for gpt2_block in self.gpt2_blocks:
+            pseudo_self_attention = gpt2_block[1]
+            k_image, v_image = pseudo_self_attention._image_key_value(image_hidden_states, image_hidden_states.size(0))
+            keys.append(pseudo_self_attention._split_heads(k_image, pseudo_self_attention.num_heads, pseudo_self_attention.head_dim))
+            values.append(pseudo_self_attention._split_heads(v_image, pseudo_self_attention.num_heads, pseudo_self_attention.head_dim))
+        return keys, values
+
+    @torch.no_grad()
+    def generate_stream(self,
+                        requests,  # iterable of (key, image_hidden_states of shape [num_rows x img_patch_num x hidden_dim])
+                        max_length: int = 300,
+                        max_batch_size: int = 16,
+                        max_cached_tokens: Optional[int] = None):
+        """
+        Greedy generation with continuous batching over several requests (e.g. the regions of many cases).
+
+        The rows of all requests share one decoding batch of max_batch_size slots: a finished sequence frees its slot after
+        every step and a pending row takes it, instead of decoding every request as its own (often small) batch. The
+        StaticKVCache is allocated once with max_batch_size rows of max_cached_tokens tokens, a joining sequence gets its
+        image keys and values written into its slot (no copy of the other rows), the word positions that were decoded
+        before it joined are masked out and its position ids start at 0, so it generates the same tokens as greedy_search.
+        Only the slots up to the last one in use are decoded.
+
+        Rows only join while the cache has room for max_length more tokens, otherwise the batch is drained and the cache
+        is reset. max_cached_tokens defaults to img_patch_num + 2 * max_length, so rows can join during the first
+        max_length steps; img_patch_num + max_length needs the least memory but only starts new rows on an empty batch.
+
+        Yields (key, output ids of shape [num_rows x longest_generated_sequence_length]) as soon as all rows of a request
+        are finished, so requests can be completed out of order.
+        """
+        requests = iter(requests)
+        if max_cached_tokens is None:
+            max_cached_tokens = self.img_patch_num + 2 * max_length
+        max_word_tokens = max_cached_tokens - self.img_patch_num
+        if max_word_tokens < max_length:
+            raise ValueError(f"max_cached_tokens has to be at least img_patch_num + max_length = {self.img_patch_num + max_length}")
+
+        pending = []  # (request index, row index, image_hidden_states row) of rows that wait for a slot in the batch
+        request_keys = {}
+        request_outputs = {}  # request index -> generated token lists of its rows, None while a row is unfinished
+        requests_exhausted = False
+        next_request = 0
+
+        past = StaticKVCache(len(self.gpt2_blocks), max_cached_tokens, max_batch_size)
+        word_mask = torch.zeros((max_batch_size, max_word_tokens), dtype=torch.int64, device=self.device)  # 1 for the word positions of a row
+        positions = torch.zeros((max_batch_size,), dtype=torch.int64, device=self.device)  # position id of the next token of every row
+        input_ids = torch.zeros((max_batch_size,), dtype=torch.int64, device=self.device)
+        slots = [None] * max_batch_size  # (request index, row index, generated tokens) of the row in every slot, None if free
+
+        while True:
+            # fetch requests until there are enough pending rows to fill the batch
+            while not requests_exhausted and len(pending) < max_batch_size:
+                try:
+                    key, image_hidden_states = next(requests)
+                except StopIteration:
+                    requests_exhausted = True
+                    break
+                request_keys[next_request] = key
+                request_outputs[next_request] = [None] * image_hidden_states.size(0)
+                pending.extend((next_request, row, image_hidden_states[row]) for row in range(image_hidden_states.size(0)))
+                if image_hidden_states.size(0) == 0:
+                    yield request_keys.pop(next_request), torch.zeros((0, 0), dtype=torch.int64, device=self.device)
+                    del request_outputs[next_request]
+                next_request += 1
+
+            free = [i for i, slot in enumerate(slots) if slot is None]
+            if len(free) == max_batch_size:
+                if len(pending) == 0:
+                    return
+                # empty batch: start over at the beginning of the cache
+                past.reset_()
+
+            # let pending rows join if the cache has room for all their tokens
+            cur_word_len = past.length - self.img_patch_num if past.length else 0
+            num_join = min(len(free), len(pending)) if cur_word_len + max_length <= max_word_tokens else 0
+            if num_join > 0:
+                joining, pending = pending[:num_join], pending[num_join:]
+                join_slots = torch.tensor(free[:num_join], dtype=torch.int64, device=self.device)
+                image_hidden_states = torch.stack([row[2] for row in joining]).to(self.device)
+                past.write_rows_(join_slots, *self._image_cache_rows(image_hidden_states))
+
+                word_mask.index_fill_(0, join_slots, 0)
+                input_ids.index_fill_(0, join_slots, self.bos_token_id)
+                positions.index_fill_(0, join_slots, 0)
+                for slot, (request, row, _) in zip(free[:num_join], joining):
+                    slots[slot] = (request, row, [self.bos_token_id])
+
+            # decode the leading slots up to the last one in use, the free slots among them compute unused tokens
+            num_rows = max(i for i, slot in enumerate(slots) if slot is not None) + 1
+            cur_word_len = past.length - self.img_patch_num
+            word_mask[:num_rows, cur_word_len] = 1
+
+            lm_logits, past = self.forward(input_ids=input_ids[:num_rows, None],
+                                           attention_mask=word_mask[:num_rows, :cur_word_len + 1],
+                                           image_hidden_states=None, past_key_values=past,
+                                           position_ids=positions[:num_rows, None], use_cache=True)
+
+            # no need to convert logits into probabilities first (via softmax), argmax can be directly applied to logits
+            input_ids[:num_rows] = torch.argmax(lm_logits[:, -1, :], dim=-1)
+            positions[:num_rows] += 1
+
+            for i, next_token in enumerate(input_ids[:num_rows].tolist()):
+                if slots[i] is None:
+                    continue
+                request, row, tokens = slots[i]
+                tokens.append(next_token)
+                # same stopping criteria as greedy_search: eos or max_length tokens (including the bos token)
+                if next_token != self.eos_token_id and len(tokens) < max_length:
+                    continue
+
+                slots[i] = None
+                outputs = request_outputs[request]
+                outputs[row] = tokens
+                if all(o is not None for o in outputs):
+                    longest = max(len(o) for o in outputs)
+                    output_ids = torch.tensor([o + [self.pad_token_id] * (longest - len(o)) for o in outputs],
+                                              dtype=torch.int64, device=self.device)
+                    del request_outputs[request]
+                    yield request_keys.pop(request), output_ids
 
 
 def print_model_summary(batch_size, seq_len, verbose):
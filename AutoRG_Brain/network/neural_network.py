@@ -14,6 +14,7 @@
 
 
 import numpy as np
+from collections import OrderedDict
 from batchgenerators.augmentations.utils import pad_nd_image
 
 from utilities.to_torch import to_cuda, maybe_to_torch
@@ -24,6 +25,7 @@ from typing import Union, Tuple, List
 
 from torch.amp import autocast
 from utilities.random_stuff import no_op
+from configuration import default_tile_batch_size, TILE_VRAM_BYTES_PER_VOXEL
 
 from batchgenerators.utilities.file_and_folder_operations import *
 
@@ -48,6 +50,13 @@ class NeuralNetwork(nn.Module):
 
 
 class SegmentationNetwork(NeuralNetwork):
+    # This is for saving gaussian importance maps for inference. They weight voxels higher that are closer to the
+    # center. Prediction at the borders are often less accurate and are thus downweighted. Creating these Gaussians
+    # can be expensive, so we keep the most recently used ones in a cache that is shared by all instances (for example
+    # the segmentation and the report network, or networks from different plans)
+    _gaussian_cache = OrderedDict()
+    _gaussian_cache_max_entries = 16
+
     def __init__(self):
         super(NeuralNetwork, self).__init__()
 
@@ -66,18 +75,13 @@ class SegmentationNetwork(NeuralNetwork):
         # to apply in inference. For the most part this will be softmax
         self.inference_apply_nonlin = lambda x: x  # softmax_helper
 
-        # This is for saving a gaussian importance map for inference. It weights voxels higher that are closer to the
-        # center. Prediction at the borders are often less accurate and are thus downweighted. Creating these Gaussians
-        # can be expensive, so it makes sense to save and reuse them.
-        self._gaussian_3d = self._patch_size_for_gaussian_3d = None
-        self._gaussian_2d = self._patch_size_for_gaussian_2d = None
-
     def predict_3D(self, x: np.ndarray, do_mirroring: bool, mirror_axes: Tuple[int, ...] = (0, 1, 2),
                    use_sliding_window: bool = False,
                    step_size: float = 0.5, patch_size: Tuple[int, ...] = None, regions_class_order: Tuple[int, ...] = None,
                    use_gaussian: bool = False, pad_border_mode: str = "constant",
                    pad_kwargs: dict = None, all_in_gpu: bool = False,
-                   verbose: bool = True, mixed_precision: bool = True, modal=None):
+                   verbose: bool = True, mixed_precision: bool = True, modal=None, tile_batch_size: int = None,
+                   half_precision_accumulation: bool = True, return_probabilities: bool = True):
         """
         Use this function to predict a 3D image. It does not matter whether the network is a 2D or 3D U-Net, it will
         detect that automatically and run the appropriate code.
@@ -105,13 +109,18 @@ class SegmentationNetwork(NeuralNetwork):
          behind this is that the segmentation accuracy decreases towards the borders. Default (and recommended): True
         :param pad_border_mode: leave this alone
         :param pad_kwargs: leave this alone
-        :param all_in_gpu: experimental. You probably want to leave this as is it
+        :param all_in_gpu: experimental. If True, the aggregated softmax and weight maps of sliding window prediction are
+        kept as torch tensors on the device of the network and only the results are copied to the host
         :param verbose: Do you want a wall of text? If yes then set this to True
         :param mixed_precision: if True, will run inference in mixed precision with autocast()
+        :param half_precision_accumulation: (Only applies with all_in_gpu) aggregate the predictions in float16
+        :param return_probabilities: if False, the softmax outputs are returned as None and (with all_in_gpu) never
+        leave the device. Use this if you only need the segmentations
+        :param tile_batch_size: (Only applies to 3d sliding window prediction) number of tiles that are predicted as
+        one batch. None means use default_tile_batch_size from configuration.py, values < 1 derive it from the free
+        GPU memory. The result does not depend on this value
         :return:
         """
-        torch.cuda.empty_cache()
-
         assert step_size <= 1, 'step_size must be smaller than 1. Otherwise there will be a gap between consecutive ' \
                                'predictions'
 
@@ -147,7 +156,10 @@ class SegmentationNetwork(NeuralNetwork):
                         res = self._internal_predict_3D_3Dconv_tiled(x, step_size, do_mirroring, mirror_axes, patch_size,
                                                                      regions_class_order, use_gaussian, pad_border_mode,
                                                                      pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu,
-                                                                     verbose=verbose, modal=modal)
+                                                                     verbose=verbose, modal=modal,
+                                                                     tile_batch_size=tile_batch_size,
+                                                                     half_precision_accumulation=half_precision_accumulation,
+                                                                     return_probabilities=return_probabilities)
                     else:
                         res = self._internal_predict_3D_3Dconv(x, patch_size, do_mirroring, mirror_axes, regions_class_order,
                                                                pad_border_mode, pad_kwargs=pad_kwargs, verbose=verbose, modal=modal)
@@ -200,8 +212,6 @@ class SegmentationNetwork(NeuralNetwork):
         :param verbose: Do you want a wall of text? If yes then set this to True
         :return:
         """
-        torch.cuda.empty_cache()
-
         assert step_size <= 1, 'step_size must be smaler than 1. Otherwise there will be a gap between consecutive ' \
                                'predictions'
 
@@ -260,6 +270,36 @@ class SegmentationNetwork(NeuralNetwork):
 
         return gaussian_importance_map
 
+    @classmethod
+    def _get_cached_gaussian(cls, patch_size, sigma_scale=1. / 8, dtype: torch.dtype = None, device=None,
+                             verbose: bool = False):
+        """
+        Returns the gaussian importance map for patch_size from the shared cache, computing it if needed. With
+        dtype=None this is the float32 numpy array from _get_gaussian, otherwise a torch tensor of that dtype on device.
+        The cache is keyed by (patch size, sigma scale, dtype, device) and keeps the most recently used entries
+        """
+        key = (tuple(int(i) for i in patch_size), float(sigma_scale), dtype, device)
+        if key in cls._gaussian_cache:
+            if verbose: print("using precomputed Gaussian")
+            cls._gaussian_cache.move_to_end(key)
+            return cls._gaussian_cache[key]
+
+        if dtype is None:
+            if verbose: print('computing Gaussian')
+            gaussian_importance_map = cls._get_gaussian(patch_size, sigma_scale=sigma_scale)
+        else:
+            gaussian_importance_map = torch.from_numpy(
+                cls._get_cached_gaussian(patch_size, sigma_scale, verbose=verbose)).to(device=device, dtype=dtype)
+
+            # make sure we did not round anything to 0 (relevant for half precision)
+            gaussian_importance_map[gaussian_importance_map == 0] = gaussian_importance_map[
+                gaussian_importance_map != 0].min()
+
+        cls._gaussian_cache[key] = gaussian_importance_map
+        if len(cls._gaussian_cache) > cls._gaussian_cache_max_entries:
+            cls._gaussian_cache.popitem(last=False)
+        return gaussian_importance_map
+
     @staticmethod
     def _compute_steps_for_sliding_window(patch_size: Tuple[int, ...], image_size: Tuple[int, ...], step_size: float) -> List[List[int]]:
         assert [i >= j for i, j in zip(image_size, patch_size)], "image size must be as large or larger than patch_size"
@@ -286,10 +326,44 @@ class SegmentationNetwork(NeuralNetwork):
 
         return steps
 
+    @staticmethod
+    def _get_mirror_flips(mirror_axes: tuple) -> List[Tuple[int, ...]]:
+        """
+        All combinations of the mirror axes as torch.flip dims of a (b, c, x, y, z) tensor, starting with the
+        unflipped input. These are the 2 ** len(mirror_axes) variants we average for test time augmentation
+        """
+        flips = [()]
+        for axis in sorted(mirror_axes, reverse=True):
+            flips += [f + (axis + 2,) for f in flips]
+        return flips
+
+    def _get_tile_batch_size(self, patch_size: Tuple[int, ...], num_tiles: int, tile_batch_size: int = None,
+                             num_mirrors: int = 1) -> int:
+        """
+        Number of sliding window tiles that go through the network in one forward pass. If tile_batch_size is None we
+        use default_tile_batch_size from configuration.py. Values < 1 mean that we derive the batch size from the free
+        GPU memory (on CPU we stay with one tile at a time). Each tile is predicted num_mirrors times in the same
+        forward pass, so this is taken into account as well
+        """
+        if tile_batch_size is None:
+            tile_batch_size = default_tile_batch_size
+
+        if tile_batch_size < 1:
+            if not torch.cuda.is_available() or self.get_device() == "cpu":
+                tile_batch_size = 1
+            else:
+                free_memory, _ = torch.cuda.mem_get_info(self.get_device())
+                bytes_per_tile = np.prod(patch_size, dtype=np.int64) * TILE_VRAM_BYTES_PER_VOXEL * num_mirrors
+                # keep some headroom for the allocator and the accumulation of the results
+                tile_batch_size = int(0.8 * free_memory // bytes_per_tile)
+
+        return int(max(1, min(tile_batch_size, num_tiles)))
+
     def _internal_predict_3D_3Dconv_tiled(self, x: np.ndarray, step_size: float, do_mirroring: bool, mirror_axes: tuple,
                                           patch_size: tuple, regions_class_order: tuple, use_gaussian: bool,
                                           pad_border_mode: str, pad_kwargs: dict, all_in_gpu: bool,
-                                          verbose: bool, modal):
+                                          verbose: bool, modal, tile_batch_size: int = None,
+                                          half_precision_accumulation: bool = True, return_probabilities: bool = True):
         # better safe than sorry
         assert len(x.shape) == 4, "x must be (c, x, y, z)"
 
@@ -306,127 +380,108 @@ class SegmentationNetwork(NeuralNetwork):
         # compute the steps for sliding window
         steps = self._compute_steps_for_sliding_window(patch_size, data_shape[1:], step_size)
         num_tiles = len(steps[0]) * len(steps[1]) * len(steps[2])
+        num_mirrors = len(self._get_mirror_flips(mirror_axes)) if do_mirroring else 1
+        tile_batch_size = self._get_tile_batch_size(patch_size, num_tiles, tile_batch_size, num_mirrors)
 
         if verbose:
             print("data shape:", data_shape)
             print("patch size:", patch_size)
             print("steps (x, y, and z):", steps)
             print("number of tiles:", num_tiles)
+            print("tiles per batch:", tile_batch_size)
 
         # we only need to compute that once. It can take a while to compute this due to the large sigma in
         # gaussian_filter
         if use_gaussian and num_tiles > 1:
-            if self._gaussian_3d is None or not all(
-                    [i == j for i, j in zip(patch_size, self._patch_size_for_gaussian_3d)]):
-                if verbose: print('computing Gaussian')
-                gaussian_importance_map = self._get_gaussian(patch_size, sigma_scale=1. / 8)
-
-                self._gaussian_3d = gaussian_importance_map
-                self._patch_size_for_gaussian_3d = patch_size
-                if verbose: print("done")
-            else:
-                if verbose: print("using precomputed Gaussian")
-                gaussian_importance_map = self._gaussian_3d
-
-            gaussian_importance_map = torch.from_numpy(gaussian_importance_map)
-
             #predict on cpu if cuda not available
-            if torch.cuda.is_available():
-                gaussian_importance_map = gaussian_importance_map.cuda(self.get_device(), non_blocking=True)
-
+            gaussian_device = self.get_device() if torch.cuda.is_available() else "cpu"
+            gaussian_importance_map = self._get_cached_gaussian(patch_size, 1. / 8, torch.float, gaussian_device,
+                                                                verbose=verbose)
         else:
             gaussian_importance_map = None
 
         if all_in_gpu:
             # If we run the inference in GPU only (meaning all tensors are allocated on the GPU, this reduces
-            # CPU-GPU communication but required more GPU memory) we need to preallocate a few things on GPU
+            # CPU-GPU communication but required more GPU memory) we need to preallocate a few things on GPU.
+            # Without cuda the same torch accumulators simply live on the CPU
+            device = self.get_device()
+            accumulator_dtype = torch.half if half_precision_accumulation else torch.float
 
             if use_gaussian and num_tiles > 1:
                 # half precision for the outputs should be good enough. If the outputs here are half, the
-                # gaussian_importance_map should be as well
-                gaussian_importance_map = gaussian_importance_map.half()
-
-                # make sure we did not round anything to 0
-                gaussian_importance_map[gaussian_importance_map == 0] = gaussian_importance_map[
-                    gaussian_importance_map != 0].min()
-
-                add_for_nb_of_preds = gaussian_importance_map
+                # weights we add for the number of predictions should be as well
+                add_for_nb_of_preds = self._get_cached_gaussian(patch_size, 1. / 8, accumulator_dtype, device)
             else:
-                add_for_nb_of_preds = torch.ones(patch_size, device=self.get_device())
+                add_for_nb_of_preds = torch.ones(patch_size, dtype=accumulator_dtype, device=device)
 
-            if verbose: print("initializing result array (on GPU)")
-            aggregated_results = torch.zeros([self.num_classes] + list(data.shape[1:]), dtype=torch.half,
-                                             device=self.get_device())
+            if verbose: print("initializing result arrays (on GPU)")
+            aggregated_results_abnormal = torch.zeros([self.num_classes_abnormal] + list(data.shape[1:]),
+                                                      dtype=accumulator_dtype, device=device)
+            aggregated_results_anatomy = torch.zeros([self.num_classes_anatomy] + list(data.shape[1:]),
+                                                     dtype=accumulator_dtype, device=device)
 
             if verbose: print("moving data to GPU")
-            data = torch.from_numpy(data).cuda(self.get_device(), non_blocking=True)
+            data = torch.from_numpy(data).to(device, non_blocking=True)
 
+            # the weights we add for the number of predictions are the same for all channels of both heads, so a
+            # single map is enough. It is broadcast when we divide below
             if verbose: print("initializing result_numsamples (on GPU)")
-            aggregated_nb_of_predictions = torch.zeros([self.num_classes] + list(data.shape[1:]), dtype=torch.half,
-                                                       device=self.get_device())
+            aggregated_nb_of_predictions = torch.zeros([1] + list(data.shape[1:]), dtype=accumulator_dtype,
+                                                       device=device)
 
         else: # choose this
             if use_gaussian and num_tiles > 1:
-                add_for_nb_of_preds = self._gaussian_3d
+                add_for_nb_of_preds = self._get_cached_gaussian(patch_size, 1. / 8)
             else:
                 add_for_nb_of_preds = np.ones(patch_size, dtype=np.float32)
-            
+
             aggregated_results_abnormal = np.zeros([self.num_classes_abnormal] + list(data.shape[1:]), dtype=np.float32)
-            aggregated_nb_of_predictions_abnormal = np.zeros([self.num_classes_abnormal] + list(data.shape[1:]), dtype=np.float32)
             aggregated_results_anatomy = np.zeros([self.num_classes_anatomy] + list(data.shape[1:]), dtype=np.float32)
-            aggregated_nb_of_predictions_anatomy = np.zeros([self.num_classes_anatomy] + list(data.shape[1:]), dtype=np.float32)
+            aggregated_nb_of_predictions = np.zeros([1] + list(data.shape[1:]), dtype=np.float32)
 
-        for x in steps[0]:
-            lb_x = x
-            ub_x = x + patch_size[0]
-            for y in steps[1]:
-                lb_y = y
-                ub_y = y + patch_size[1]
-                for z in steps[2]:
-                    lb_z = z
-                    ub_z = z + patch_size[2]
+        # same tile order as the nested x/y/z loops. Tiles are gathered into batches of tile_batch_size, predicted in a
+        # single forward pass and then scattered back into the aggregation arrays one by one
+        tiles = [(slice(x, x + patch_size[0]), slice(y, y + patch_size[1]), slice(z, z + patch_size[2]))
+                 for x in steps[0] for y in steps[1] for z in steps[2]]
 
-                    # a={}
-                    # a["data"]=list(data[None, :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z].shape)
+        for batch_start in range(0, num_tiles, tile_batch_size):
+            batch_tiles = tiles[batch_start:batch_start + tile_batch_size]
 
-                    predicted_patches = self._internal_maybe_mirror_and_pred_3D(
-                        data[None, :, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z], mirror_axes, do_mirroring,
-                        gaussian_importance_map, modal=modal)
+            if all_in_gpu:
+                batch_data = torch.stack([data[(slice(None),) + t] for t in batch_tiles])
+            else:
+                batch_data = np.stack([data[(slice(None),) + t] for t in batch_tiles])
 
-                    predicted_patch_abnormal, predicted_patch_anatomy = predicted_patches[0], predicted_patches[1]
-                    # a["predicted_patch_ab_shape2"]=list(predicted_patch_abnormal.shape)
-                    # a["predicted_patch_ana_shape2"]=list(predicted_patch_anatomy.shape)
+            predicted_patches = self._internal_maybe_mirror_and_pred_3D(
+                batch_data, mirror_axes, do_mirroring, gaussian_importance_map, modal=modal)
 
-                    if all_in_gpu:
-                        predicted_patch_abnormal = predicted_patch_abnormal.half()
-                        predicted_patch_anatomy = predicted_patch_anatomy.half()
-                    else:
-                        predicted_patch_abnormal = predicted_patch_abnormal.cpu().numpy()
-                        predicted_patch_anatomy = predicted_patch_anatomy.cpu().numpy()
+            predicted_patch_abnormal, predicted_patch_anatomy = predicted_patches[0], predicted_patches[1]
 
-                    aggregated_results_abnormal[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += predicted_patch_abnormal[0]
-                    aggregated_nb_of_predictions_abnormal[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add_for_nb_of_preds
-                    aggregated_results_anatomy[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += predicted_patch_anatomy[0]
-                    aggregated_nb_of_predictions_anatomy[:, lb_x:ub_x, lb_y:ub_y, lb_z:ub_z] += add_for_nb_of_preds
+            if all_in_gpu:
+                predicted_patch_abnormal = predicted_patch_abnormal.to(accumulator_dtype)
+                predicted_patch_anatomy = predicted_patch_anatomy.to(accumulator_dtype)
+            else:
+                predicted_patch_abnormal = predicted_patch_abnormal.cpu().numpy()
+                predicted_patch_anatomy = predicted_patch_anatomy.cpu().numpy()
 
-        # we reverse the padding here (remeber that we padded the input to be at least as large as the patch size
-        slicer_abnormal = tuple(
-            [slice(0, aggregated_results_abnormal.shape[i]) for i in
-             range(len(aggregated_results_abnormal.shape) - (len(slicer) - 1))] + slicer[1:])
-        aggregated_results_abnormal = aggregated_results_abnormal[slicer_abnormal]
-        aggregated_nb_of_predictions_abnormal = aggregated_nb_of_predictions_abnormal[slicer_abnormal]
+            for b, t in enumerate(batch_tiles):
+                t = (slice(None),) + t
+                aggregated_results_abnormal[t] += predicted_patch_abnormal[b]
+                aggregated_results_anatomy[t] += predicted_patch_anatomy[b]
+                aggregated_nb_of_predictions[t] += add_for_nb_of_preds
 
-        slicer_anatomy = tuple(
+        # we reverse the padding here (remeber that we padded the input to be at least as large as the patch size
+        slicer = tuple(
             [slice(0, aggregated_results_anatomy.shape[i]) for i in
              range(len(aggregated_results_anatomy.shape) - (len(slicer) - 1))] + slicer[1:])
-        aggregated_results_anatomy = aggregated_results_anatomy[slicer_anatomy]
-        aggregated_nb_of_predictions_anatomy = aggregated_nb_of_predictions_anatomy[slicer_anatomy]
+        aggregated_results_abnormal = aggregated_results_abnormal[slicer]
+        aggregated_results_anatomy = aggregated_results_anatomy[slicer]
+        aggregated_nb_of_predictions = aggregated_nb_of_predictions[slicer]
 
         # computing the class_probabilities by dividing the aggregated result with result_numsamples
-        aggregated_results_abnormal /= aggregated_nb_of_predictions_abnormal
-        aggregated_results_anatomy /= aggregated_nb_of_predictions_anatomy
-        del aggregated_nb_of_predictions_abnormal
-        del aggregated_nb_of_predictions_anatomy
+        aggregated_results_abnormal /= aggregated_nb_of_predictions
+        aggregated_results_anatomy /= aggregated_nb_of_predictions
+        del aggregated_nb_of_predictions
 
         if regions_class_order is None:
             predicted_segmentation_abnormal = aggregated_results_abnormal.argmax(0)
@@ -438,7 +493,7 @@ class SegmentationNetwork(NeuralNetwork):
             else:
                 class_probabilities_here_abnormal = aggregated_results_abnormal
                 class_probabilities_here_anatomy = aggregated_results_anatomy
-            
+
             predicted_segmentation_abnormal = np.zeros(class_probabilities_here_abnormal.shape[1:], dtype=np.float32)
             for i, c in enumerate(regions_class_order):
                 predicted_segmentation_abnormal[class_probabilities_here_abnormal[i] > 0.5] = c
@@ -454,8 +509,13 @@ class SegmentationNetwork(NeuralNetwork):
                 predicted_segmentation_abnormal = predicted_segmentation_abnormal.detach().cpu().numpy()
                 predicted_segmentation_anatomy = predicted_segmentation_anatomy.detach().cpu().numpy()
 
-            aggregated_results_abnormal = aggregated_results_abnormal.detach().cpu().numpy()
-            aggregated_results_anatomy = aggregated_results_anatomy.detach().cpu().numpy()
+            # only the probabilities that were asked for leave the device (as float32, like the numpy path)
+            if return_probabilities:
+                aggregated_results_abnormal = aggregated_results_abnormal.detach().cpu().float().numpy()
+                aggregated_results_anatomy = aggregated_results_anatomy.detach().cpu().float().numpy()
+
+        if not return_probabilities:
+            aggregated_results_abnormal = aggregated_results_anatomy = None
 
         if verbose: print("prediction done")
         return predicted_segmentation_abnormal, aggregated_results_abnormal, predicted_segmentation_anatomy, aggregated_results_anatomy
@@ -560,16 +620,9 @@ class SegmentationNetwork(NeuralNetwork):
         #   we now return a cuda tensor! Not numpy array!
 
         x = maybe_to_torch(x)
-        
-        result_torch_abnormal = torch.zeros([1, self.num_classes_abnormal] + list(x.shape[2:]),
-                                   dtype=torch.float)
-        result_torch_anatomy = torch.zeros([1, self.num_classes_anatomy] + list(x.shape[2:]),
-                                   dtype=torch.float)
 
         if torch.cuda.is_available():
             x = to_cuda(x, gpu_id=self.get_device())
-            result_torch_abnormal = result_torch_abnormal.cuda(self.get_device(), non_blocking=True)
-            result_torch_anatomy = result_torch_anatomy.cuda(self.get_device(), non_blocking=True)
 
         if mult is not None:
             mult = maybe_to_torch(mult)
@@ -577,71 +630,27 @@ class SegmentationNetwork(NeuralNetwork):
                 mult = to_cuda(mult, gpu_id=self.get_device())
 
         if do_mirroring: # choose this
-            mirror_idx = 8
-            num_results = 2 ** len(mirror_axes)
+            flips = self._get_mirror_flips(mirror_axes)
         else:
-            mirror_idx = 1
-            num_results = 1
-
-        for m in range(mirror_idx):
-            # pred_ana, pred_ab = self(x)
-            # patch_size 112,128,112
-            # pred_ana.shape 1,96,patch_size pred_ab.shape 1,2,patch_size
-            if m == 0:
-                pred_ana, pred_ab = self(x, modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * pred_ab
-                result_torch_anatomy += 1 / num_results * pred_ana
-
-            if m == 1 and (2 in mirror_axes):
-                pred_ana, pred_ab = self(torch.flip(x, (4, )), modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * torch.flip(pred_ab, (4,))
-                result_torch_anatomy += 1 / num_results * torch.flip(pred_ana, (4,))
-
-            if m == 2 and (1 in mirror_axes):
-                pred_ana, pred_ab = self(torch.flip(x, (3, )), modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * torch.flip(pred_ab, (3,))
-                result_torch_anatomy += 1 / num_results * torch.flip(pred_ana, (3,))
-
-            if m == 3 and (2 in mirror_axes) and (1 in mirror_axes):
-                pred_ana, pred_ab = self(torch.flip(x, (4, 3)), modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * torch.flip(pred_ab, (4, 3))
-                result_torch_anatomy += 1 / num_results * torch.flip(pred_ana, (4, 3))
-
-            if m == 4 and (0 in mirror_axes):
-                pred_ana, pred_ab = self(torch.flip(x, (2, )), modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * torch.flip(pred_ab, (2,))
-                result_torch_anatomy += 1 / num_results * torch.flip(pred_ana, (2,))
-
-            if m == 5 and (0 in mirror_axes) and (2 in mirror_axes):
-                pred_ana, pred_ab = self(torch.flip(x, (4, 2)), modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * torch.flip(pred_ab, (4, 2))
-                result_torch_anatomy += 1 / num_results * torch.flip(pred_ana, (4, 2))
-
-            if m == 6 and (0 in mirror_axes) and (1 in mirror_axes):
-                pred_ana, pred_ab = self(torch.flip(x, (3, 2)), modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * torch.flip(pred_ab, (3, 2))
-                result_torch_anatomy += 1 / num_results * torch.flip(pred_ana, (3, 2))
-
-            if m == 7 and (0 in mirror_axes) and (1 in mirror_axes) and (2 in mirror_axes):
-                pred_ana, pred_ab = self(torch.flip(x, (4, 3, 2)), modal=modal)
-                pred_ana = self.inference_apply_nonlin(pred_ana)
-                pred_ab = self.inference_apply_nonlin(pred_ab)
-                result_torch_abnormal += 1 / num_results * torch.flip(pred_ab, (4, 3, 2))
-                result_torch_anatomy += 1 / num_results * torch.flip(pred_ana, (4, 3, 2))
+            flips = [()]
+
+        # all mirrored variants are stacked along the batch axis and predicted in a single forward pass
+        # pred_ana.shape (num_flips * b, 96, patch_size) pred_ab.shape (num_flips * b, 2, patch_size)
+        b = x.shape[0]
+        pred_ana, pred_ab = self(torch.cat([torch.flip(x, f) if len(f) else x for f in flips]), modal=modal)
+        pred_ana = self.inference_apply_nonlin(pred_ana)
+        pred_ab = self.inference_apply_nonlin(pred_ab)
+        pred_ana = pred_ana.view(len(flips), b, *pred_ana.shape[1:])
+        pred_ab = pred_ab.view(len(flips), b, *pred_ab.shape[1:])
+
+        # undo the flips in place, then average over all variants in one reduction
+        for i, f in enumerate(flips):
+            if len(f):
+                pred_ana[i] = torch.flip(pred_ana[i], f)
+                pred_ab[i] = torch.flip(pred_ab[i], f)
+
+        result_torch_abnormal = pred_ab.mean(0, dtype=torch.float)
+        result_torch_anatomy = pred_ana.mean(0, dtype=torch.float)
 
         if mult is not None:
             result_torch_abnormal[:, :] *= mult
@@ -729,20 +738,9 @@ class SegmentationNetwork(NeuralNetwork):
         # we only need to compute that once. It can take a while to compute this due to the large sigma in
         # gaussian_filter
         if use_gaussian and num_tiles > 1:
-            if self._gaussian_2d is None or not all(
-                    [i == j for i, j in zip(patch_size, self._patch_size_for_gaussian_2d)]):
-                if verbose: print('computing Gaussian')
-                gaussian_importance_map = self._get_gaussian(patch_size, sigma_scale=1. / 8)
-
-                self._gaussian_2d = gaussian_importance_map
-                self._patch_size_for_gaussian_2d = patch_size
-            else:
-                if verbose: print("using precomputed Gaussian")
-                gaussian_importance_map = self._gaussian_2d
-
-            gaussian_importance_map = torch.from_numpy(gaussian_importance_map)
-            if torch.cuda.is_available():
-                gaussian_importance_map = gaussian_importance_map.cuda(self.get_device(), non_blocking=True)
+            gaussian_device = self.get_device() if torch.cuda.is_available() else "cpu"
+            gaussian_importance_map = self._get_cached_gaussian(patch_size, 1. / 8, torch.float, gaussian_device,
+                                                                verbose=verbose)
 
         else:
             gaussian_importance_map = None
@@ -753,12 +751,8 @@ class SegmentationNetwork(NeuralNetwork):
 
             if use_gaussian and num_tiles > 1:
                 # half precision for the outputs should be good enough. If the outputs here are half, the
-                # gaussian_importance_map should be as well
-                gaussian_importance_map = gaussian_importance_map.half()
-
-                # make sure we did not round anything to 0
-                gaussian_importance_map[gaussian_importance_map == 0] = gaussian_importance_map[
-                    gaussian_importance_map != 0].min()
+                # gaussian_importance_map should be as well (the cached half map has no values rounded to 0)
+                gaussian_importance_map = self._get_cached_gaussian(patch_size, 1. / 8, torch.half, gaussian_device)
 
                 add_for_nb_of_preds = gaussian_importance_map
             else:
@@ -776,7 +770,7 @@ class SegmentationNetwork(NeuralNetwork):
                                                        device=self.get_device())
         else:
             if use_gaussian and num_tiles > 1:
-                add_for_nb_of_preds = self._gaussian_2d
+                add_for_nb_of_preds = self._get_cached_gaussian(patch_size, 1. / 8)
             else:
                 add_for_nb_of_preds = np.ones(patch_size, dtype=np.float32)
             aggregated_results = np.zeros([self.num_classes] + list(data.shape[1:]), dtype=np.float32)
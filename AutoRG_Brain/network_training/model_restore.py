@@ -13,6 +13,7 @@
 #    limitations under the License.
 
 import torch
+from collections import OrderedDict
 from batchgenerators.utilities.file_and_folder_operations import *
 import importlib
 import pkgutil
@@ -99,6 +100,58 @@ def load_model_and_checkpoint_files(folder, mixed_precision=None, checkpoint_nam
     all_params = [torch.load(i, map_location=torch.device('cpu'), weights_only=False) for i in all_best_model_files]
     return trainer, all_params
 
+# only needed to resume training
+_TRAINING_CHECKPOINT_KEYS = ('optimizer_state_dict', 'lr_scheduler_state_dict', 'plot_stuff', 'amp_grad_scaler')
+
+
+class CheckpointPool(object):
+    def __init__(self, trainer, params, pin_memory=False):
+        """
+        holds the checkpoints returned by load_model_and_checkpoint_files(_llm) for a whole prediction run. The
+        optimizer state is dropped and the weights can be pinned for faster host to device copies. activate() only
+        loads weights into the trainer if another checkpoint is requested, so a single checkpoint is loaded once per
+        run and an ensemble of n checkpoints swaps n - 1 times per case.
+        :param pin_memory: pin the weights in host memory (ignored without cuda)
+        """
+        self.trainer = trainer
+        pin_memory = pin_memory and torch.cuda.is_available()
+        self.params = [self._prepare(p, pin_memory) for p in params]
+        self.active = None
+
+    @staticmethod
+    def _prepare(checkpoint, pin_memory):
+        checkpoint = {k: v for k, v in checkpoint.items() if k not in _TRAINING_CHECKPOINT_KEYS}
+        if pin_memory:
+            for k, v in checkpoint.items():
+                if isinstance(v, dict):
+                    checkpoint[k] = OrderedDict((name, t.pin_memory() if isinstance(t, torch.Tensor) else t)
+                                                for name, t in v.items())
+        return checkpoint
+
+    def __len__(self):
+        return len(self.params)
+
+    def activate(self, idx):
+        if self.active != idx:
+            self.trainer.load_checkpoint_ram(self.params[idx], False)
+            self.active = idx
+        return self.trainer
+
+    def iterate(self):
+        """
+        yields the trainer with each checkpoint loaded, starting with the one that is already active
+        """
+        start = self.active if self.active is not None else 0
+        for i in range(len(self.params)):
+            yield self.activate((start + i) % len(self.params))
+
+
+def load_checkpoint_pool(folder, mixed_precision=None, checkpoint_name="model_best", pin_memory=False, llm=False):
+    load_fn = load_model_and_checkpoint_files_llm if llm else load_model_and_checkpoint_files
+    trainer, params = load_fn(folder, mixed_precision=mixed_precision, checkpoint_name=checkpoint_name)
+    return CheckpointPool(trainer, params, pin_memory)
+
+
 def load_model_and_checkpoint_files_llm(folder, mixed_precision=None, checkpoint_name="model_best"):
     
     trainer = restore_model_llm(join(folder, "%s.model.pkl" % checkpoint_name), fp16=mixed_precision)
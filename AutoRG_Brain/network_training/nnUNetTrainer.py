@@ -449,7 +449,8 @@ class nnUNetTrainer(NetworkTrainer):
                                                          use_sliding_window: bool = True, step_size: float = 0.5,
                                                          use_gaussian: bool = True, pad_border_mode: str = 'constant',
                                                          pad_kwargs: dict = None, all_in_gpu: bool = False,
-                                                         verbose: bool = True, mixed_precision: bool = True):
+                                                         verbose: bool = True, mixed_precision: bool = True,
+                                                         return_probabilities: bool = True):
         """
         :param data:
         :param do_mirroring:
@@ -461,6 +462,7 @@ class nnUNetTrainer(NetworkTrainer):
         :param pad_kwargs:
         :param all_in_gpu:
         :param verbose:
+        :param return_probabilities: if False only the segmentations are returned, the softmax slots are None
         :return:
         """
         if pad_border_mode == 'constant' and pad_kwargs is None:
@@ -483,7 +485,7 @@ class nnUNetTrainer(NetworkTrainer):
                                       patch_size=self.patch_size, regions_class_order=self.regions_class_order,
                                       use_gaussian=use_gaussian, pad_border_mode=pad_border_mode,
                                       pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu, verbose=verbose,
-                                      mixed_precision=mixed_precision)
+                                      mixed_precision=mixed_precision, return_probabilities=return_probabilities)
         self.network.train(current_mode)
         return ret
 
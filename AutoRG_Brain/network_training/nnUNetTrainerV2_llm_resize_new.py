@@ -13,8 +13,9 @@
 #    limitations under the License.
 
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from typing import Tuple
+import hashlib
 import numpy as np
 import torch
 from sklearn.model_selection import KFold
@@ -65,7 +66,11 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 
 # dataloader
 from dataset.dataset_loading_llm import load_dataset, DataLoader3D, unpack_dataset
-from dataset.dataset_loading_llm_bucket_resize_new import load_dataset_bucket, DataLoader3D_bucket, unpack_dataset_bucket
+from dataset.dataset_loading_llm_bucket_resize_new import load_dataset_bucket, DataLoader3D_bucket, unpack_dataset_bucket, \
+    convert_to_resized_cache
+from dataset.feature_cache import DataLoaderFeatures, create_feature_cache, finalize_feature_cache, \
+    load_feature_cache_index
+from dataset.report_tokens import ReportTokens
 
 # utils
 from utilities.nd_softmax import softmax_helper, cal_dice
@@ -78,6 +83,7 @@ import SimpleITK as sitk
 
 ## llm
 from transformers import GPT2Tokenizer
+from configuration import default_gpt2_checkpoint
 from network.language_model_patchwise import LanguageModel as LanguageModel_patch
 from utilities.llm_metric import *
 
@@ -88,7 +94,9 @@ class nnUNetTrainerV2(nnUNetTrainer):
 
     def __init__(self, plans_file, fold, train_file, only_ana=False, abnormal_type="intense", num_batches_per_epoch=250, num_val_batches_per_epoch=50, output_folder=None, dataset_directory=None, batch_dice=True, stage=None,
                  unpack_data=True, deterministic=True, fp16=False, network_type="normal",feature_layer=3,dataset_directory_bucket=None,
-                 train_with_seg=False,avg_type='xyz',pool_to_feature_layer=None,use_conv_pool=False,use_global=True,size=4,dataset="six",max_tokens = 1024):
+                 train_with_seg=False,avg_type='xyz',pool_to_feature_layer=None,use_conv_pool=False,use_global=True,size=4,dataset="six",max_tokens = 1024,
+                 use_feature_cache=False, use_resized_cache=False, online_eval_fraction=0.1, online_eval_heldout=False,
+                 online_eval_window=50):
         super().__init__(plans_file, fold, output_folder, dataset_directory, batch_dice, stage, unpack_data,
                          deterministic, fp16)
         self.max_num_epochs = 1000
@@ -97,7 +105,8 @@ class nnUNetTrainerV2(nnUNetTrainer):
         self.ds_loss_weights = None
 
         self.init_args = (plans_file, fold, train_file, only_ana, abnormal_type, num_batches_per_epoch, num_val_batches_per_epoch, output_folder, dataset_directory, batch_dice, stage, 
-        unpack_data, deterministic, fp16, network_type, feature_layer,dataset_directory_bucket,train_with_seg,avg_type,pool_to_feature_layer,use_conv_pool,use_global,size,dataset,max_tokens)
+        unpack_data, deterministic, fp16, network_type, feature_layer,dataset_directory_bucket,train_with_seg,avg_type,pool_to_feature_layer,use_conv_pool,use_global,size,dataset,max_tokens,
+        use_feature_cache, use_resized_cache, online_eval_fraction, online_eval_heldout, online_eval_window)
         
         self.epoch_rouges = []
         self.epoch_bleus = []
@@ -117,6 +126,8 @@ class nnUNetTrainerV2(nnUNetTrainer):
         self.train_file = json.load(open(train_file,'r')) if train_file is not None else None
         self.test_file = self.train_file['validation'] if train_file is not None else None
         self.report = self.train_file['region_report'] if train_file is not None else None
+        # token ids of all report phrases, built by get_report_tokens
+        self.report_tokens = None
 
         self.metric = ['rouge','bleu','f1']
         self.all_val_eval_metrics = {i:[] for i in self.metric}
@@ -166,8 +177,24 @@ class nnUNetTrainerV2(nnUNetTrainer):
         self.train_eval_epoch = 500
         self.val_eval_epoch = 5
 
+        # report generation for the online evaluation costs more than a training step. It only runs on every
+        # round(1 / online_eval_fraction)-th iteration of an evaluation epoch or, with online_eval_heldout, once per
+        # evaluation epoch on a fixed training and a fixed validation batch. The reported metrics are averages over the
+        # last online_eval_window evaluated batches
+        self.online_eval_fraction = online_eval_fraction
+        self.online_eval_heldout = online_eval_heldout
+        self.online_eval_window = online_eval_window
+        self.online_eval_scores = {"train": deque(maxlen=online_eval_window), "val": deque(maxlen=online_eval_window)}
+        self.online_eval_batches = {"train": None, "val": None}
+
         self.max_tokens = max_tokens
 
+        # train pool_conv and the language model on cached backbone features, see extract_frozen_features
+        self.use_feature_cache = use_feature_cache
+        self.feature_cache_folder = join(self.output_folder, "feature_cache")
+        # store the cases of the bucket loader resized to the patch size, see convert_to_resized_cache
+        self.use_resized_cache = use_resized_cache
+
     def setup_seed(self,seed):
         torch.manual_seed(seed)
         torch.cuda.manual_seed_all(seed)
@@ -200,17 +227,35 @@ class nnUNetTrainerV2(nnUNetTrainer):
                                 pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
         return dl_tr, dl_val
 
+    def get_resized_cache_folder(self):
+        if not self.use_resized_cache:
+            return None
+        return join(self.folder_with_preprocessed_data, "resized_%s" % "x".join(str(i) for i in self.patch_size))
+
     def get_basic_generators_bucket(self):
         self.load_dataset_bucket()
         self.do_split()
+        resized_cache_folder = self.get_resized_cache_folder()
         dl_tr = DataLoader3D_bucket(self.dataset_tr, self.basic_generator_patch_size, self.patch_size, self.batch_size, report=self.report["training"],
                                 has_prev_stage=True, oversample_foreground_percent=self.oversample_foreground_percent,
-                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r',client=self.client,dataset=self.mode)
+                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r',client=self.client,dataset=self.mode,
+                                resized_cache_folder=resized_cache_folder)
         dl_val = DataLoader3D_bucket(self.dataset_val, self.patch_size, self.patch_size, self.batch_size, report=self.report["validation"],
                                 has_prev_stage=True,oversample_foreground_percent=self.oversample_foreground_percent,
-                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r',client=self.client,dataset=self.mode)
+                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r',client=self.client,dataset=self.mode,
+                                resized_cache_folder=resized_cache_folder)
         return dl_tr, dl_val
 
+    def get_keys_modal(self):
+        """
+        :return: modal -> keys of the training and validation cases of the bucket loaders
+        """
+        keys_modal = OrderedDict()
+        for dl in (self.dl_tr, self.dl_val):
+            for modal, keys in dl.list_of_keys_modal.items():
+                keys_modal.setdefault(modal, []).extend(keys)
+        return keys_modal
+
     def initialize(self, training=True, force_load_plans=False, no_aug=False):
         """
         - replaced get_default_augmentation with get_moreDA_augmentation
@@ -267,6 +312,11 @@ class nnUNetTrainerV2(nnUNetTrainer):
             
             ############## prepare test imgs and segs #############
 
+            if self.use_feature_cache:
+                assert no_aug and not self.train_with_seg and self.dataset_directory_bucket is not None, \
+                    "the feature cache needs a frozen backbone and the resized cases of the --bucket loader without " \
+                    "augmentation (--no_aug)"
+
             if training:
                 if self.dataset_directory_bucket is None:
                     self.dl_tr, self.dl_val = self.get_basic_generators()
@@ -280,13 +330,19 @@ class nnUNetTrainerV2(nnUNetTrainer):
                     else:
                         # the data is on the bucket
                         unpack_dataset_bucket(self.folder_with_preprocessed_data, self.folder_with_preprocessed_data_bucket, train_file = self.train_file, client=self.client)
+                        if self.use_resized_cache:
+                            convert_to_resized_cache(self.get_resized_cache_folder(), self.dataset, self.get_keys_modal(),
+                                                     self.patch_size, client=self.client)
                     print("done")
                 else:
                     print(
                         "INFO: Not unpacking data! Training may be slow due to that. Pray you are not using 2d or you "
                         "will wait all winter for your model to finish!")
 
-                if no_aug:
+                if self.use_feature_cache:
+                    # the features can only be computed once the pretrained backbone is loaded, see run_training
+                    self.tr_gen, self.val_gen = None, None
+                elif no_aug:
                     self.tr_gen, self.val_gen = get_moreDA_augmentation_noaug(
                         self.dl_tr, self.dl_val,
                         self.data_aug_params[
@@ -324,8 +380,70 @@ class nnUNetTrainerV2(nnUNetTrainer):
             self.print_to_log_file('self.was_initialized is True, not running self.initialize again')
         self.was_initialized = True
     
+    def get_backbone_fingerprint(self):
+        md5 = hashlib.md5()
+        for name, value in self.network.state_dict().items():
+            if not name.startswith("pool_conv"):
+                md5.update(name.encode('utf-8'))
+                md5.update(value.detach().cpu().numpy().tobytes())
+        return md5.hexdigest()
+
+    def extract_frozen_features(self):
+        """
+        runs the frozen backbone (network.encode) once per case and stores the features and the downsampled targets in
+        self.feature_cache_folder (see dataset/feature_cache.py). An existing cache is reused if it was computed with
+        the same backbone weights, feature layer and patch size
+        """
+        key_modal = OrderedDict()
+        for modal, keys in self.get_keys_modal().items():
+            for k in keys:
+                key_modal[k] = modal
+
+        fingerprint = self.get_backbone_fingerprint()
+        index = load_feature_cache_index(self.feature_cache_folder)
+        if index is not None and index['fingerprint'] == fingerprint and index['feature_layer'] == self.feature_layer \
+                and tuple(index['patch_size']) == tuple(self.patch_size) and all(k in index['rows'] for k in key_modal):
+            self.print_to_log_file("using the backbone features cached in", self.feature_cache_folder)
+            return
+
+        self.print_to_log_file("extracting the backbone features of %d cases" % len(key_modal))
+        self.network.eval()
+        features, targets = None, None
+        with torch.no_grad():
+            for row, (k, modal) in enumerate(key_modal.items()):
+                dl = self.dl_tr if k in self.dataset_tr else self.dl_val
+                data, seg = dl.get_resized_case(k, modal)
+                seg[seg == -1] = 0 # RemoveLabelTransform(-1, 0) of the training pipeline
+
+                data = maybe_to_torch(data[None])
+                target = maybe_to_torch(seg[None])
+                if torch.cuda.is_available():
+                    data = to_cuda(data)
+
+                with autocast(enabled=self.fp16):
+                    feature, target = self.network.encode(data, target, modal)
+
+                if features is None:
+                    features, targets = create_feature_cache(self.feature_cache_folder, len(key_modal),
+                                                             feature.shape[1:], target.shape[1:])
+                features[row] = feature[0].float().cpu().numpy()
+                targets[row] = target[0].cpu().numpy()
+
+        finalize_feature_cache(self.feature_cache_folder, features, targets,
+                               {'rows': {k: row for row, k in enumerate(key_modal)}, 'modal': key_modal,
+                                'fingerprint': fingerprint, 'feature_layer': self.feature_layer,
+                                'patch_size': tuple(self.patch_size)})
+
+    def get_feature_generators(self):
+        dl_tr = DataLoaderFeatures(self.dataset_tr, self.feature_cache_folder, self.batch_size, report=self.report["training"])
+        dl_val = DataLoaderFeatures(self.dataset_val, self.feature_cache_folder, self.batch_size, report=self.report["validation"])
+        # same transforms as the no_aug pipeline: remove -1 labels, rename seg to target, to tensor
+        return get_moreDA_augmentation_noaug(dl_tr, dl_val, self.data_aug_params['patch_size_for_spatialtransform'],
+                                             self.data_aug_params, deep_supervision_scales=None,
+                                             pin_memory=self.pin_memory, use_nondetMultiThreadedAugmenter=False)
+
     def get_tokenizer(self):
-        checkpoint = "/home/jason/models/healx-gpt-2-pubmed-medium"
+        checkpoint = default_gpt2_checkpoint
         tokenizer = GPT2Tokenizer.from_pretrained(checkpoint)
         tokenizer.pad_token = tokenizer.eos_token
 
@@ -449,37 +567,27 @@ class nnUNetTrainerV2(nnUNetTrainer):
         # eps: if the lr change gap less than 1e-8, then ignore this lr change
 
 
-    def tokenized(self, report):
-        # pharases shape (b,)
-        # f = lambda x:x.split(';')
-        # phrases = f(phrases) # List<List<str>>
-        # temp = list(map(lambda x:x.split(';'), phrases))
-        # phrases = np.asarray(phrases)
-        # phrases = phrases.flatten()
-        # phrases = []
-        # for a in temp:
-        #     phrases.extend(a)
-        # phrases = list(np.asarray(phrases).flatten()) # List<str> shape [report_num_in_a_batch]
+    def get_report_tokens(self):
+        """
+        the phrases of all reports are tokenized once and cached in dataset_directory/report_tokens, the cache file is
+        named after the tokenizer files and the phrases so it is rebuilt whenever either changes
+        """
+        if self.report_tokens is None:
+            self.report_tokens = ReportTokens.build(self.tokenizer, self.report if self.report is not None else {},
+                                                    join(self.dataset_directory, "report_tokens"), max_length=1024)
+        return self.report_tokens
 
+    def tokenized(self, report):
+        # report: List<List<str>>, the phrases of the regions selected for each case in the batch
         phrases = []
         for a in report:
             phrases.extend(a)
 
-        bos_token = "<|endoftext|>"  # note: in the GPT2 tokenizer, bos_token = eos_token = "<|endoftext|>"
-        eos_token = "<|endoftext|>"
-
-        phrases_with_special_tokens = [bos_token + phrase + eos_token for phrase in phrases]
-
-        # the tokenizer will return input_ids of type List[List[int]] and attention_mask of type List[List[int]]
-        k = self.tokenizer(phrases_with_special_tokens, truncation=True, max_length=1024)
+        # same input_ids/attention_mask as tokenizing "<|endoftext|>" + phrase + "<|endoftext|>" with truncation to
+        # 1024 tokens and padding="longest", phrases that are not in the cache are tokenized on the fly
+        input_ids, attention_mask = self.get_report_tokens().collate(phrases)
 
-        example = {}
-        example["input_ids"] = k["input_ids"]
-        example["attention_mask"] = k["attention_mask"]
-
-        example = self.tokenizer.pad(example, padding="longest", return_tensors="pt")
-
-        return example["input_ids"], example["attention_mask"], phrases
+        return input_ids, attention_mask, phrases
 
     def run_online_evaluation(self, output, reference_sents_for_selected_regions):
         """
@@ -924,13 +1032,28 @@ class nnUNetTrainerV2(nnUNetTrainer):
 
         # self.print_to_log_file("epoch",ep,"lr:", np.round(self.optimizer.param_groups[0]['lr'], decimals=6))
 
+    def should_run_online_evaluation(self, iteration):
+        if self.online_eval_heldout:
+            return False
+        every = max(1, int(round(1 / self.online_eval_fraction))) if self.online_eval_fraction > 0 else None
+        return every is not None and iteration % every == 0
+
+    def run_heldout_evaluation(self, mode="train"):
+        """
+        generates reports for a fixed batch of the training or validation generator, drawn the first time this is
+        called, so that the online evaluation of different epochs is comparable
+        """
+        if self.online_eval_batches[mode] is None:
+            self.online_eval_batches[mode] = next(self.tr_gen if mode == "train" else self.val_gen)
+        self.run_iteration(iter([self.online_eval_batches[mode]]), False, True)
+
     def finish_online_evaluation(self, mode="train"):
 
         if len(self.epoch_bleus):
+            self.online_eval_scores[mode].extend(zip(self.epoch_bleus, self.epoch_rouges, self.epoch_f1s))
 
-            mean_bleu = np.mean(self.epoch_bleus)
-            mean_rouge = np.mean(self.epoch_rouges)
-            mean_f1 = np.mean(self.epoch_f1s)
+            # windowed averages over the last online_eval_window evaluated batches
+            mean_bleu, mean_rouge, mean_f1 = np.mean(self.online_eval_scores[mode], 0)
 
             if mode == "train":
                 self.all_train_eval_metrics["bleu"].append(mean_bleu)
@@ -1025,7 +1148,12 @@ class nnUNetTrainerV2(nnUNetTrainer):
                 # output_xxx[0].shape b,num_classes,pathc_size
                 # target[1].shape b,num_classes,patch_size//2 target[2].shape b,num_classes,patch_size//4 target[3].shape b,num_classes,patch_size//8 target[4].shape b,num_classes,patch_size//16
                 a={}
-                region_features, _ = self.network(data, target, modal, region, eval_mode="region_oracle")
+                if self.use_feature_cache:
+                    # data are the cached backbone features, target is already downsampled
+                    region_features, _ = self.network.pool_region_features(data.half() if self.fp16 else data, target,
+                                                                           region, eval_mode="region_oracle")
+                else:
+                    region_features, _ = self.network(data, target, modal, region, eval_mode="region_oracle")
 
                 del data
                 del region
@@ -1128,6 +1256,10 @@ class nnUNetTrainerV2(nnUNetTrainer):
         if not torch.cuda.is_available():
             self.print_to_log_file("WARNING!!! You are attempting to run training on a CPU (torch.cuda.is_available() is False). This can be VERY slow!")
 
+        if self.use_feature_cache and self.tr_gen is None:
+            self.extract_frozen_features()
+            self.tr_gen, self.val_gen = self.get_feature_generators()
+
         _ = self.tr_gen.next()
         _ = self.val_gen.next()
 
@@ -1166,18 +1298,25 @@ class nnUNetTrainerV2(nnUNetTrainer):
 
                         # do_backdrop and run_online_evaluation
 
-                        l = self.run_iteration(self.tr_gen, True, train_run_eval)
+                        l = self.run_iteration(self.tr_gen, True,
+                                               train_run_eval and self.should_run_online_evaluation(b))
 
                         tbar.set_postfix(loss=l)
                         train_losses_epoch.append(l)
             else:
-                for _ in range(self.num_batches_per_epoch):
-                    l = self.run_iteration(self.tr_gen, True, train_run_eval)
+                for b in range(self.num_batches_per_epoch):
+                    l = self.run_iteration(self.tr_gen, True, train_run_eval and self.should_run_online_evaluation(b))
                     train_losses_epoch.append(l)
 
             self.all_tr_losses.append(np.mean(train_losses_epoch))
             self.print_to_log_file("train loss : %.4f" % self.all_tr_losses[-1])
 
+            if train_run_eval and self.online_eval_heldout:
+                with torch.no_grad():
+                    self.network.eval()
+                    self.llm_model.eval()
+                    self.run_heldout_evaluation(mode="train")
+
             ### this reset the online evaluation values so that it won't mess with 
             ### the later online evaluation on validation set (if it runs) 
             self.finish_online_evaluation(mode="train")
@@ -1190,11 +1329,14 @@ class nnUNetTrainerV2(nnUNetTrainer):
 
                 val_losses = []
                 for b in range(self.num_val_batches_per_epoch):
-                    l = self.run_iteration(self.val_gen, False, val_run_eval)
+                    l = self.run_iteration(self.val_gen, False, val_run_eval and self.should_run_online_evaluation(b))
                     val_losses.append(l)
                 
                 self.all_val_losses.append(np.mean(val_losses))
                 self.print_to_log_file("validation loss: %.4f" % self.all_val_losses[-1])
+
+                if val_run_eval and self.online_eval_heldout:
+                    self.run_heldout_evaluation(mode="val")
                 self.finish_online_evaluation(mode="val")
             
             # update value of self.train_loss_MA (in network_trainer.py)
@@ -90,7 +90,8 @@ class nnUNetTrainerV2(nnUNetTrainer):
     """
 
     def __init__(self, plans_file, fold, train_file, only_ana=False, abnormal_type="intense", num_batches_per_epoch=250, num_val_batches_per_epoch=50, output_folder=None, dataset_directory=None, batch_dice=True, stage=None,
-                 unpack_data=True, deterministic=True, fp16=False, network_type="normal",dataset_directory_bucket=None,anatomy_reverse=False):
+                 unpack_data=True, deterministic=True, fp16=False, network_type="normal",dataset_directory_bucket=None,anatomy_reverse=False,
+                 lesion_bank_file=None, reference_file=None):
         super().__init__(plans_file, fold, output_folder, dataset_directory, batch_dice, stage, unpack_data,
                          deterministic, fp16)
         self.max_num_epochs = 1000
@@ -99,7 +100,7 @@ class nnUNetTrainerV2(nnUNetTrainer):
         self.ds_loss_weights = None
 
         self.init_args = (plans_file, fold, train_file, only_ana, abnormal_type, num_batches_per_epoch, num_val_batches_per_epoch, output_folder, dataset_directory, batch_dice, stage, unpack_data,
-                          deterministic, fp16, network_type,dataset_directory_bucket,anatomy_reverse)
+                          deterministic, fp16, network_type,dataset_directory_bucket,anatomy_reverse, lesion_bank_file, reference_file)
 
         self.online_eval_foreground_dc_ana = []
         self.online_eval_tp_ana = []
@@ -150,6 +151,8 @@ class nnUNetTrainerV2(nnUNetTrainer):
 
         self.only_ana = only_ana
         self.abnormal_type = abnormal_type
+        self.lesion_bank_file = lesion_bank_file
+        self.reference_file = reference_file
 
         self.network_type = network_type
 
@@ -270,10 +273,12 @@ class nnUNetTrainerV2(nnUNetTrainer):
         self.do_split()
         dl_tr = DataLoader3D(self.dataset_tr, self.basic_generator_patch_size, self.patch_size, self.batch_size, abnormal_type=self.abnormal_type,
                                 has_prev_stage=True, oversample_foreground_percent=self.oversample_foreground_percent,
-                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
+                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r',
+                                lesion_bank_file=self.lesion_bank_file, reference_file=self.reference_file)
         dl_val = DataLoader3D(self.dataset_val, self.patch_size, self.patch_size, self.batch_size, abnormal_type=self.abnormal_type,
                                 has_prev_stage=True,oversample_foreground_percent=self.oversample_foreground_percent,
-                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
+                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r',
+                                lesion_bank_file=self.lesion_bank_file, reference_file=self.reference_file)
         return dl_tr, dl_val
 
     def get_basic_generators_bucket(self):
@@ -370,7 +375,8 @@ class nnUNetTrainerV2(nnUNetTrainer):
                     # unpack_dataset(self.folder_with_preprocessed_data)
                     # print("done")
                     if self.dataset_directory_bucket is None:
-                        unpack_dataset(self.folder_with_preprocessed_data, train_file = self.train_file)
+                        unpack_dataset(self.folder_with_preprocessed_data, train_file = self.train_file,
+                                       synthesis_cache=self.abnormal_type != "no_abnormal")
                     else:
                         # the data is on the bucket
                         unpack_dataset_bucket(self.folder_with_preprocessed_data, self.folder_with_preprocessed_data_bucket, train_file = self.train_file, client=self.client)
@@ -823,7 +829,8 @@ class nnUNetTrainerV2(nnUNetTrainer):
                                                          use_sliding_window: bool = True, step_size: float = 0.5,
                                                          use_gaussian: bool = True, pad_border_mode: str = 'constant',
                                                          pad_kwargs: dict = None, all_in_gpu: bool = False,
-                                                         verbose: bool = True, mixed_precision=True, modal=None):
+                                                         verbose: bool = True, mixed_precision=True, modal=None,
+                                                         return_probabilities: bool = True):
         """
         We need to wrap this because we need to enforce self.network.do_ds = False for prediction
         """
@@ -837,7 +844,8 @@ class nnUNetTrainerV2(nnUNetTrainer):
                                                                        pad_border_mode=pad_border_mode,
                                                                        pad_kwargs=pad_kwargs, all_in_gpu=all_in_gpu,
                                                                        verbose=verbose,
-                                                                       mixed_precision=mixed_precision)
+                                                                       mixed_precision=mixed_precision,
+                                                                       return_probabilities=return_probabilities)
         self.network.do_ds = ds
         return ret
 
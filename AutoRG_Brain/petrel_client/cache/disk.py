@@ -0,0 +1,176 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from os.path import abspath, expanduser
+
+from petrel_client.client_base import ClientBase
+
+LOG = logging.getLogger(__name__)
+
+_DATA_SUFFIX = '.data'
+_META_SUFFIX = '.meta'
+# eviction goes down to this fraction of disk_cache_max_bytes, so the next
+# puts fit without rescanning the directory
+_EVICT_TO_FRACTION = 0.9
+
+
+def _etag_md5(etag):
+    # ETag of an object uploaded in one part is the md5 of its content,
+    # multipart ETags ("<md5>-<parts>") can not be checked locally
+    if not etag:
+        return None
+    etag = etag.strip('"')
+    if len(etag) == 32 and '-' not in etag:
+        return etag.lower()
+    return None
+
+
+class DiskCache(ClientBase):
+    """
+    local disk tier of MixedClient, checked before memcached and the backend.
+    Each object is stored as <sha1(uri)>.data plus a json .meta sidecar holding
+    the uri, the content length and the ETag (if the backend returned one).
+    Files are written to a temp file and renamed, so concurrent readers (e.g.
+    dataloader workers sharing the directory) never see partial content.
+    With disk_cache_verify_etag, MixedClient revalidates hits against the
+    length and ETag of the backend object (see get).
+    Hits refresh the mtime. Once the directory exceeds disk_cache_max_bytes,
+    eviction drops the least recently used entries until it is below 90% of
+    the cap.
+    """
+
+    def __init__(self, conf, *args, **kwargs):
+        super(DiskCache, self).__init__(*args, name='disk', conf=conf, **kwargs)
+        self._dir = abspath(expanduser(conf.get('disk_cache_dir')))
+        self._max_bytes = conf.get_int('disk_cache_max_bytes')
+        self._verify_etag = conf.get_boolean('disk_cache_verify_etag')
+        self.revalidate = self._verify_etag
+        os.makedirs(self._dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # estimate only, other processes write into the same directory. The
+        # directory is rescanned whenever the estimate exceeds the cap
+        self._used_bytes = sum(size for _, size, _ in self._scan())
+        self.log = LOG
+
+    def _paths(self, uri):
+        name = hashlib.sha1(uri.encode('utf-8')).hexdigest()
+        prefix = os.path.join(self._dir, name[:2], name)
+        return prefix + _DATA_SUFFIX, prefix + _META_SUFFIX
+
+    def _scan(self):
+        # (mtime, size, data path) of all complete entries
+        entries = []
+        for root, _, files in os.walk(self._dir):
+            for f in files:
+                if not f.endswith(_DATA_SUFFIX):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    @staticmethod
+    def _remove(data_path):
+        for path in (data_path, data_path[:-len(_DATA_SUFFIX)] + _META_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _write_atomic(path, content):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def get(self, uri, etag=None, size=None, **kwargs):
+        """
+        :param etag: if given, entries cached with a different ETag are stale
+        :param size: if given, entries with a different length are stale
+        :return: cached content, or None on a miss or an invalid entry
+        """
+        data_path, meta_path = self._paths(uri)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                content = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+        valid = meta.get('uri') == uri and len(content) == meta.get('size')
+        if valid and size is not None:
+            valid = len(content) == size
+        if valid and etag is not None:
+            valid = meta.get('etag') == etag
+        if valid and self._verify_etag:
+            md5 = _etag_md5(meta.get('etag'))
+            valid = md5 is None or hashlib.md5(content).hexdigest() == md5
+        if not valid:
+            LOG.debug('drop invalid disk cache entry for %s', uri)
+            self._remove(data_path)
+            return None
+
+        try:
+            os.utime(data_path)
+        except FileNotFoundError:
+            pass
+        return content
+
+    def put(self, uri, content, info=None):
+        size = len(content)
+        if size > self._max_bytes:
+            return
+
+        data_path, meta_path = self._paths(uri)
+        meta = {'uri': uri, 'size': size}
+        if info and info.get('etag'):
+            meta['etag'] = info['etag']
+
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        # data first: an entry is only visible once its meta file exists
+        try:
+            os.remove(meta_path)
+        except FileNotFoundError:
+            pass
+        self._write_atomic(data_path, content)
+        self._write_atomic(meta_path, json.dumps(meta).encode('utf-8'))
+
+        with self._lock:
+            self._used_bytes += size
+            if self._used_bytes > self._max_bytes:
+                self._evict()
+
+    def delete(self, uri):
+        self._remove(self._paths(uri)[0])
+
+    def _evict(self):
+        entries = sorted(self._scan())
+        used = sum(size for _, size, _ in entries)
+        if used <= self._max_bytes:
+            # other processes already evicted
+            self._used_bytes = used
+            return
+        target = int(self._max_bytes * _EVICT_TO_FRACTION)
+        for _, size, path in entries:
+            if used <= target:
+                break
+            self._remove(path)
+            used -= size
+        self._used_bytes = used
@@ -185,6 +185,23 @@ class S3Client(Ceph):
             info['md5'] = md5.hexdigest()
         return result, info
 
+    def head(self, cluster, bucket, key):
+        """
+        :return: {'size': content length, 'etag': ETag} of the object, without its content
+        """
+        assert self._cluster == cluster
+        try:
+            obj = self._s3_resource.Object(bucket, key)
+            obj.load()
+            return {'size': obj.content_length, 'etag': obj.e_tag.strip('"')}
+        except BotoClientError as err:
+            if err.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                raise NoSuchKeyError(cluster, bucket, key)
+            elif err.response['ResponseMetadata']['HTTPStatusCode'] == 403:
+                raise AccessDeniedError(err)
+            else:
+                raise S3ClientError(err)
+
     def contains(self, cluster, bucket, key):
         assert self._cluster == cluster
         try:
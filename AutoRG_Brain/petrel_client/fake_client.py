@@ -1,3 +1,5 @@
+import hashlib
+
 from petrel_client.client_base import ClientBase
 from petrel_client.common.io_profile import profile
 
@@ -5,6 +7,7 @@ from petrel_client.common.io_profile import profile
 class FakeClient(ClientBase):
     customized_get = None
     customized_put = None
+    customized_delete = None
 
     def __init__(self, client_type, conf, **kwargs):
         super(FakeClient, self).__init__(conf=conf, **kwargs)
@@ -23,8 +26,14 @@ class FakeClient(ClientBase):
     def get_with_info(self, *args, **kwargs):
         info = {}
         data = self.get(*args, **kwargs)
+        if kwargs.get('enable_etag', False) and isinstance(data, bytes):
+            info['etag'] = hashlib.md5(data).hexdigest()
         return data, info
 
+    def head(self, *args, **kwargs):
+        data = self.get(*args, **kwargs)
+        return {'size': len(data), 'etag': hashlib.md5(data).hexdigest()}
+
     @profile('put')
     def put(self, *args, **kwargs):
         if self.customized_put:
@@ -41,5 +50,9 @@ class FakeClient(ClientBase):
         result = self.put(*args, **kwargs)
         return result, info
 
+    def delete(self, *args, **kwargs):
+        if self.customized_delete:
+            return self.customized_delete(*args, **kwargs)
+
     def enable_cache(self):
         return self.__enable_cache
@@ -25,6 +25,39 @@ from batchgenerators.utilities.file_and_folder_operations import *
 from multiprocessing.pool import Pool
 
 
+def sample_class_locations(seg, all_classes, rndst, num_samples=10000, min_percent_coverage=0.01):
+    """
+    Same result as calling np.argwhere(seg == c) for every c in all_classes and drawing
+    max(min(num_samples, n), ceil(n * min_percent_coverage)) of the n locations with rndst.choice, but the voxels are
+    grouped by label in a single pass (stable sort keeps each group in np.argwhere order, so rndst draws the same
+    samples)
+    :param seg: (x, y, z) label map
+    :param rndst: np.random.RandomState, consumed in the order of all_classes
+    :return: dict class -> (num_selected, 3) array of voxel locations ([] if the class is absent)
+    """
+    flat_seg = seg.ravel()
+    fg_idx = np.flatnonzero(np.isin(flat_seg, list(all_classes)))
+    fg_labels = flat_seg[fg_idx]
+    order = np.argsort(fg_labels, kind='stable')
+    fg_labels = fg_labels[order]
+    fg_idx = fg_idx[order]
+
+    class_locs = {}
+    for c in all_classes:
+        start, end = np.searchsorted(fg_labels, c, side='left'), np.searchsorted(fg_labels, c, side='right')
+        n = end - start
+        if n == 0:
+            class_locs[c] = []
+            continue
+        target_num_samples = min(num_samples, n)
+        target_num_samples = max(target_num_samples, int(np.ceil(n * min_percent_coverage)))
+
+        selected = fg_idx[start:end][rndst.choice(n, target_num_samples, replace=False)]
+        class_locs[c] = np.stack(np.unravel_index(selected, seg.shape), axis=1)
+        print(c, target_num_samples)
+    return class_locs
+
+
 def get_do_separate_z(spacing, anisotropy_threshold=RESAMPLING_SEPARATE_Z_ANISO_THRESHOLD):
     do_separate_z = (np.max(spacing) / np.min(spacing)) > anisotropy_threshold
     return do_separate_z
@@ -342,18 +375,7 @@ class GenericPreprocessor(object):
         num_samples = 10000
         min_percent_coverage = 0.01 # at least 1% of the class voxels need to be selected, otherwise it may be too sparse
         rndst = np.random.RandomState(1234)
-        class_locs = {}
-        for c in all_classes:
-            all_locs = np.argwhere(all_data[-1] == c)
-            if len(all_locs) == 0:
-                class_locs[c] = []
-                continue
-            target_num_samples = min(num_samples, len(all_locs))
-            target_num_samples = max(target_num_samples, int(np.ceil(len(all_locs) * min_percent_coverage)))
-
-            selected = all_locs[rndst.choice(len(all_locs), target_num_samples, replace=False)]
-            class_locs[c] = selected
-            print(c, target_num_samples)
+        class_locs = sample_class_locations(all_data[-1], all_classes, rndst, num_samples, min_percent_coverage)
         properties['class_locations'] = class_locs
 
         print("saving: ", os.path.join(output_folder_stage, "%s.npz" % case_identifier))
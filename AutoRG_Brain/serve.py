@@ -0,0 +1,54 @@
+from inference.inferenceSdk import AutoRG_Brain
+from inference.report_service import ReportService, make_server
+import argparse
+import os
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-o',"--out_dir", required=True, default=None, help="folder for saving mask predictions")
+parser.add_argument('--llm_folder', required=True, default=None, help="folder of saved llm checkpoint")
+parser.add_argument('--llm_chk', help='llm checkpoint name (if xx.model then --llm_chk xx)', default='AutoRG_Brain_RGv1')
+parser.add_argument('--seg_folder', required=True, default=None, help="folder of saved segmentation checkpoint")
+parser.add_argument('--seg_chk', help='segmentation checkpoint name (if xx.model then --seg_chk xx)', default='AutoRG_Brain_SEG')
+parser.add_argument('--eval_mode', required=False,default='region_segtool', help="the report inference way")
+parser.add_argument('--no_mask_export', required=False, action='store_true', help="do not write the predicted masks as nifti")
+parser.add_argument('--staged', required=False, action='store_true', help="write the masks to disk and preprocess them again before report generation instead of passing them in memory")
+parser.add_argument('--quantize_llm', required=False, action='store_true', help="generate the reports on the CPU with int8 weights, check the accuracy with check_quantization.py first")
+parser.add_argument('--host', required=False, default='127.0.0.1', help="address of the http endpoint, keep it on loopback")
+parser.add_argument('--port', required=False, type=int, default=8765)
+parser.add_argument('--unix_socket', required=False, default=None, help="serve on this unix socket instead of host:port")
+parser.add_argument('--max_queue', required=False, type=int, default=8, help="number of requests that can wait, further requests get 503")
+parser.add_argument('--max_batch_cases', required=False, type=int, default=16, help="cases of several queued requests are processed together up to this number")
+parser.add_argument('--submit_timeout', required=False, type=float, default=5, help="seconds a request waits for a free slot in the queue")
+parser.add_argument('--request_timeout', required=False, type=float, default=600, help="default timeout (seconds) of a request, 0 for none")
+
+args = parser.parse_args()
+
+os.makedirs(args.out_dir, exist_ok=True)
+
+config = {
+    'llm_folder':args.llm_folder,
+    'seg_folder':args.seg_folder,
+    'llm_chk':args.llm_chk,
+    'seg_chk':args.seg_chk,
+    'output_dir':args.out_dir,
+    'eval_mode':args.eval_mode,
+    'save_masks':not args.no_mask_export,
+    'fuse_seg_report':not args.staged,
+    'quantize_llm':args.quantize_llm
+}
+
+model = AutoRG_Brain(gpu_id=[0], config=config)
+
+service = ReportService(model, max_queue_size=args.max_queue, max_batch_cases=args.max_batch_cases,
+                        submit_timeout=args.submit_timeout, request_timeout=args.request_timeout)
+service.start()
+
+server = make_server(service, host=args.host, port=args.port, unix_socket=args.unix_socket)
+print("serving reports on", args.unix_socket if args.unix_socket is not None else "%s:%d" % (args.host, args.port))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    service.stop()
@@ -11,6 +11,9 @@ parser.add_argument('--seg_folder', required=True, default=None, help="folder of
 parser.add_argument('--seg_chk', help='segmentation checkpoint name (if xx.model then --seg_chk xx)', default='AutoRG_Brain_SEG')
 parser.add_argument('-test','--test_file', required=True,default=None, help="json with your test images info")
 parser.add_argument('--eval_mode', required=False,default='region_segtool', help="the report inference way")
+parser.add_argument('--no_mask_export', required=False, action='store_true', help="do not write the predicted masks as nifti")
+parser.add_argument('--staged', required=False, action='store_true', help="write the masks to disk and preprocess them again before report generation instead of passing them in memory")
+parser.add_argument('--quantize_llm', required=False, action='store_true', help="generate the reports on the CPU with int8 weights, check the accuracy with check_quantization.py first")
 
 args = parser.parse_args()
 
@@ -22,7 +25,10 @@ config = {
     'llm_chk':args.llm_chk,
     'seg_chk':args.seg_chk,
     'output_dir':args.out_dir,
-    'eval_mode':args.eval_mode
+    'eval_mode':args.eval_mode,
+    'save_masks':not args.no_mask_export,
+    'fuse_seg_report':not args.staged,
+    'quantize_llm':args.quantize_llm
 }
 
 model = AutoRG_Brain(gpu_id=[0], config=config)
@@ -80,6 +80,8 @@ def main():
                         help='Predictions are done with mixed precision by default. This improves speed and reduces '
                              'the required vram. If you want to disable mixed precision you can set this flag. Note '
                              'that this is not recommended (mixed precision is ~2x faster!)')
+    parser.add_argument('--pin_memory', default=False, action='store_true', required=False,
+                        help='keep the checkpoint weights in pinned host memory for faster copies to the GPU')
     
     args = parser.parse_args()
     output_folder = args.output_folder
@@ -111,7 +113,8 @@ def main():
                         num_threads_nifti_save, part_id, num_parts, not disable_tta,
                         overwrite_all_in_gpu=all_in_gpu,
                         mixed_precision=not args.disable_mixed_precision,
-                        step_size=step_size, checkpoint_name=args.chk, eval_mode = args.eval_mode)
+                        step_size=step_size, checkpoint_name=args.chk, eval_mode = args.eval_mode,
+                        pin_memory=args.pin_memory)
     end = time()
     save_json(end - st, join(output_folder, 'prediction_time.txt'))
 
@@ -116,6 +116,8 @@ def main():
                         help='Predictions are done with mixed precision by default. This improves speed and reduces '
                              'the required vram. If you want to disable mixed precision you can set this flag. Note '
                              'that this is not recommended (mixed precision is ~2x faster!)')
+    parser.add_argument('--pin_memory', default=False, action='store_true', required=False,
+                        help='keep the checkpoint weights in pinned host memory for faster copies to the GPU')
 
     args = parser.parse_args()
     output_folder = args.output_folder
@@ -155,7 +157,7 @@ def main():
                         num_threads_nifti_save, dice_type, part_id, num_parts, not disable_tta,
                         save_output_nii = args.save_output_nii, overwrite_all_in_gpu=all_in_gpu,
                         mixed_precision=not args.disable_mixed_precision,
-                        step_size=step_size, checkpoint_name=args.chk, modal=modal)
+                        step_size=step_size, checkpoint_name=args.chk, modal=modal, pin_memory=args.pin_memory)
     end = time()
     save_json(end - st, join(output_folder, 'prediction_time.txt'))
     if dice_abnormal is None:
@@ -0,0 +1,149 @@
+import os
+
+import pytest
+
+pytest.importorskip("environs")
+pytest.importorskip("coloredlogs")
+pytest.importorskip("humanize")
+
+from petrel_client.cache.disk import DiskCache
+from petrel_client.fake_client import FakeClient
+from petrel_client.mixed_client import MixedClient
+
+OBJECT_SIZE = 100
+MAX_BYTES = 10 * OBJECT_SIZE
+
+
+@pytest.fixture
+def make_client(tmp_path, monkeypatch):
+    """
+    MixedClient with the fake backend (objects maps keys to content, other keys return the key padded to
+    OBJECT_SIZE) and the disk cache in tmp_path
+    """
+    objects = {}
+    backend_gets = []
+
+    def get(cluster, bucket, key, **kwargs):
+        backend_gets.append(key)
+        return objects.get(key, key.encode('utf-8').ljust(OBJECT_SIZE, b'.'))
+
+    def put(cluster, bucket, key, body, **kwargs):
+        objects[key] = body
+        return len(body)
+
+    monkeypatch.setattr(FakeClient, 'customized_get', staticmethod(get))
+    monkeypatch.setattr(FakeClient, 'customized_put', staticmethod(put))
+    monkeypatch.setattr(FakeClient, 'customized_delete', staticmethod(lambda cluster, bucket, key: objects.pop(key)))
+
+    def make(verify_etag=False):
+        conf_path = tmp_path / "petreloss.conf"
+        conf_path.write_text("\n".join([
+            "[DEFAULT]",
+            "fake = True",
+            "enable_disk_cache = True",
+            "disk_cache_dir = %s" % (tmp_path / "cache"),
+            "disk_cache_max_bytes = %d" % MAX_BYTES,
+            "disk_cache_verify_etag = %s" % verify_etag,
+            "default_cluster = cluster1",
+            "console_log_level = ERROR",
+            "[cluster1]",
+            "host_base = http://127.0.0.1",
+        ]))
+        client = MixedClient(str(conf_path))
+        client.objects = objects
+        client.backend_gets = backend_gets
+        return client
+
+    return make
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
+
+
+def uri(i):
+    return 's3://bucket/key%d' % i
+
+
+def is_cached(client, i):
+    return os.path.exists(client._disk_cache._paths(uri(i))[0])
+
+
+def test_evicts_least_recently_used(client, monkeypatch):
+    disk_cache = client._disk_cache
+
+    # fill the cache up to the cap, key0 is the oldest entry
+    for i in range(10):
+        client.get_with_info(uri(i))
+        mtime = 1000 + i
+        os.utime(disk_cache._paths(uri(i))[0], (mtime, mtime))
+    assert all(is_cached(client, i) for i in range(10))
+
+    # a hit is served from disk and makes key0 the most recently used entry
+    content, _ = client.get_with_info(uri(0))
+    assert content.startswith(b'key0')
+    assert client.backend_gets.count('key0') == 1
+
+    # key10 exceeds the cap, key1 and key2 are evicted to get below 90% of it
+    client.get_with_info(uri(10))
+    assert not is_cached(client, 1) and not is_cached(client, 2)
+    assert all(is_cached(client, i) for i in [0] + list(range(3, 11)))
+
+    # key11 fits below the cap, the directory is not scanned again
+    scans = []
+    monkeypatch.setattr(DiskCache, '_scan', lambda self: scans.append(1) or [])
+    client.get_with_info(uri(11))
+    assert len(scans) == 0
+    assert is_cached(client, 11)
+
+
+def test_truncated_data_file_is_refetched(client):
+    client.get_with_info(uri(0))
+    data_path = client._disk_cache._paths(uri(0))[0]
+    with open(data_path, 'r+b') as f:
+        f.truncate(OBJECT_SIZE // 2)
+
+    content, _ = client.get_with_info(uri(0))
+    assert len(content) == OBJECT_SIZE
+    assert client.backend_gets.count('key0') == 2
+    assert os.path.getsize(data_path) == OBJECT_SIZE
+
+
+def test_mismatched_etag_is_refetched(client):
+    client.get_with_info(uri(0))
+    client.get_with_info(uri(0))
+    assert client.backend_gets.count('key0') == 1
+
+    client.get_with_info(uri(0), etag='0123456789abcdef0123456789abcdef')
+    assert client.backend_gets.count('key0') == 2
+
+
+def test_put_and_delete_invalidate(client):
+    client.get_with_info(uri(0))
+    client.put_with_info(uri(0), b'new content')
+    assert not is_cached(client, 0)
+    content, _ = client.get_with_info(uri(0))
+    assert content == b'new content'
+
+    assert is_cached(client, 0)
+    client.delete(uri(0))
+    assert not is_cached(client, 0)
+
+
+def test_revalidates_against_the_backend(make_client):
+    client = make_client(verify_etag=True)
+    client.get_with_info(uri(0))
+    gets = len(client.backend_gets)
+
+    # the HEAD request of the hit reads the fake object, the content comes from disk
+    content, info = client.get_with_info(uri(0))
+    assert info is None
+    assert content.startswith(b'key0')
+
+    # overwritten on the backend behind the client's back: same length, other ETag
+    client.objects['key0'] = b'x' * OBJECT_SIZE
+    content, info = client.get_with_info(uri(0))
+    assert content == b'x' * OBJECT_SIZE
+    assert info is not None
+    assert len(client.backend_gets) > gets
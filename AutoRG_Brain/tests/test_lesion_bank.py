@@ -0,0 +1,56 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from augmentation.lesion_bank import LesionBank
+
+CUBE_SIZE = 32
+RADIUS = 12
+
+
+def write_bank(bank_file, num_lesions=3):
+    """
+    a bank of balls in the layout of generate_lesion_bank, without meshing them with VTK
+    """
+    grid = np.indices((CUBE_SIZE,) * 3) - CUBE_SIZE / 2. + 0.5
+    ball = np.sqrt((grid ** 2).sum(0)) <= RADIUS
+    masks = np.stack([np.packbits(ball, axis=-1)] * num_lesions)
+    np.save(bank_file, masks)
+
+    lo = CUBE_SIZE // 2 - RADIUS
+    bboxes = np.tile(np.array([lo, CUBE_SIZE - lo], dtype=np.int32), (num_lesions, 3, 1))
+    with open(bank_file[:-4] + ".pkl", 'wb') as f:
+        pickle.dump({'radii': np.full(num_lesions, RADIUS, dtype=np.float32), 'bboxes': bboxes,
+                     'cube_size': CUBE_SIZE}, f)
+    return ball
+
+
+def test_sample(tmp_path):
+    ball = write_bank(str(tmp_path / "bank.npy"))
+    bank = LesionBank(str(tmp_path / "bank.npy"), scale_range=(1., 1.))
+
+    mask = bank.sample(RADIUS)
+    assert mask.dtype == bool
+    assert mask.shape == (2 * RADIUS,) * 3
+    assert mask.sum() == ball.sum()
+
+
+def test_tumor_array_generate_from_bank(tmp_path, monkeypatch):
+    for module in ("vtk", "torchio", "noise", "cv2", "nibabel", "SimpleITK", "skimage", "elasticdeform"):
+        pytest.importorskip(module)
+    from dataset import copypaste
+
+    ball = write_bank(str(tmp_path / "bank.npy"))
+    bank = LesionBank(str(tmp_path / "bank.npy"), scale_range=(1., 1.))
+    monkeypatch.setattr(copypaste, "sample_lesion_radius", lambda: float(RADIUS))
+
+    img_array = np.zeros((96, 96, 96), dtype=np.float32)
+    img_array[16:80, 16:80, 16:80] = 1
+
+    # itk_img and input_poly_data are only needed to mesh a new lesion
+    mask = copypaste.tumor_array_generate(img_array, None, None, "case", bank)
+    assert mask.shape == img_array.shape
+    assert set(np.unique(mask)) == {0, 1}
+    assert 0.8 * ball.sum() < mask.sum() <= ball.sum()
+    assert np.all(img_array[mask > 0] == 1)
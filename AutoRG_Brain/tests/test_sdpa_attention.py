@@ -0,0 +1,101 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip("torch")
+for module in ("torchinfo", "transformers", "batchgenerators"):
+    pytest.importorskip(module)
+if not hasattr(torch.nn.functional, "scaled_dot_product_attention"):
+    pytest.skip("scaled_dot_product_attention needs torch >= 2.0", allow_module_level=True)
+
+from network.language_model_patchwise import GPT2PseudoAttention, LayerKVCache
+
+HIDDEN_DIM = 1024
+IMG_PATCH_NUM = 3
+MAX_TOKENS = 32
+
+
+@pytest.fixture
+def attentions():
+    """
+    the same attention layer with attn_implementation eager and sdpa, on the CPU in float32
+    """
+    torch.manual_seed(0)
+    c_attn = (torch.randn(HIDDEN_DIM, 3 * HIDDEN_DIM) * 0.02, torch.randn(3 * HIDDEN_DIM) * 0.02)
+    c_proj = (torch.randn(HIDDEN_DIM, HIDDEN_DIM) * 0.02, torch.randn(HIDDEN_DIM) * 0.02)
+    eager = GPT2PseudoAttention(c_attn, c_proj, MAX_TOKENS, attn_implementation="eager").eval()
+    sdpa = GPT2PseudoAttention(c_attn, c_proj, MAX_TOKENS, attn_implementation="sdpa").eval()
+    sdpa.load_state_dict(eager.state_dict())
+    return eager, sdpa
+
+
+def additive_mask(word_mask):
+    """
+    the attention mask LanguageModel.forward passes to the layers: image tokens are always visible, 0 for attended and
+    -1e4 for masked tokens, shape [batch_size, 1, 1, img_patch_num+seq_len]
+    """
+    ones = torch.ones((word_mask.size(0), IMG_PATCH_NUM), dtype=word_mask.dtype)
+    mask = torch.cat((ones, word_mask), dim=-1)[:, None, None, :].to(torch.float32)
+    return (1.0 - mask) * -10000.0
+
+
+@torch.no_grad()
+def test_training_with_padding(attentions):
+    eager, sdpa = attentions
+    word_hidden_states = torch.randn(2, 6, HIDDEN_DIM)
+    image_hidden_states = torch.randn(2, IMG_PATCH_NUM, HIDDEN_DIM)
+    word_mask = torch.ones(2, 6, dtype=torch.int64)
+    word_mask[1, 4:] = 0
+
+    mask = additive_mask(word_mask)
+    out_eager, _ = eager(word_hidden_states, image_hidden_states, mask, None, False)
+    out_sdpa, _ = sdpa(word_hidden_states, image_hidden_states, mask, None, False)
+    torch.testing.assert_close(out_sdpa, out_eager)
+
+
+@torch.no_grad()
+def test_cached_decoding_step(attentions):
+    eager, sdpa = attentions
+    prompt = torch.randn(2, 4, HIDDEN_DIM)
+    image_hidden_states = torch.randn(2, IMG_PATCH_NUM, HIDDEN_DIM)
+    next_token = torch.randn(2, 1, HIDDEN_DIM)
+
+    outputs = []
+    for attention in (eager, sdpa):
+        cache = LayerKVCache(MAX_TOKENS)
+        attention(prompt, image_hidden_states, additive_mask(torch.ones(2, 4, dtype=torch.int64)), cache, True)
+        out, _ = attention(next_token, None, additive_mask(torch.ones(2, 5, dtype=torch.int64)), cache, True)
+        outputs.append(out)
+    torch.testing.assert_close(outputs[1], outputs[0])
+
+
+@torch.no_grad()
+def test_stale_slots(attentions):
+    """
+    a row that joins generate_stream takes a freed slot: its word positions before the join hold the keys and values
+    of the previous sequence and are masked out
+    """
+    eager, sdpa = attentions
+    cache = LayerKVCache(MAX_TOKENS, max_batch_size=3)
+    cache.write_rows_(torch.arange(3), *[torch.randn(3, eager.num_heads, IMG_PATCH_NUM, eager.head_dim) for _ in range(2)])
+    for _ in range(5):
+        cache.update(*[torch.randn(3, eager.num_heads, 1, eager.head_dim) for _ in range(2)])
+    # slot 1 is taken by a new sequence after 5 decoded words
+    cache.write_rows_(torch.tensor([1]), *[torch.randn(1, eager.num_heads, IMG_PATCH_NUM, eager.head_dim) for _ in range(2)])
+
+    word_mask = torch.ones(3, 6, dtype=torch.int64)
+    word_mask[1, :5] = 0
+    next_token = torch.randn(3, 1, HIDDEN_DIM)
+
+    outputs = []
+    for attention in (eager, sdpa):
+        out, _ = attention(next_token, None, additive_mask(word_mask), copy.deepcopy(cache), True)
+        outputs.append(out)
+    torch.testing.assert_close(outputs[1], outputs[0])
+
+    # the stale words of slot 1 do not change its output
+    stale = copy.deepcopy(cache)
+    stale.key[1, :, IMG_PATCH_NUM:] = torch.randn_like(stale.key[1, :, IMG_PATCH_NUM:])
+    stale.value[1, :, IMG_PATCH_NUM:] = torch.randn_like(stale.value[1, :, IMG_PATCH_NUM:])
+    out, _ = sdpa(next_token, None, additive_mask(word_mask), stale, True)
+    torch.testing.assert_close(out[1], outputs[1][1])
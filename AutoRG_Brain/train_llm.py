@@ -122,6 +122,21 @@ def main():
 
     parser.add_argument("--dataset", type=str, required=False, default="six")
 
+    parser.add_argument('--feature_cache', action='store_true', default=False,
+                        help='run the frozen segmentation backbone once per case and train on the cached features. '
+                             'Needs --bucket and --no_aug and does not work with --train_with_seg')
+    parser.add_argument('--resized_cache', action='store_true', default=False,
+                        help='with --bucket, store all cases resized to the patch size in the local preprocessed '
+                             'folder once and build the batches from there')
+    parser.add_argument('--online_eval_fraction', type=float, required=False, default=0.1,
+                        help='fraction of the iterations of an evaluation epoch that generate reports for the online '
+                             'BLEU/ROUGE, 0 disables it')
+    parser.add_argument('--online_eval_heldout', action='store_true', default=False,
+                        help='instead, generate reports once per evaluation epoch for a fixed training and a fixed '
+                             'validation batch')
+    parser.add_argument('--online_eval_window', type=int, required=False, default=50,
+                        help='the online metrics are averaged over this many evaluated batches')
+
     args = parser.parse_args()
 
     task = args.task
@@ -178,7 +193,10 @@ def main():
                             batch_dice=batch_dice, stage=stage, unpack_data=decompress_data,
                             deterministic=deterministic,
                             fp16=run_mixed_precision, network_type=network_type,feature_layer=args.feature_layer,dataset_directory_bucket=dataset_directory_bucket,train_with_seg=train_with_seg,avg_type=args.avg_type,pool_to_feature_layer=args.pool_to_feature_layer,use_conv_pool=args.use_conv_pool,
-                            use_global = args.use_patchwise, size=args.size, dataset=args.dataset, max_tokens=args.max_tokens)
+                            use_global = args.use_patchwise, size=args.size, dataset=args.dataset, max_tokens=args.max_tokens,
+                            use_feature_cache=args.feature_cache, use_resized_cache=args.resized_cache,
+                            online_eval_fraction=args.online_eval_fraction, online_eval_heldout=args.online_eval_heldout,
+                            online_eval_window=args.online_eval_window)
     trainer.client = client
     
     if args.disable_saving:
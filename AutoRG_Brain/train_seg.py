@@ -37,6 +37,13 @@ def main():
     parser.add_argument("-train", "--train_file", type=str, required=False, default=None, help="use this if you want to train on customized ids")
     parser.add_argument("--only_ana", required=False, default=False, action="store_true",help="only optimize anatomy segmentation loss")
     parser.add_argument("--abnormal_type", type=str, required=False, default="intense",help="set the way yo synthesis abnormaly")
+    parser.add_argument("--lesion_bank_file", type=str, required=False, default=None,
+                        help="lesion bank (.npy) written by augmentation/lesion_bank.py for the copy-paste synthesis")
+    parser.add_argument("--reference_file", type=str, required=False, default=None,
+                        help="json {name: {modality: image}} of the scans the copy-paste synthesis takes the lesion "
+                             "texture from. Required unless --abnormal_type is intense or no_abnormal: mix no "
+                             "longer falls back to the intense synthesis without it. The copy-paste synthesis needs "
+                             "vtk, torchio and noise")
     parser.add_argument(
         "--network_type",
         type=str,
@@ -167,11 +174,13 @@ def main():
     # print("plans_file",plans_file, fold, test_file, output_folder_name, dataset_directory, batch_dice, stage, decompress_data, deterministic, run_mixed_precision)
 
     # plans_file, fold, train_file, only_ana=False, abnormal_type="intense", num_batches_per_epoch=250, num_val_batches_per_epoch=50, output_folder=None, dataset_directory=None, batch_dice=True, stage=None,
-    # unpack_data=True, deterministic=True, fp16=False, network_type="normal",dataset_directory_bucket=None,anatomy_reverse=False
+    # unpack_data=True, deterministic=True, fp16=False, network_type="normal",dataset_directory_bucket=None,anatomy_reverse=False,
+    # lesion_bank_file=None, reference_file=None
     trainer = nnUNetTrainerV2(plans_file, fold, train_file, only_ana=only_ana, abnormal_type=abnormal_type, num_batches_per_epoch=num_batches_per_epoch, num_val_batches_per_epoch=num_val_batches_per_epoch, output_folder=output_folder_name, dataset_directory=dataset_directory,
                             batch_dice=batch_dice, stage=stage, unpack_data=decompress_data,
                             deterministic=deterministic,fp16=run_mixed_precision, 
-                            network_type=network_type,dataset_directory_bucket=dataset_directory_bucket,anatomy_reverse=args.anatomy_reverse)
+                            network_type=network_type,dataset_directory_bucket=dataset_directory_bucket,anatomy_reverse=args.anatomy_reverse,
+                            lesion_bank_file=args.lesion_bank_file, reference_file=args.reference_file)
     trainer.client = client
     
     if args.disable_saving:
@@ -17,6 +17,7 @@ from torch import nn
 import torch.nn.functional as F
 import numpy as np
 
+from scipy.ndimage import distance_transform_edt, find_objects
 from skimage import metrics
 import monai.metrics
 from surface_distance import compute_surface_distances,compute_surface_dice_at_tolerance
@@ -69,6 +70,60 @@ def simple_cal_dice(pred,true,mode='ab'):
 def cal_hd(pred, true):
     return metrics.hausdorff_distance(pred, true)
 
+def _hausdorff_edt(pred, true):
+    # same value as skimage.metrics.hausdorff_distance: max distance of any voxel of one mask to the other mask
+    if not pred.any() and not true.any():
+        return 0.
+    if not pred.any() or not true.any():
+        return np.inf
+    return max(distance_transform_edt(~true)[pred].max(), distance_transform_edt(~pred)[true].max())
+
+
+def cal_multilabel_metrics(pred, true, labels, spacing_mm=(1,1,1), tolerance=2):
+    """
+    cal_dice and cal_hd for several labels of one label map at once. Dice, precision, sensitivity and specificity
+    come from a single confusion matrix, the distances are computed on the bounding box of pred | true of each label
+    :return: one [dice, nsd, hd, precision, sensitivity, specificity] row per label
+    """
+    pred = np.asarray(pred).astype(np.int64)
+    true = np.asarray(true).astype(np.int64)
+    num_classes = int(max(pred.max(), true.max(), max(labels))) + 1
+    confusion = np.bincount((true * num_classes + pred).ravel(),
+                            minlength=num_classes ** 2).reshape(num_classes, num_classes)  # rows: gt, columns: pred
+
+    bboxes_pred = find_objects(pred, num_classes - 1)
+    bboxes_true = find_objects(true, num_classes - 1)
+
+    results = []
+    for label in labels:
+        label = int(label)
+        tp = confusion[label, label]
+        fp = confusion[:, label].sum() - tp
+        fn = confusion[label].sum() - tp
+        tn = pred.size - tp - fp - fn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dice = np.float64(tp * 2.0) / (2 * tp + fp + fn)
+            precision = np.float64(tp) / (tp + fp)
+            sensitivity = np.float64(tp) / (tp + fn)
+            specificity = np.float64(tn) / (tn + fp)
+
+        boxes = [b for b in (bboxes_pred[label - 1], bboxes_true[label - 1]) if b is not None] if label > 0 else []
+        if len(boxes) > 0:
+            # pad by one voxel so the surfaces of the crop are the surfaces of the full masks
+            bbox = tuple(slice(max(min(b[d].start for b in boxes) - 1, 0), max(b[d].stop for b in boxes) + 1)
+                         for d in range(pred.ndim))
+            pred_l = pred[bbox] == label
+            true_l = true[bbox] == label
+        else:
+            pred_l = true_l = np.zeros([1] * pred.ndim, dtype=bool)
+
+        hd = _hausdorff_edt(pred_l, true_l)
+        surface_distances = compute_surface_distances(true_l, pred_l, spacing_mm=spacing_mm)
+        nsd = compute_surface_dice_at_tolerance(surface_distances, tolerance)
+
+        results.append([dice, nsd, hd, precision, sensitivity, specificity])
+    return results
+
 def cal_nsd(pred, true):
     return monai.metrics.compute_surface_dice(pred, true, class_thresholds = [],include_background=False, distance_metric='euclidean')
 